@@ -1,9 +1,18 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
+import numpy as np
+import auditcache
+import osmparser
+import utils
 
 postalCodeRe = re.compile(r'^\d{5}-\d{3}') #It'll return only if the postal code is perfect
 
+# Range of the postal codes of the Curitiba Metropolitan Region (without the dash)
+POSTCODE_MIN = 80000001
+POSTCODE_MAX = 83800999
+
+AUDIT_VERSION = 1 # Change it when the audit code changes, so the cached results are discarded
+
 def test_postcode(value):
     """
     Tests if a postal code is within the acceptable range for the Curitiba Metropolitan Region
@@ -17,16 +26,66 @@ def test_postcode(value):
     """
     try:
         testCode = int(value.replace('-', ''))
-        if testCode >= 80000001 and testCode <= 83800999:
+        if testCode >= POSTCODE_MIN and testCode <= POSTCODE_MAX:
             return True
         else:
             return False
     except:
         return False # If the .replace fails, it means the post code is not in a valid format
 
+def postcode_number(value):
+    """
+    Converts a postal code to the number tested by test_postcode, -1 if it can't be converted,
+    the numbers above the acceptable range are clipped, so they fit in an int64 array
+    """
+    try:
+        return min(int(value.replace('-', '')), POSTCODE_MAX + 1)
+    except:
+        return -1
+
+
+def audit_postcodes(values):
+    """
+    Batch version of audit_postcode: audits a set of postal codes at once
+    Each distinct value is audited only once, and the range of all the candidate codes is tested
+    with a single vectorized comparison
+
+    Args:
+        values: iterable of postal codes, can have repeated values
+
+    Returns:
+        postal_codes: problematic postal codes dictionary (the same returned by audit), in the
+                      order the values were first seen
+    """
+    values = list(dict.fromkeys(values)) # Removes the repeated values, keeping the order
+    candidates = [] # Postal code to test for each value, None if it can't be fixed
+    for value in values:
+        if postalCodeRe.search(value):
+            candidates.append(value)
+        elif len(value) == 8: # If the postal code is only missing the dash (-) it should be
+                              # just 8 characters long
+            candidates.append(value[:5] + '-' + value[5:]) # Adds the dash
+        elif '.' in value: # If it has a dot
+            candidates.append(value.replace('.', ''))
+        else:
+            candidates.append(None)
+    numbers = np.fromiter((postcode_number(candidate) if candidate is not None else -1
+                           for candidate in candidates), dtype=np.int64, count=len(candidates))
+    inRange = (numbers >= POSTCODE_MIN) & (numbers <= POSTCODE_MAX)
+
+    postal_codes = defaultdict(set)
+    for value, candidate, valid in zip(values, candidates, inRange.tolist()):
+        if not valid:
+            postal_codes[value] = 'Invalid Postal Code'
+        elif candidate != value: # If the postal code is not in the standard format
+            postal_codes[value] = candidate
+    return postal_codes
+
+
 def audit_postcode(postal_codes, value):
     """
     Audit whether or not a postal code is in the correct format and within the acceptable range
+    (to audit many values, use audit_postcodes)
     
     Args:
         postal_codes: problematic postal codes dictionary
@@ -34,23 +93,7 @@ def audit_postcode(postal_codes, value):
     Returns:
         Nothing
     """
-    correct = postalCodeRe.search(value)
-    if correct:
-        if not test_postcode(value): # If it's not in the acceptable range
-            postal_codes[value] = 'Invalid Postal Code'
-    if not correct: # If the postal code is not in the standard format
-        if len(value) == 8: # If the postal code is only missing the dash (-) it should be
-                            # just 8 characters long
-            correctValue = value[:5] + '-' + value[5:] # Adds the dash
-            if not test_postcode(correctValue): # If it's not in the acceptable range
-                correctValue = 'Invalid Postal Code'
-        elif '.' in value: # If it has a dot
-            correctValue = value.replace('.', '')
-            if not test_postcode(correctValue): # If it's not in the acceptable range
-                correctValue = 'Invalid Postal Code'
-        else:
-            correctValue = 'Invalid Postal Code'
-        postal_codes[value] = (correctValue)
+    postal_codes.update(audit_postcodes([value]))
 
 
 def is_postcode(elem):
@@ -71,37 +114,105 @@ def is_postcode(elem):
 def audit(osmfile):
     """
     Audits a OSM XML file for postal codes
+    The file is streamed and every element is cleared after being audited, so the memory used
+    doesn't grow with the size of the file, the distinct values are audited at the end
 
     Args:
-        osmfile: OSM XML file path
+        osmfile: OSM XML file path (can be compressed, .gz, .bz2 or .xz, or a PBF file, .pbf)
 
     Returns:
         postal_codes: problematic postal codes dictionary
     """
-    osm_file = open(osmfile, "r", encoding='UTF-8')
-    postal_codes = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_postcode(tag):
-                    audit_postcode(postal_codes, tag.attrib['v'])
-    osm_file.close()
+    values = {} # Distinct values, in the order they're found
+    for elem in osmparser.get_element(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_postcode(tag):
+                values[tag.attrib['v']] = None
+    return audit_postcodes(values)
+
+
+def audit_rules():
+    """
+    Returns the rules used by audit, the cached results are discarded when they change
+    """
+    return {'version': AUDIT_VERSION, 'postalCodeRe': [postalCodeRe.pattern, postalCodeRe.flags],
+            'range': [POSTCODE_MIN, POSTCODE_MAX]}
+
+
+def cached_audit(osmfile, cache=True, prints=False):
+    """
+    Same as audit, but the result is read from the audit cache if the file and the audit
+    rules didn't change since it was saved (see the auditcache module)
+
+    Args:
+        osmfile: OSM XML file path (can be compressed or a PBF file, see audit)
+        cache: if False, the cache isn't used
+        prints: if True and the audit runs (its result isn't cached), prints its peak memory
+                usage
+
+    Returns:
+        postal_codes: problematic postal codes dictionary
+    """
+    postal_codes = load_audit(osmfile) if cache is True else None
+    if postal_codes is None:
+        utils.reset_peak_rss() # Measures the peak of this audit, not of the whole process
+        postal_codes = audit(osmfile)
+        if prints is True:
+            print('Postal codes audit peak memory usage: {} MB'.format(utils.peak_rss()))
+        if cache is True:
+            save_audit(osmfile, postal_codes)
     return postal_codes
 
 
-def execute(osmFile, highlightUnchanged=False, prints=False):
+def load_audit(osmfile):
+    """
+    Reads an audited postal codes dictionary from the audit cache
+
+    Returns:
+        postal_codes: problematic postal codes dictionary, or None if it isn't cached
+    """
+    cached = auditcache.load('postcodes', osmfile, audit_rules())
+    if cached is None:
+        return None
+    return defaultdict(set, cached)
+
+
+def save_audit(osmfile, postal_codes):
+    """
+    Saves an audited postal codes dictionary to the audit cache
+    """
+    auditcache.save('postcodes', osmfile, audit_rules(), postal_codes)
+
+
+def execute(osmFile, highlightUnchanged=False, prints=False, cache=True):
     """
     Main function of this module:
 
     Args:
-        osmFile: OSM XML file to parse
+        osmFile: OSM XML file to parse (can be compressed or a PBF file, see audit)
+        highlightUnchanged: highlights names that should be fixed, but weren't with a * if True
+        prints: If True, prints every change to be made to the data
+        cache: if True, the audit is skipped when its result is in the audit cache
+
+    Returns:
+        A dictionary of every change to be made to the data to be used in the osmparser module
+    """
+    postal_codes = cached_audit(osmFile, cache, prints)
+    return build_changes(postal_codes, highlightUnchanged, prints)
+
+
+def build_changes(postal_codes, highlightUnchanged=False, prints=False):
+    """
+    Creates the dictionary of changes from an already audited postal codes dictionary
+
+    Args:
+        postal_codes: problematic postal codes dictionary, as returned by audit
         highlightUnchanged: highlights names that should be fixed, but weren't with a * if True
         prints: If True, prints every change to be made to the data
 
     Returns:
         A dictionary of every change to be made to the data to be used in the osmparser module
     """
-    postal_codes = audit(osmFile)
     if prints is True:
         for value, correctValue in postal_codes.items():
             if highlightUnchanged == True and correctValue == 'Invalid Postal Code':
@@ -1,6 +1,8 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
+import auditcache
+import osmparser
+import utils
 import pprint
 
 OSMFILE = "curitiba.osm"
@@ -19,6 +21,8 @@ mapping = { "Av": "Avenida",
             'RUA': 'Rua'
           }
 
+AUDIT_VERSION = 1 # Change it when the audit code changes, so the cached results are discarded
+
 
 def audit_street_type(street_types, street_name):
     """
@@ -39,6 +43,29 @@ def audit_street_type(street_types, street_name):
             street_types[street_type].add(street_name)
 
 
+def audit_street_types(street_names):
+    """
+    Batch version of audit_street_type: audits a set of street names at once, each distinct
+    name is audited only once
+
+    Args:
+        street_names: iterable of street names, can have repeated names
+
+    Returns:
+        street_types: problematic street names dictionary (the same returned by audit)
+    """
+    expectedTypes = set(expected)
+    search = street_type_re.search
+    street_types = defaultdict(set)
+    for street_name in dict.fromkeys(street_names):
+        m = search(street_name)
+        if m:
+            street_type = m.group()
+            if street_type not in expectedTypes:
+                street_types[street_type].add(street_name)
+    return street_types
+
+
 def is_street_name(elem):
     """
     Checks if an element is a street name
@@ -55,24 +82,78 @@ def is_street_name(elem):
 def audit(osmfile):
     """
     Audits a OSM XML file for street names
+    The file is streamed and every element is cleared after being audited, so the memory used
+    doesn't grow with the size of the file, the distinct names are audited at the end
 
     Args:
-        osmfile: OSM XML file path
+        osmfile: OSM XML file path (can be compressed, .gz, .bz2 or .xz, or a PBF file, .pbf)
 
     Returns:
         street_types: problematic street names dictionary
     """
-    osm_file = open(osmfile, "r", encoding='UTF-8')
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    street_names = {} # Distinct names, in the order they're found
+    for elem in osmparser.get_element(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                street_names[tag.attrib['v']] = None
+    return audit_street_types(street_names)
+
+
+def audit_rules():
+    """
+    Returns the rules used by audit, the cached results are discarded when they change
+    (the mapping and the overrides are applied after the audit, see build_changes)
+    """
+    return {'version': AUDIT_VERSION, 'expected': expected,
+            'street_type_re': [street_type_re.pattern, street_type_re.flags]}
+
+
+def cached_audit(osmfile, cache=True, prints=False):
+    """
+    Same as audit, but the result is read from the audit cache if the file and the audit
+    rules didn't change since it was saved (see the auditcache module)
+
+    Args:
+        osmfile: OSM XML file path (can be compressed or a PBF file, see audit)
+        cache: if False, the cache isn't used
+        prints: if True and the audit runs (its result isn't cached), prints its peak memory
+                usage
+
+    Returns:
+        street_types: problematic street names dictionary
+    """
+    street_types = load_audit(osmfile) if cache is True else None
+    if street_types is None:
+        utils.reset_peak_rss() # Measures the peak of this audit, not of the whole process
+        street_types = audit(osmfile)
+        if prints is True:
+            print('Street names audit peak memory usage: {} MB'.format(utils.peak_rss()))
+        if cache is True:
+            save_audit(osmfile, street_types)
     return street_types
 
 
+def load_audit(osmfile):
+    """
+    Reads an audited street names dictionary from the audit cache
+
+    Returns:
+        street_types: problematic street names dictionary, or None if it isn't cached
+    """
+    cached = auditcache.load('streetnames', osmfile, audit_rules())
+    if cached is None:
+        return None
+    return defaultdict(set, {st_type: set(names) for st_type, names in cached.items()})
+
+
+def save_audit(osmfile, street_types):
+    """
+    Saves an audited street names dictionary to the audit cache
+    """
+    auditcache.save('streetnames', osmfile, audit_rules(),
+                    {st_type: sorted(names) for st_type, names in street_types.items()})
+
+
 def update_name(name, mapping):
     """
     Updates a street type to a better one if found in the mapping dictionary,
@@ -86,35 +167,68 @@ def update_name(name, mapping):
         name: updated name
     """
 
-    n = name.split(' ')
-    if n[0] in mapping.keys():
-        n[0] = mapping[n[0]]
-        name = n[0]
-        for word in n[1:]:
-            name = name + ' {}'.format(word)
+    street_type, sep, rest = name.partition(' ') # The street type is the first word
+    if street_type in mapping:
+        name = mapping[street_type] + sep + rest
     return name
 
 
-def execute(osmFile, highlightUnchanged=False, prints=False, overrides={}, specialOverrides={}):
+def update_names(names, mapping):
+    """
+    Batch version of update_name, each distinct name is updated only once
+
+    Args:
+        names: iterable of names, can have repeated names
+        mapping: dictionary to correct most problems found in the data
+
+    Returns:
+        A dictionary, name -> updated name
+    """
+    return {name: update_name(name, mapping) for name in dict.fromkeys(names)}
+
+
+def execute(osmFile, highlightUnchanged=False, prints=False, overrides={}, specialOverrides={},
+            cache=True):
     """
     Main function of this module:
 
     Args:
-        osmFile: OSM XML file to parse
+        osmFile: OSM XML file to parse (can be compressed or a PBF file, see audit)
         highlightUnchanged: highlights names that should be fixed, but weren't with a * if True
         prints: If True, prints every change to be made to the data
         overrides: Dictionary of manual overrides
         specialOverrides: Dictionary of special cases
+        cache: if True, the audit is skipped when its result is in the audit cache
 
     Returns:
         A dictionary of every change to be made to the data to be used in the osmparser module
     """
 
-    st_types = audit(osmFile)
+    st_types = cached_audit(osmFile, cache, prints)
+    return build_changes(st_types, highlightUnchanged, prints, overrides, specialOverrides)
+
+
+def build_changes(st_types, highlightUnchanged=False, prints=False, overrides={},
+                  specialOverrides={}):
+    """
+    Creates the dictionary of changes from an already audited street names dictionary
+
+    Args:
+        st_types: problematic street names dictionary, as returned by audit
+        highlightUnchanged: highlights names that should be fixed, but weren't with a * if True
+        prints: If True, prints every change to be made to the data
+        overrides: Dictionary of manual overrides
+        specialOverrides: Dictionary of special cases
+
+    Returns:
+        A dictionary of every change to be made to the data to be used in the osmparser module
+    """
     changeDict = {}
+    # Tries to update the names automatically
+    updated = update_names((name for ways in st_types.values() for name in ways), mapping)
     for st_type, ways in st_types.items():
         for name in ways:
-            better_name = update_name(name, mapping) # Tries to update the names automatically
+            better_name = updated[name]
             if name in overrides.keys(): # If the name is in the overrides ditionary, use it instead
                 better_name = overrides[name]
             if name not in specialOverrides.keys(): # If the name is not a special case, add if to
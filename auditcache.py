@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the audit results (see the audit_streetnames and audit_postcodes modules)
+
+The audits parse the whole OSM file, but their results only change when the file or the audit
+rules change, so they are saved in CACHE_DIR, keyed by a fingerprint of the file and a hash of
+the rules. The fingerprint is the SHA-1 of the file contents, memoized by path, size and
+modification time, so an unchanged file isn't read again, and a touched (but unchanged) file
+is only hashed, not parsed.
+"""
+
+import hashlib
+import json
+import os
+
+CACHE_DIR = '.audit_cache'
+HASHES_FILE = 'hashes.json' # 'path:size:mtime' -> SHA-1 of the files already hashed
+CHUNK_SIZE = 1 << 20 # Bytes read at a time when hashing a file
+
+
+def read_json(path):
+    """
+    Reads a JSON file, returns None if it doesn't exist or is damaged
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, value):
+    """
+    Writes a JSON file atomically (a temporary file replaces it), creating its directory
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w', encoding='utf-8') as f:
+        json.dump(value, f)
+    os.replace(tmpPath, path)
+
+
+def file_hash(path, cacheDir=CACHE_DIR):
+    """
+    Returns the SHA-1 of the contents of a file, reading it only if its size or modification
+    time changed since it was last hashed
+
+    Args:
+        path: path of the file
+        cacheDir: directory of the cache
+
+    Returns:
+        The hexadecimal SHA-1 of the file
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = '{}:{}:{}'.format(path, stat.st_size, stat.st_mtime_ns)
+    hashesPath = os.path.join(cacheDir, HASHES_FILE)
+    hashes = read_json(hashesPath) or {}
+    if key not in hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+        # Older versions of the same file are forgotten
+        hashes = {k: v for k, v in hashes.items() if k.rsplit(':', 2)[0] != path}
+        hashes[key] = sha.hexdigest()
+        write_json(hashesPath, hashes)
+    return hashes[key]
+
+
+def rules_hash(rules):
+    """
+    Returns the SHA-1 of the rules of an audit
+
+    Args:
+        rules: JSON serializable object (dictionaries, lists, strings and numbers)
+    """
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def entry_path(name, osmPath, cacheDir=CACHE_DIR):
+    """
+    Returns the path of the cache entry of an audit of a file, there's only one entry for
+    each audit and file, so the outdated results don't accumulate
+    """
+    pathHash = hashlib.sha1(os.path.abspath(osmPath).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, '{}-{}.json'.format(name, pathHash[:16]))
+
+
+def load(name, osmPath, rules, cacheDir=CACHE_DIR):
+    """
+    Reads the cached result of an audit
+
+    Args:
+        name: name of the audit, ex: 'streetnames'
+        osmPath: path of the audited OSM file
+        rules: rules used by the audit (see rules_hash)
+        cacheDir: directory of the cache
+
+    Returns:
+        The saved result, or None if there's none for this version of the file and the rules
+    """
+    entry = read_json(entry_path(name, osmPath, cacheDir))
+    if entry is None or entry.get('rules') != rules_hash(rules):
+        return None
+    if entry.get('file') != file_hash(osmPath, cacheDir):
+        return None
+    return entry['result']
+
+
+def save(name, osmPath, rules, result, cacheDir=CACHE_DIR):
+    """
+    Saves the result of an audit
+
+    Args:
+        name: name of the audit, ex: 'streetnames'
+        osmPath: path of the audited OSM file
+        rules: rules used by the audit (see rules_hash)
+        result: JSON serializable result of the audit
+        cacheDir: directory of the cache
+
+    Returns:
+        Nothing
+    """
+    write_json(entry_path(name, osmPath, cacheDir),
+               {'file': file_hash(osmPath, cacheDir), 'rules': rules_hash(rules),
+                'result': result})
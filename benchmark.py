@@ -0,0 +1,90 @@
+"""
+Benchmarks of the parsing process, used to measure the effect of the optimizations
+"""
+
+import os
+import time
+import tempfile
+import tracemalloc
+import osmparser
+import parallelparser
+
+
+def parallel_scaling(osmPath, maxWorkers, prints=True):
+    """
+    Measures the throughput of parallelparser.execute using from 1 to maxWorkers processes
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file to parse
+        maxWorkers: maximum number of processes
+        prints: If True, prints the throughput and speedup of each number of processes
+
+    Returns:
+        A list of (workers, elements per second) tuples
+    """
+    results = []
+    for workers in range(1, maxWorkers + 1):
+        start = time.perf_counter()
+        count = parallelparser.execute(osmPath, workers=workers)
+        elapsed = time.perf_counter() - start
+        results.append((workers, count / elapsed))
+        if prints is True:
+            print('{:>2} workers: {:>10.0f} elements/s, speedup {:.2f}x'.format(
+                workers, count / elapsed, results[-1][1] / results[0][1]))
+    return results
+
+
+def row_paths(osmPath, sample=10000, prints=True):
+    """
+    Compares the dictionary rows path (shape_element and write_csvs) with the tuple rows path
+    (shape_element_rows and write_csv_rows) on the same input
+
+    The throughput is measured writing the whole file to temporary CSVs, the memory is measured
+    with tracemalloc keeping the rows of the first `sample` elements
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file to parse
+        sample: number of elements used to measure the allocations
+        prints: If True, prints the results
+
+    Returns:
+        A dictionary with, for each path ('dict' and 'tuple'): elements per second, allocated
+        blocks per element and allocated bytes per element
+    """
+    paths = {'dict': (osmparser.shape_element, osmparser.write_csvs),
+             'tuple': (osmparser.shape_element_rows, osmparser.write_csv_rows)}
+    transform = osmparser.cleaning_transform({}, {}, {})
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpDir:
+        csvPaths = [os.path.join(tmpDir, os.path.basename(p)) for p in osmparser.CSV_PATHS]
+        for name, (shape, write) in paths.items():
+            start = time.perf_counter()
+            count = write((shape(element, {}, {}, {}, transform=transform)
+                           for element in osmparser.get_element(osmPath, tags=('node', 'way'))),
+                          paths=csvPaths)
+            elapsed = time.perf_counter() - start
+
+            kept = []
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            for element in osmparser.get_element(osmPath, tags=('node', 'way')):
+                kept.append(shape(element, {}, {}, {}, transform=transform))
+                if len(kept) == sample:
+                    break
+            stats = tracemalloc.take_snapshot().compare_to(before, 'filename')
+            tracemalloc.stop()
+            blocks = sum(stat.count_diff for stat in stats)
+            size = sum(stat.size_diff for stat in stats)
+            results[name] = {'elements/s': count / elapsed,
+                             'blocks/element': blocks / len(kept),
+                             'bytes/element': size / len(kept)}
+            if prints is True:
+                print('{:<6} {:>10.0f} elements/s {:>8.1f} blocks/element {:>8.0f} bytes/element'
+                      .format(name, count / elapsed, blocks / len(kept), size / len(kept)))
+    return results
+
+
+if __name__ == '__main__':
+    # If the module is used directly, execute the benchmarks with standard arguments
+    row_paths('curitiba.osm')
+    parallel_scaling('curitiba.osm', 4)
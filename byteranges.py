@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Byte ranges of an uncompressed OSM XML file
+
+A range starts at the beginning of a <node or <way element and is read wrapped in an <osm>
+root element, so it can be parsed on its own. Used by the parallelparser module to split the
+file between processes, and by osmparser.execute_checkpointed to resume a run from the
+offset of a checkpoint
+"""
+
+import os
+import re
+
+ELEMENT_START_RE = re.compile(rb'<(?:node|way)[\s/>]') # Start of a node or way element
+OSM_END = b'</osm>'
+SCAN_SIZE = 1024 * 1024 # Size of the blocks read when searching for a boundary
+
+
+class RangeReader(object):
+    """
+    Read only file-like object over a byte range of an OSM XML file, wrapped in an <osm> root
+    element so it can be parsed on its own
+    """
+
+    def __init__(self, osmPath, start, end):
+        self.osm_file = open(osmPath, 'rb')
+        self.osm_file.seek(start)
+        self.remaining = end - start
+        self.prefix = b'<osm>'
+        self.suffix = b'</osm>'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining + len(self.prefix) + len(self.suffix)
+        data = self.prefix[:size]
+        self.prefix = self.prefix[len(data):]
+        size -= len(data)
+        if size > 0 and self.remaining > 0:
+            chunk = self.osm_file.read(min(size, self.remaining))
+            self.remaining -= len(chunk)
+            if not chunk: # The file is shorter than expected
+                self.remaining = 0
+            data += chunk
+            size -= len(chunk)
+        if size > 0 and self.remaining == 0:
+            end = self.suffix[:size]
+            self.suffix = self.suffix[len(end):]
+            data += end
+        return data
+
+    def close(self):
+        self.osm_file.close()
+
+
+def find_element_start(osm_file, offset, limit):
+    """
+    Finds the position of the first node or way element starting at or after offset
+
+    Args:
+        osm_file: OSM XML file opened in binary mode
+        offset: position where the search starts
+        limit: position where the search stops
+
+    Returns:
+        The position of the element start, or limit if there isn't any
+    """
+    overlap = 16 # Enough to not miss a match split between two blocks
+    while offset < limit:
+        osm_file.seek(offset)
+        block = osm_file.read(min(SCAN_SIZE, limit - offset) + overlap)
+        match = ELEMENT_START_RE.search(block)
+        if match:
+            return min(offset + match.start(), limit)
+        if len(block) <= overlap:
+            break
+        offset += len(block) - overlap
+    return limit
+
+
+def find_end(osm_file, size):
+    """
+    Finds the position of the closing </osm> tag, the end of the last element
+
+    Args:
+        osm_file: OSM XML file opened in binary mode
+        size: size of the file
+
+    Returns:
+        The position of the closing tag, or the size of the file if there isn't any
+    """
+    tail = max(0, size - SCAN_SIZE)
+    osm_file.seek(tail)
+    endPos = osm_file.read().rfind(OSM_END)
+    return tail + endPos if endPos >= 0 else size
+
+
+def find_boundaries(osmPath, chunks):
+    """
+    Splits the OSM XML file in byte ranges, each one starting at a node or way element
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file
+        chunks: number of ranges wanted, the result can have less if the file is too small
+
+    Returns:
+        A list of (start, end) tuples
+    """
+    size = os.path.getsize(osmPath)
+    with open(osmPath, 'rb') as osm_file:
+        end = find_end(osm_file, size)
+        starts = []
+        for i in range(chunks):
+            start = find_element_start(osm_file, size * i // chunks, end)
+            if start < end and (not starts or start > starts[-1]):
+                starts.append(start)
+    return list(zip(starts, starts[1:] + [end]))
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Fast replacement of the cerberus Validator for the rules used in schema.py
+
+The schema is compiled once into plain functions that do only the checks and coercions it
+declares, the error messages and the errors format are the same ones used by cerberus
+Supported rules: type (integer, float, string, dict, list), required, coerce, regex and schema
+"""
+
+import re
+import schema
+
+TYPES = {'integer': int, 'float': float, 'string': str, 'dict': dict, 'list': list}
+RULES = {'type', 'required', 'coerce', 'regex', 'schema'} # Rules compiled by compile_field
+
+
+def compile_field(name, rules, topLevel=False):
+    """
+    Compiles the rules of a field into a function
+
+    Args:
+        name: name of the field, used in the error messages
+        rules: dictionary of rules of the field
+        topLevel: True for the fields of the validated document, cerberus reports their
+                  coercion errors before the other errors (and after them in the sub-documents)
+
+    Returns:
+        A function that receives a value (and optionally the name of the field, used for the
+        items of a list) and returns a list of error messages (empty if the value is valid)
+    """
+    unsupported = set(rules) - RULES
+    if unsupported:
+        raise ValueError('Unsupported rules for field {}: {}'.format(name, sorted(unsupported)))
+    typeName = rules['type']
+    pytype = TYPES[typeName]
+    typeError = 'must be of {} type'.format(typeName)
+    coerce = rules.get('coerce')
+    regex = re.compile(rules['regex']) if 'regex' in rules else None
+    regexError = "value does not match regex '{}'".format(rules.get('regex'))
+
+    if typeName == 'dict' and 'schema' in rules:
+        check_mapping = compile_mapping(rules['schema'])
+
+        def check(value, field=name):
+            if value is None:
+                return ['null value not allowed']
+            if not isinstance(value, dict):
+                return [typeError]
+            errors = check_mapping(value)
+            return [errors] if errors else []
+        return check
+
+    if typeName == 'list' and 'schema' in rules:
+        check_item = compile_field(name, rules['schema'])
+
+        def check(value, field=name):
+            if value is None:
+                return ['null value not allowed']
+            if not isinstance(value, list):
+                return [typeError]
+            errors = {}
+            for index, item in enumerate(value):
+                itemErrors = check_item(item, index)
+                if itemErrors:
+                    errors[index] = itemErrors
+            return [errors] if errors else []
+        return check
+
+    def check(value, field=name):
+        errors = []
+        if coerce is not None:
+            try:
+                coerced = coerce(value)
+            except Exception as e:
+                coerceError = "field '{}' cannot be coerced: {}".format(field, e)
+                if value is None:
+                    errors.append('null value not allowed')
+                elif not isinstance(value, pytype):
+                    errors.append(typeError)
+                if topLevel is True:
+                    errors.insert(0, coerceError)
+                else:
+                    errors.append(coerceError)
+                return errors
+            value = coerced
+        if value is None:
+            return ['null value not allowed']
+        if not isinstance(value, pytype):
+            errors.append(typeError)
+        elif regex is not None and isinstance(value, str) and not regex.fullmatch(value):
+            errors.append(regexError)
+        return errors
+    return check
+
+
+def compile_mapping(mappingSchema, topLevel=False):
+    """
+    Compiles a mapping schema (field: rules) into a function
+
+    Args:
+        mappingSchema: dictionary of field names and their rules
+        topLevel: True if the mapping is the validated document (see compile_field)
+
+    Returns:
+        A function that receives a dictionary and returns a dictionary of errors, in the same
+        format as cerberus Validator.errors (empty if the dictionary is valid)
+    """
+    checks = [(field, rules.get('required', False), compile_field(field, rules, topLevel))
+              for field, rules in mappingSchema.items()]
+    known = set(mappingSchema)
+
+    def check(document):
+        errors = {}
+        for field, required, check_field in checks:
+            if field in document:
+                fieldErrors = check_field(document[field])
+                if fieldErrors:
+                    errors[field] = fieldErrors
+            elif required:
+                errors[field] = ['required field']
+        if len(document) > len(known) or not known.issuperset(document):
+            for field in document:
+                if field not in known:
+                    errors[field] = ['unknown field']
+        return {field: errors[field] for field in sorted(errors, key=str)}
+    return check
+
+
+class Validator(object):
+    """
+    Validator with the same interface used from cerberus.Validator: validate() and errors
+    The compiled schemas are cached, so they're compiled only once
+    """
+
+    def __init__(self, schema=schema.schema):
+        self.schema = schema
+        self.errors = {}
+        self.compiled = {}
+
+    def compiled_schema(self, schema):
+        """
+        Returns the compiled function of a schema, compiling it if necessary
+        """
+        key = id(schema)
+        if key not in self.compiled:
+            # Keeps a reference to the schema so the id is unique
+            self.compiled[key] = (schema, compile_mapping(schema, topLevel=True))
+        return self.compiled[key][1]
+
+    def validate(self, document, schema=None):
+        """
+        Validates a document
+
+        Args:
+            document: dictionary to validate
+            schema: schema to validate, defaults to the one given to the constructor
+
+        Returns:
+            True if the document is valid, False if not (the errors are stored in self.errors)
+        """
+        check = self.compiled_schema(self.schema if schema is None else schema)
+        self.errors = check(document)
+        return not self.errors
+
+    def validate_batch(self, documents, schema=None):
+        """
+        Validates a batch of documents
+
+        Args:
+            documents: iterable of dictionaries to validate
+            schema: schema to validate, defaults to the one given to the constructor
+
+        Returns:
+            A list of (index, errors) tuples of the invalid documents, empty if all are valid
+        """
+        check = self.compiled_schema(self.schema if schema is None else schema)
+        invalid = []
+        for index, document in enumerate(documents):
+            errors = check(document)
+            if errors:
+                invalid.append((index, errors))
+        return invalid
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass version of the cleaning process done in main.py
+
+Instead of parsing the OSM XML file three times (street names audit, postal codes audit and
+the CSV creation), the file is parsed only once: the audit dictionaries are collected while the
+elements are shaped, and the shaped elements are spooled to a temporary file.
+The fixes are then applied over the spooled elements only, not over the XML.
+When the results of both audits are in the audit cache (see the auditcache module), the
+elements aren't spooled, the CSV files are written directly by osmparser.execute.
+"""
+
+import pickle
+import tempfile
+import osmparser
+import loadstats
+import audit_streetnames
+import audit_postcodes
+
+
+def spool_elements(osmPath, spool, street_names, postcodes):
+    """
+    Parses the OSM XML file once, collecting the distinct street names and postal codes (to be
+    audited at the end) and spooling the shaped (still dirty) elements
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file to parse
+        spool: binary file object where the shaped elements are pickled
+        street_names: dictionary used as an ordered set of the street names, filled in place
+        postcodes: dictionary used as an ordered set of the postal codes, filled in place
+
+    Returns:
+        The number of spooled elements
+    """
+    count = 0
+    transform = osmparser.cleaning_transform({}, {}, {}) # Shapes without cleaning
+    for element in osmparser.get_element(osmPath, tags=('node', 'way')):
+        for tag in element.iter('tag'):
+            if audit_streetnames.is_street_name(tag):
+                street_names[tag.attrib['v']] = None
+            if audit_postcodes.is_postcode(tag):
+                postcodes[tag.attrib['v']] = None
+        el = osmparser.shape_element(element, fixedStreetNames={}, specialStreetOverrides={},
+                                     fixedPostcodes={}, transform=transform)
+        pickle.dump(el, spool, pickle.HIGHEST_PROTOCOL)
+        count += 1
+    return count
+
+
+def unspool_elements(spool, count, fixedStreetNames, specialStreetOverrides, fixedPostcodes):
+    """
+    Yields the spooled elements with their tags cleaned
+
+    Args:
+        spool: binary file object where the shaped elements were pickled
+        count: number of spooled elements
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+
+    Yields:
+        el: cleaned element, in the same format as osmparser.shape_element
+    """
+    transform = osmparser.cleaning_transform(fixedStreetNames, specialStreetOverrides,
+                                             fixedPostcodes)
+    spool.seek(0)
+    for _ in range(count):
+        el = pickle.load(spool)
+        tagsKey = 'node_tags' if 'node' in el else 'way_tags'
+        el[tagsKey] = osmparser.clean_tags(el[tagsKey], fixedStreetNames,
+                                           specialStreetOverrides, fixedPostcodes,
+                                           transform=transform)
+        yield el
+
+
+def execute(osmPath, validate=False, highlightUnchanged=False, prints=False,
+            streetOverrides={}, specialStreetOverrides={}, validateEvery=1, cache=True):
+    """
+    Main function of this module:
+    Audits the street names and postal codes and writes the cleaned CSV files with a single
+    pass over the OSM XML file
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file to parse
+        validate: if True, validate the elements against the schema
+        highlightUnchanged: highlights values that should be fixed, but weren't with a * if True
+        prints: If True, prints every change to be made to the data
+        streetOverrides: Dictionary of manual street name overrides
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        validateEvery: validates only every Nth element (sampling), 1 validates all of them
+        cache: if True, the audit results are read from (and saved to) the audit cache
+
+    Returns:
+        fixedStreetNames, fixedPostcodes: the change dictionaries, the same ones returned by
+        audit_streetnames.execute and audit_postcodes.execute
+        Writes the same 5 csv files as osmparser.execute, and the statistics file
+    """
+    if validateEvery < 1:
+        raise ValueError('validateEvery must be 1 or more')
+    street_types = postal_codes = None
+    if cache is True:
+        street_types = audit_streetnames.load_audit(osmPath)
+        postal_codes = audit_postcodes.load_audit(osmPath)
+    if street_types is not None and postal_codes is not None:
+        # Both audits are cached, the elements are shaped already cleaned, without the spool
+        fixedStreetNames = audit_streetnames.build_changes(street_types, highlightUnchanged,
+                                                           prints, overrides=streetOverrides,
+                                                           specialOverrides=specialStreetOverrides)
+        fixedPostcodes = audit_postcodes.build_changes(postal_codes, highlightUnchanged, prints)
+        osmparser.execute(osmPath, validate, fixedStreetNames, specialStreetOverrides,
+                          fixedPostcodes, validateEvery)
+        return fixedStreetNames, fixedPostcodes
+
+    street_names = {}
+    postcodes = {}
+    with tempfile.TemporaryFile() as spool:
+        count = spool_elements(osmPath, spool, street_names, postcodes)
+        street_types = audit_streetnames.audit_street_types(street_names)
+        postal_codes = audit_postcodes.audit_postcodes(postcodes)
+        if cache is True:
+            audit_streetnames.save_audit(osmPath, street_types)
+            audit_postcodes.save_audit(osmPath, postal_codes)
+
+        fixedStreetNames = audit_streetnames.build_changes(street_types, highlightUnchanged,
+                                                           prints, overrides=streetOverrides,
+                                                           specialOverrides=specialStreetOverrides)
+        fixedPostcodes = audit_postcodes.build_changes(postal_codes, highlightUnchanged, prints)
+
+        stats = loadstats.LoadStats()
+        osmparser.write_csvs(unspool_elements(spool, count, fixedStreetNames,
+                                              specialStreetOverrides, fixedPostcodes),
+                             validate, validateEvery=validateEvery, stats=stats)
+        stats.save(osmparser.STATS_PATH)
+    return fixedStreetNames, fixedPostcodes
+
+
+if __name__ == '__main__':
+    # If the module is used directly, execute the main function with the override dictionaries
+    from overrides import streetOverrides, specialStreetOverrides
+    execute('curitiba.osm', False, True, True, streetOverrides=streetOverrides,
+            specialStreetOverrides=specialStreetOverrides)
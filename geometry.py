@@ -0,0 +1,115 @@
+"""
+Geometry functions used to compute the length and the bounding box of the ways
+"""
+
+import math
+from array import array
+import sys
+import numpy as np
+
+FIXED_POINT = 10000000 # Coordinates are stored as integers of 1e-7 degrees (like the OSM database)
+EARTH_RADIUS = 6371008.8 # Mean earth radius, in meters
+
+
+def to_fixed(degrees):
+    """
+    Converts a coordinate in degrees to fixed point
+
+    Args:
+        degrees: coordinate, float or string
+
+    Returns:
+        The coordinate as an integer of 1e-7 degrees
+    """
+    return int(round(float(degrees) * FIXED_POINT))
+
+
+def to_degrees(fixed):
+    """
+    Converts a fixed point coordinate back to degrees
+    """
+    return fixed / FIXED_POINT
+
+
+def encode_coords(coords):
+    """
+    Packs the coordinates of a way in a compact binary blob: little endian int32
+    (lat, lon) pairs, in fixed point (1e-7 degrees)
+
+    Args:
+        coords: list of (lat, lon) tuples, in degrees
+
+    Returns:
+        bytes, 8 per coordinate
+    """
+    packed = array('i', [to_fixed(value) for coord in coords for value in coord])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def decode_coords(blob):
+    """
+    Decodes a blob created by encode_coords without copying it
+
+    Args:
+        blob: bytes created by encode_coords
+
+    Returns:
+        A read only NumPy int32 array of shape (n, 2), with the fixed point (lat, lon) pairs
+        (divide by FIXED_POINT to get degrees, or use decode_coords_degrees)
+    """
+    return np.frombuffer(blob, dtype='<i4').reshape(-1, 2)
+
+
+def decode_coords_degrees(blob):
+    """
+    Decodes a blob created by encode_coords into degrees
+
+    Args:
+        blob: bytes created by encode_coords
+
+    Returns:
+        A NumPy float64 array of shape (n, 2), with the (lat, lon) pairs in degrees
+    """
+    return decode_coords(blob) / FIXED_POINT
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Distance between two points over the earth surface
+
+    Args:
+        lat1, lon1: coordinates of the first point, in degrees
+        lat2, lon2: coordinates of the second point, in degrees
+
+    Returns:
+        The distance in meters
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dPhi = phi2 - phi1
+    dLambda = math.radians(lon2 - lon1)
+    a = math.sin(dPhi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dLambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def way_geometry(coords):
+    """
+    Computes the length and the bounding box of a way
+
+    Args:
+        coords: list of (lat, lon) tuples, in degrees, in the order of the way
+
+    Returns:
+        A (length, minLat, minLon, maxLat, maxLon) tuple, the length is in meters
+        The bounding box is None if the list is empty
+    """
+    if not coords:
+        return 0.0, None, None, None, None
+    length = 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(coords, coords[1:]):
+        length += haversine(lat1, lon1, lat2, lon2)
+    lats = [lat for lat, lon in coords]
+    lons = [lon for lat, lon in coords]
+    return length, min(lats), min(lons), max(lats), max(lons)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Summary statistics of the loaded data, accumulated while the elements are shaped and saved in
+small tables, so the report queries (counts by element type, by user, by tag key and value,
+extent of the dataset) don't need to scan the nodes, ways and tags tables
+
+Tables:
+    - stats_types: number of elements of each type
+    - stats_users: number of nodes and ways of each user
+    - stats_keys: number of tags of each key, by element and tag type
+    - stats_tags: number of tags of each key and value, by element and tag type
+    - stats_bbox: bounding box of the nodes
+"""
+
+import collections
+import json
+import os
+
+STATS_TABLES = ['stats_types', 'stats_users', 'stats_keys', 'stats_tags', 'stats_bbox']
+STATS_SCHEMA = [
+    'CREATE TABLE stats_types (type TEXT PRIMARY KEY NOT NULL, count INTEGER)',
+    '''CREATE TABLE stats_users (uid INTEGER, user TEXT, nodes INTEGER, ways INTEGER,
+                                 PRIMARY KEY (uid, user))''',
+    '''CREATE TABLE stats_keys (element TEXT, type TEXT, key TEXT, count INTEGER,
+                                PRIMARY KEY (key, type, element))''',
+    '''CREATE TABLE stats_tags (element TEXT, type TEXT, key TEXT, value TEXT, count INTEGER,
+                                PRIMARY KEY (key, value, type, element))''',
+    'CREATE INDEX stats_tags_value ON stats_tags (value)',
+    'CREATE TABLE stats_bbox (min_lat REAL, min_lon REAL, max_lat REAL, max_lon REAL)']
+
+# Used to compute the statistics of a database that was loaded without them (or changed)
+STATS_QUERIES = {
+    'stats_types': '''SELECT 'node', COUNT(*) FROM nodes UNION ALL
+                      SELECT 'way', COUNT(*) FROM ways''',
+    'stats_users': '''SELECT uid, user, SUM(tp = 'node'), SUM(tp = 'way') FROM
+                      (SELECT uid, user, 'node' tp FROM nodes UNION ALL
+                       SELECT uid, user, 'way' tp FROM ways)
+                      GROUP BY uid, user''',
+    'stats_tags': '''SELECT 'node', type, key, value, COUNT(*) FROM nodes_tags
+                     GROUP BY type, key, value UNION ALL
+                     SELECT 'way', type, key, value, COUNT(*) FROM ways_tags
+                     GROUP BY type, key, value''',
+    'stats_bbox': 'SELECT MIN(lat), MIN(lon), MAX(lat), MAX(lon) FROM nodes'}
+
+
+class LoadStats(object):
+    """
+    Streaming counters of the statistics, updated with each shaped element
+    """
+
+    def __init__(self):
+        self.types = collections.Counter()
+        self.users = collections.Counter() # (uid, user, element type) -> count
+        self.tags = collections.Counter() # (element type, tag type, key, value) -> count
+        self.bbox = None # [min lat, min lon, max lat, max lon]
+        self.removedBbox = None # Bounding box of the nodes subtracted by remove_rows
+
+    def add_rows(self, tag, row, tags):
+        """
+        Adds an element in the tuple form
+
+        Args:
+            tag: element type, 'node' or 'way'
+            row: node or way tuple, in the osmparser NODE_FIELDS or WAY_FIELDS order (only the
+                 first fields, up to uid, are used)
+            tags: list of tag tuples (id, key, value, type)
+
+        Returns:
+            Nothing
+        """
+        self.types[tag] += 1
+        if tag == 'node':
+            id_, lat, lon, user, uid = row[:5]
+            lat, lon = float(lat), float(lon)
+            if self.bbox is None:
+                self.bbox = [lat, lon, lat, lon]
+            else:
+                bbox = self.bbox
+                if lat < bbox[0]:
+                    bbox[0] = lat
+                elif lat > bbox[2]:
+                    bbox[2] = lat
+                if lon < bbox[1]:
+                    bbox[1] = lon
+                elif lon > bbox[3]:
+                    bbox[3] = lon
+        else:
+            user, uid = row[1:3]
+        self.users[int(uid), user, tag] += 1
+        for id_, key, value, tp in tags:
+            self.tags[tag, tp, key, value] += 1
+
+    def remove_rows(self, tag, row, tags):
+        """
+        Subtracts an element in the tuple form (see add_rows), used to keep the statistics of a
+        changed database (see apply_changes)
+        A bounding box can't be shrunk by subtraction, the removed nodes are kept in
+        removedBbox instead
+        """
+        self.types[tag] -= 1
+        if tag == 'node':
+            id_, lat, lon, user, uid = row[:5]
+            if lat is not None and lon is not None:
+                lat, lon = float(lat), float(lon)
+                bbox = self.removedBbox
+                if bbox is None:
+                    self.removedBbox = [lat, lon, lat, lon]
+                else:
+                    bbox[:] = [min(bbox[0], lat), min(bbox[1], lon),
+                               max(bbox[2], lat), max(bbox[3], lon)]
+        else:
+            user, uid = row[1:3]
+        self.users[int(uid), user, tag] -= 1
+        for id_, key, value, tp in tags:
+            self.tags[tag, tp, key, value] -= 1
+
+    def add_element(self, el):
+        """
+        Adds an element in the dictionary form (as returned by osmparser.shape_element)
+        """
+        if 'node' in el:
+            node = el['node']
+            self.add_rows('node', (node['id'], node['lat'], node['lon'], node['user'],
+                                   node['uid']),
+                          [(t['id'], t['key'], t['value'], t['type']) for t in el['node_tags']])
+        elif 'way' in el:
+            way = el['way']
+            self.add_rows('way', (way['id'], way['user'], way['uid']),
+                          [(t['id'], t['key'], t['value'], t['type']) for t in el['way_tags']])
+
+    def table_rows(self):
+        """
+        Returns the rows of each statistics table
+
+        Returns:
+            A dictionary, table name -> list of row tuples
+        """
+        users = {}
+        for (uid, user, tag), count in self.users.items():
+            counts = users.setdefault((uid, user), [0, 0])
+            counts[tag == 'way'] += count
+        keys = collections.Counter()
+        for (element, tp, key, value), count in self.tags.items():
+            keys[element, tp, key] += count
+        return {'stats_types': sorted(self.types.items()),
+                'stats_users': sorted(k + tuple(v) for k, v in users.items()),
+                'stats_keys': sorted(k + (v,) for k, v in keys.items()),
+                'stats_tags': sorted(k + (v,) for k, v in self.tags.items()),
+                'stats_bbox': [tuple(self.bbox)] if self.bbox is not None else []}
+
+    def save(self, path):
+        """
+        Saves the statistics to a JSON file, used to keep them with the CSV files
+        """
+        with open(path, 'w') as f:
+            json.dump(self.table_rows(), f)
+
+
+def create_tables(conn):
+    """
+    Creates the statistics tables, dropping them first if they already exist
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        Nothing
+    """
+    for table in STATS_TABLES:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+    for sqlCommand in STATS_SCHEMA:
+        conn.execute(sqlCommand)
+
+
+def write_tables(conn, tableRows):
+    """
+    Creates the statistics tables and inserts their rows, without committing
+
+    Args:
+        conn: sqlite3 Connection object
+        tableRows: dictionary, table name -> list of row tuples (see LoadStats.table_rows)
+
+    Returns:
+        Nothing
+    """
+    create_tables(conn)
+    for table, rows in tableRows.items():
+        if rows:
+            conn.executemany('INSERT INTO {} VALUES ({})'.format(
+                table, ', '.join('?' * len(rows[0]))), rows)
+
+
+def load_file(conn, path, csvPath=None):
+    """
+    Creates the statistics tables from a file saved by LoadStats.save, without committing
+
+    Args:
+        conn: sqlite3 Connection object
+        path: path of the JSON file
+        csvPath: if given, the file is ignored if it's older than this CSV file (the
+                 statistics were saved with other CSV files)
+
+    Returns:
+        True if the file was loaded, False if it doesn't exist or is outdated
+    """
+    if not os.path.exists(path) or (csvPath is not None and os.path.exists(csvPath) and
+                                    os.path.getmtime(path) < os.path.getmtime(csvPath)):
+        return False
+    with open(path) as f:
+        tableRows = json.load(f)
+    write_tables(conn, {table: [tuple(row) for row in rows] for table, rows in tableRows.items()})
+    return True
+
+
+def compute(conn):
+    """
+    Creates the statistics tables from the data tables, used when they weren't accumulated
+    during the load, or after the data changes (see the osmchange module), without committing
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        Nothing
+    """
+    tableRows = {table: conn.execute(query).fetchall() for table, query in STATS_QUERIES.items()}
+    if tableRows['stats_bbox'][0][0] is None:
+        tableRows['stats_bbox'] = []
+    keys = collections.Counter()
+    for element, tp, key, value, count in tableRows['stats_tags']:
+        keys[element, tp, key] += count
+    tableRows['stats_keys'] = [k + (v,) for k, v in keys.items()]
+    write_tables(conn, tableRows)
+
+
+def add_counts(conn, table, keyFields, key, countFields, counts):
+    """
+    Adds counts to a row of a statistics table, inserting the row if it doesn't exist
+    """
+    cursor = conn.execute('UPDATE {} SET {} WHERE {}'.format(
+        table, ', '.join('{0} = {0} + ?'.format(field) for field in countFields),
+        ' AND '.join('{} IS ?'.format(field) for field in keyFields)), tuple(counts) + key)
+    if cursor.rowcount == 0:
+        conn.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(keyFields + countFields),
+            ', '.join('?' * (len(keyFields) + len(countFields)))), key + tuple(counts))
+
+
+def apply_changes(conn, delta):
+    """
+    Updates the statistics tables with the counts of the changed elements, without committing
+    The cost depends on the size of the change, not on the size of the database (the bounding
+    box is only computed again when a node on its border was removed or moved)
+
+    Args:
+        conn: sqlite3 Connection object
+        delta: LoadStats object, with the old rows of the changed and deleted elements
+               subtracted (remove_rows) and the new rows added (add_rows)
+
+    Returns:
+        Nothing
+    """
+    for tag, count in delta.types.items():
+        if count:
+            add_counts(conn, 'stats_types', ['type'], (tag,), ['count'], (count,))
+    users = {}
+    for (uid, user, tag), count in delta.users.items():
+        users.setdefault((uid, user), [0, 0])[tag == 'way'] += count
+    for key, counts in users.items():
+        if any(counts):
+            add_counts(conn, 'stats_users', ['uid', 'user'], key, ['nodes', 'ways'], counts)
+    keys = collections.Counter()
+    for (element, tp, key, value), count in delta.tags.items():
+        keys[element, tp, key] += count
+        if count:
+            add_counts(conn, 'stats_tags', ['element', 'type', 'key', 'value'],
+                       (element, tp, key, value), ['count'], (count,))
+    for key, count in keys.items():
+        if count:
+            add_counts(conn, 'stats_keys', ['element', 'type', 'key'], key, ['count'], (count,))
+    # The rows that reached zero aren't returned by the STATS_QUERIES, they're removed
+    conn.execute('DELETE FROM stats_users WHERE nodes = 0 AND ways = 0')
+    conn.execute('DELETE FROM stats_tags WHERE count = 0')
+    conn.execute('DELETE FROM stats_keys WHERE count = 0')
+
+    current = conn.execute('SELECT * FROM stats_bbox').fetchone()
+    removed = delta.removedBbox
+    if removed is not None and (current is None or removed[0] <= current[0] or
+                                removed[1] <= current[1] or removed[2] >= current[2] or
+                                removed[3] >= current[3]):
+        bbox = conn.execute(STATS_QUERIES['stats_bbox']).fetchone()
+        bbox = bbox if bbox[0] is not None else None
+    elif delta.bbox is None:
+        return
+    elif current is None:
+        bbox = delta.bbox
+    else:
+        bbox = (min(current[0], delta.bbox[0]), min(current[1], delta.bbox[1]),
+                max(current[2], delta.bbox[2]), max(current[3], delta.bbox[3]))
+    conn.execute('DELETE FROM stats_bbox')
+    if bbox is not None:
+        conn.execute('INSERT INTO stats_bbox VALUES (?, ?, ?, ?)', tuple(bbox))
+
+
+def has_stats(conn):
+    """
+    Checks if a database has the statistics tables
+    """
+    query = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'stats_types'")
+    return query.fetchone()[0] == 1
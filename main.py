@@ -4,31 +4,26 @@ curitiba.osm OpenStreetMap XML file
 It is commented, but further details can be found on the Project.ipynb file
 """
 
-import osmparser
+import fusedparser
 import sqlcreator
-import audit_streetnames
-import audit_postcodes
 # Imports the necessary modules
 
 from overrides import streetOverrides, specialStreetOverrides
 # Imports the override dictionaries
 
-fixedStreetNames = audit_streetnames.execute('curitiba.osm', True, True,
-                                             overrides=streetOverrides,
-                                             specialOverrides=specialStreetOverrides)
-# Creates a dictionary of street names to fix using both the automatic and the override fixes
-# And print the changes
-
-fixedPostcodes = audit_postcodes.execute('curitiba.osm', True, True)
-# Creates a dictionary of postal codes to fix using both the automatic fixes
-# And print the changes
-
-osmparser.execute('curitiba.osm', validate=True, fixedStreetNames=fixedStreetNames,
-                  specialStreetOverrides=specialStreetOverrides,
-                  fixedPostcodes=fixedPostcodes)
+fixedStreetNames, fixedPostcodes = fusedparser.execute('curitiba.osm', validate=True,
+                                                       highlightUnchanged=True, prints=True,
+                                                       streetOverrides=streetOverrides,
+                                                       specialStreetOverrides=specialStreetOverrides)
+# With a single pass over the OSM XML:
+# Creates a dictionary of street names to fix using both the automatic and the override fixes,
+# a dictionary of postal codes to fix using the automatic fixes, and print the changes
 # Using the above mentioned dictionaries and the specialStreetOverrides one, creates a set of
 # CSVs using the OSM XML
-# Obs: set validate to False to not use the schema validation processs (it can take a long time)
+# It gives the same result as calling audit_streetnames.execute, audit_postcodes.execute and
+# osmparser.execute in sequence, as documented in Project.ipynb
+# Obs: set validate to False to not use the schema validation process, or validateEvery to N to
+# validate only every Nth element
 
 sqlcreator.execute('curitiba.db')
 # Creates the SQLite3 database using the cleaned CSVs previously generated
@@ -0,0 +1,173 @@
+"""
+On disk, memory mapped, store of node locations (node id -> (lat, lon))
+
+Used by the osmparser module to compute the geometry of the ways while the file is parsed,
+without keeping all the nodes in a Python dictionary. Two modes are available:
+    - dense: an array indexed by node id, 8 bytes per possible id (the file is sparse on disk on
+             most file systems), fastest, best for extracts with many nodes. The negative ids
+             (new nodes in JOSM files and osmChange creates) can't index the array, they're
+             kept in a dictionary, there are only a few of them
+    - sparse: a sorted list of (id, lat, lon) records, 16 bytes per node, lookups use a binary
+              search, best for small extracts, needs the nodes sorted by id (like in the OSM files)
+"""
+
+import mmap
+import os
+import struct
+import geometry
+
+# The coordinates are stored as unsigned fixed point integers with an offset, so that 0
+# means "no location"
+LAT_OFFSET = 90 * geometry.FIXED_POINT + 1
+LON_OFFSET = 180 * geometry.FIXED_POINT + 1
+
+DENSE_RECORD = struct.Struct('<II') # lat, lon
+SPARSE_RECORD = struct.Struct('<qII') # id, lat, lon
+DENSE_GROWTH = 1 << 20 # Minimum number of ids added when the dense file grows
+SPARSE_BUFFER = 1 << 16 # Number of sparse records buffered before being written to the file
+
+
+class NodeLocationStore(object):
+    """
+    Store of node locations, see the module documentation
+    """
+
+    def __init__(self, path, mode='dense'):
+        """
+        Args:
+            path: file used to store the locations, it's recreated
+            mode: 'dense' or 'sparse'
+        """
+        if mode not in ('dense', 'sparse'):
+            raise ValueError("mode must be 'dense' or 'sparse'")
+        self.path = path
+        self.mode = mode
+        self.file = open(path, 'w+b')
+        self.map = None
+        self.size = 0 # Size of the mapped file
+        self.pending = [] # Sparse records not yet written to the file
+        self.count = 0 # Sparse records written to the file
+        self.lastId = None
+        self.negative = {} # Dense mode: negative id -> (lat, lon) fixed point integers
+
+    def remap(self, size):
+        """
+        Resizes the file and maps it again
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.truncate(size)
+        self.size = size
+        if size > 0:
+            self.map = mmap.mmap(self.file.fileno(), size)
+
+    def set(self, id_, lat, lon):
+        """
+        Stores the location of a node
+
+        Args:
+            id_: node id
+            lat, lon: coordinates in degrees, floats or strings
+
+        Returns:
+            Nothing
+        """
+        id_ = int(id_)
+        lat = geometry.to_fixed(lat) + LAT_OFFSET
+        lon = geometry.to_fixed(lon) + LON_OFFSET
+        if self.mode == 'dense':
+            if id_ < 0: # A negative offset would write from the end of the map
+                self.negative[id_] = (lat, lon)
+                return
+            end = (id_ + 1) * DENSE_RECORD.size
+            if end > self.size:
+                self.remap(max(end, self.size * 2, DENSE_GROWTH * DENSE_RECORD.size))
+            DENSE_RECORD.pack_into(self.map, id_ * DENSE_RECORD.size, lat, lon)
+        else:
+            if self.lastId is not None and id_ <= self.lastId:
+                raise ValueError('The sparse mode needs the nodes sorted by id '
+                                 '({} after {})'.format(id_, self.lastId))
+            self.lastId = id_
+            self.pending.append(SPARSE_RECORD.pack(id_, lat, lon))
+            if len(self.pending) >= SPARSE_BUFFER:
+                self.write_pending()
+
+    def write_pending(self):
+        """
+        Appends the pending sparse records to the file
+        """
+        if self.pending:
+            self.file.seek(self.count * SPARSE_RECORD.size)
+            self.file.write(b''.join(self.pending))
+            self.count += len(self.pending)
+            self.pending = []
+
+    def flush(self):
+        """
+        Writes the pending sparse records to the file and maps it again if it has grown
+        """
+        self.write_pending()
+        if self.size != self.count * SPARSE_RECORD.size:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.flush()
+            self.size = self.count * SPARSE_RECORD.size
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def get(self, id_):
+        """
+        Returns the location of a node
+
+        Args:
+            id_: node id
+
+        Returns:
+            A (lat, lon) tuple in degrees, or None if the node wasn't stored
+        """
+        id_ = int(id_)
+        if self.mode == 'dense':
+            if id_ < 0:
+                if id_ not in self.negative:
+                    return None
+                lat, lon = self.negative[id_]
+            else:
+                offset = id_ * DENSE_RECORD.size
+                if offset + DENSE_RECORD.size > self.size:
+                    return None
+                lat, lon = DENSE_RECORD.unpack_from(self.map, offset)
+        else:
+            self.flush()
+            low, high = 0, self.count
+            while low < high: # Binary search on the ids
+                middle = (low + high) // 2
+                if struct.unpack_from('<q', self.map, middle * SPARSE_RECORD.size)[0] < id_:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low == self.count:
+                return None
+            found, lat, lon = SPARSE_RECORD.unpack_from(self.map, low * SPARSE_RECORD.size)
+            if found != id_:
+                return None
+        if lat == 0:
+            return None
+        return geometry.to_degrees(lat - LAT_OFFSET), geometry.to_degrees(lon - LON_OFFSET)
+
+    def close(self, delete=True):
+        """
+        Closes the store
+
+        Args:
+            delete: if True, the file is deleted
+
+        Returns:
+            Nothing
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+        if delete is True:
+            os.remove(self.path)
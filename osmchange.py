@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Applies OpenStreetMap change files (.osc, osmChange format) to a database created by the
+sqlcreator module, so it can be updated without parsing the whole OSM XML file again
+
+The created and modified elements are shaped and cleaned with the same rules used by the
+osmparser module, and all the changes are applied inside a single transaction
+
+Usage: python osmchange.py curitiba.db changes.osc.gz
+"""
+
+import sys
+import xml.etree.cElementTree as ET
+import sqlite3
+import osmparser
+import audit_streetnames
+import audit_postcodes
+import sqlcreator
+import loadstats
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# Statements that remove every row of an element, by element type
+DELETE_COMMANDS = {'node': ['DELETE FROM nodes_tags WHERE id = ?',
+                            'DELETE FROM nodes WHERE id = ?'],
+                   'way': ['DELETE FROM ways_tags WHERE id = ?',
+                           'DELETE FROM ways_nodes WHERE id = ?',
+                           'DELETE FROM ways WHERE id = ?']}
+
+
+def get_changes(oscPath):
+    """
+    Yields the elements of an osmChange file with the action that should be applied to them
+
+    Args:
+        oscPath: path and/or name of the change file, can be compressed (.gz, .bz2 or .xz)
+
+    Yields:
+        (action, elem) tuples, action is 'create', 'modify' or 'delete'
+    """
+    osc_file = osmparser.open_osm(oscPath)
+    try:
+        context = ET.iterparse(osc_file, events=('start', 'end'))
+        action = None
+        block = None
+        for event, elem in context:
+            if elem.tag in ACTIONS:
+                if event == 'start':
+                    action, block = elem.tag, elem
+                else:
+                    action, block = None, None
+                    elem.clear()
+            elif event == 'end' and elem.tag in ('node', 'way') and action is not None:
+                yield action, elem
+                block.clear() # Only one element is kept in memory at a time
+    finally:
+        osc_file.close()
+
+
+def insert_element(cursor, rows):
+    """
+    Inserts the rows of a shaped element, replacing the element if it already exists
+
+    Args:
+        cursor: sqlite3 Cursor object
+        rows: tuple returned by osmparser.shape_element_rows
+
+    Returns:
+        Nothing
+    """
+    tag, row, tags, way_nodes = rows
+    for sqlCommand in DELETE_COMMANDS[tag]:
+        cursor.execute(sqlCommand, (row[0],))
+    if tag == 'node':
+        cursor.execute('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+        cursor.executemany('INSERT INTO nodes_tags VALUES (?, ?, ?, ?)', tags)
+    else:
+        cursor.execute('INSERT INTO ways VALUES (?, ?, ?, ?, ?, ?)', row)
+        cursor.executemany('INSERT INTO ways_nodes VALUES (?, ?, ?)', way_nodes)
+        cursor.executemany('INSERT INTO ways_tags VALUES (?, ?, ?, ?)', tags)
+
+
+def element_rows(cursor, tag, id_):
+    """
+    Reads the stored rows of an element, used to subtract them from the statistics
+
+    Args:
+        cursor: sqlite3 Cursor object
+        tag: element type, 'node' or 'way'
+        id_: id of the element
+
+    Returns:
+        (row, tags) tuple in the format used by loadstats.LoadStats.add_rows, or None if the
+        element isn't stored
+    """
+    if tag == 'node':
+        row = cursor.execute('SELECT id, lat, lon, user, uid FROM nodes WHERE id = ?',
+                             (id_,)).fetchone()
+    else:
+        row = cursor.execute('SELECT id, user, uid FROM ways WHERE id = ?', (id_,)).fetchone()
+    if row is None:
+        return None
+    tags = cursor.execute('SELECT id, key, value, type FROM {}_tags WHERE id = ?'.format(
+        tag + 's'), (id_,)).fetchall()
+    return row, tags
+
+
+def delete_element(cursor, tag, id_):
+    """
+    Deletes every row of an element
+
+    Args:
+        cursor: sqlite3 Cursor object
+        tag: element type, 'node' or 'way'
+        id_: id of the element
+
+    Returns:
+        Nothing
+    """
+    for sqlCommand in DELETE_COMMANDS[tag]:
+        cursor.execute(sqlCommand, (id_,))
+
+
+def affected_ways(cursor, tag, id_):
+    """
+    Returns the ways whose geometry depends on an element
+
+    Args:
+        cursor: sqlite3 Cursor object
+        tag: element type, 'node' or 'way'
+        id_: id of the element
+
+    Returns:
+        A list of way ids: the way itself, or the ways that use the node
+    """
+    if tag == 'way':
+        return [id_]
+    return [way for (way,) in cursor.execute(
+        'SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?', (id_,)).fetchall()]
+
+
+def update_spatial_index(cursor, tag, id_, ways):
+    """
+    Updates the R*Tree tables after an element was inserted, replaced or deleted
+    When a node changes, the bounding boxes of the ways that use it are updated too
+
+    Args:
+        cursor: sqlite3 Cursor object
+        tag: element type, 'node' or 'way'
+        id_: id of the element
+        ways: ways affected by the change, see affected_ways
+
+    Returns:
+        Nothing
+    """
+    if tag == 'node':
+        cursor.execute('DELETE FROM nodes_rtree WHERE id = ?', (id_,))
+        cursor.execute(sqlcreator.NODE_RTREE_UPDATE, (id_,))
+    for way in ways:
+        cursor.execute('DELETE FROM ways_rtree WHERE id = ?', (way,))
+        cursor.execute(sqlcreator.WAY_RTREE_UPDATE, (way,))
+
+
+def execute(dbname, oscPath, fixedStreetNames={}, specialStreetOverrides={},
+            fixedPostcodes={}):
+    """
+    Main function of this module:
+    Applies an osmChange file to a database, in a single transaction (if anything fails,
+    nothing is changed)
+
+    Args:
+        dbname: a SQLite database name, ex: 'example.db'
+        oscPath: path and/or name of the change file, can be compressed (.gz, .bz2 or .xz)
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+
+    Returns:
+        A dictionary with the number of elements of each action
+    """
+    counts = {action: 0 for action in ACTIONS}
+    conn = sqlite3.Connection(dbname)
+    conn.isolation_level = None # The transaction is handled explicitly
+    spatial = sqlcreator.has_spatial_index(conn)
+    wayGeometry = sqlcreator.has_table(conn, 'way_geometry')
+    stats = loadstats.LoadStats() if loadstats.has_stats(conn) else None # Changed counts
+    transform = osmparser.cleaning_transform(fixedStreetNames, specialStreetOverrides,
+                                             fixedPostcodes)
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        for action, element in get_changes(oscPath):
+            if stats is not None:
+                old = element_rows(cursor, element.tag, element.attrib['id'])
+                if old is not None:
+                    stats.remove_rows(element.tag, *old)
+            if action == 'delete':
+                delete_element(cursor, element.tag, element.attrib['id'])
+            else:
+                rows = osmparser.shape_element_rows(element, fixedStreetNames,
+                                                    specialStreetOverrides, fixedPostcodes,
+                                                    transform=transform)
+                insert_element(cursor, rows)
+                if stats is not None:
+                    stats.add_rows(*rows[:3])
+            if spatial or wayGeometry:
+                ways = affected_ways(cursor, element.tag, element.attrib['id'])
+            if spatial:
+                update_spatial_index(cursor, element.tag, element.attrib['id'], ways)
+            if wayGeometry:
+                sqlcreator.build_way_geometry(conn, ways)
+            counts[action] += 1
+        if stats is not None:
+            loadstats.apply_changes(conn, stats) # Only the changed counts are updated
+        sqlcreator.bump_generation(conn)
+        cursor.execute('COMMIT')
+    except:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return counts
+
+
+if __name__ == '__main__':
+    # If the module is used directly, audits the change file and applies it to the database,
+    # using the override dictionaries, like main.py does with the complete OSM XML file
+    from overrides import streetOverrides, specialStreetOverrides
+    dbname, oscPath = sys.argv[1:3] if len(sys.argv) > 2 else ('curitiba.db', 'changes.osc')
+    fixedStreetNames = audit_streetnames.execute(oscPath, overrides=streetOverrides,
+                                                 specialOverrides=specialStreetOverrides)
+    fixedPostcodes = audit_postcodes.execute(oscPath)
+    print(execute(dbname, oscPath, fixedStreetNames, specialStreetOverrides, fixedPostcodes))
@@ -1,29 +1,57 @@
 # -*- coding: utf-8 -*-
 
 import xml.etree.cElementTree as ET
+import bz2
 import codecs
+import collections
+import gzip
+import itertools
+import json
+import lzma
+import os
 import re
 import pprint
 import unicodecsv as csv # Uses unicodecsv module to handle encoding
 import schema
-import cerberus
+import fastvalidator
+import geometry
+import loadstats
+import byteranges
+import nodestore
+import pbfparser
+import tagtransform
 
 NODES_PATH = "nodes.csv"
 NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+CSV_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
+WAY_GEOMETRY_PATH = "ways_geometry.csv" # Only written if the node locations are stored
+STATS_PATH = "load_stats.json" # Statistics of the CSV files, see the loadstats module
+LOCATIONS_PATH = "nodes.locations" # File of the node locations store
+CHECKPOINT_PATH = "osmparser.checkpoint" # Last checkpoint of a run, removed when it finishes
+CHECKPOINT_MARGIN = 1 << 20 # Bytes before the input position searched for the last element
+VALIDATE_BATCH_SIZE = 1000 # Elements read by the writers before their batch is validated
 
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 SCHEMA = schema.schema
 
+# Last transform built by cleaning_transform, with its key and the dictionaries it was built from
+_cleaning = {}
+
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
 NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+# coords is the hexadecimal of the packed coordinates (see geometry.encode_coords)
+WAY_GEOMETRY_FIELDS = ['id', 'length', 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'coords']
+
+# Functions used to open the compressed OSM XML files, by extension
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
 
 def validate_element(element, validator, schema=SCHEMA):
     """
@@ -31,7 +59,7 @@ def validate_element(element, validator, schema=SCHEMA):
 
         Args:
             element: element to validade
-            validator: cerberus Validator object
+            validator: Validator object (fastvalidator or cerberus)
             schema: schema to validate
 
        Returns:
@@ -39,29 +67,105 @@ def validate_element(element, validator, schema=SCHEMA):
     
     """
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
-        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_string = pprint.pformat(errors)
-        raise Exception(message_string.format(field, error_string))
+        raise_validation_error(validator.errors)
+
+def validate_elements(elements, validator, schema=SCHEMA):
+    """
+    Raise ValidationError if any element of a batch does not match schema, the whole batch is
+    validated with a single call (see fastvalidator.Validator.validate_batch)
+
+        Args:
+            elements: list of elements to validate
+            validator: fastvalidator.Validator object
+            schema: schema to validate
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+       Returns:
+            Nothing
+    """
+    invalid = validator.validate_batch(elements, schema)
+    if invalid:
+        index, errors = invalid[0]
+        raise_validation_error(errors)
+
+def raise_validation_error(errors):
+    """
+    Raises the exception of an invalid element, with the errors of its first invalid field
+    """
+    field, errors = next(iter(errors.items()))
+    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+    error_string = pprint.pformat(errors)
+    raise Exception(message_string.format(field, error_string))
+
+def iter_batches(items, size=VALIDATE_BATCH_SIZE):
+    """
+    Splits an iterable in lists of up to size items
+    """
+    items = iter(items)
+    batch = list(itertools.islice(items, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(items, size))
+
+def is_pbf(osmPath):
+    """
+    Checks if a path is an OpenStreetMap PBF file
+
+        Args:
+            osmPath: path and/or name of the file
+
+        Returns:
+            True if the file has the .pbf extension
+    """
+    return isinstance(osmPath, str) and osmPath.lower().endswith('.pbf')
+
+def open_osm(osmPath):
+    """
+    Opens an OSM XML file for reading, decompressing it on the fly (while streaming) if it has
+    the .gz, .bz2 or .xz extension
+
+        Args:
+            osmPath: path and/or name of the file
+
+        Returns:
+            A binary file object
+    """
+    for extension, opener in OPENERS.items():
+        if osmPath.lower().endswith(extension):
+            return opener(osmPath, 'rb')
+    return open(osmPath, 'rb')
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), workers=1):
     """
     Yield element if it is the right type of tag
 
         Args:
-            osm_file: OSM XML file to parse
+            osm_file: OSM XML file to parse, can be compressed (.gz, .bz2 or .xz), a PBF file
+                      (.pbf) or an already opened file object
             tags: elements to search
+            workers: number of processes used to decode the blobs of a PBF file (see
+                     pbfparser.iter_elements), ignored for the XML files
 
         Yields:
             elem: element
     """
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
+    if is_pbf(osm_file):
+        for elem in pbfparser.iter_elements(osm_file, tags, workers):
             yield elem
-            root.clear()
+        return
+
+    opened = isinstance(osm_file, str)
+    if opened:
+        osm_file = open_osm(osm_file)
+    try:
+        context = ET.iterparse(osm_file, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+    finally:
+        if opened:
+            osm_file.close()
 
 def append_tag_dic(tags, id_, k, v, tp):
     """
@@ -83,10 +187,59 @@ def append_tag_dic(tags, id_, k, v, tp):
            'type': tp}
     tags.append(dic)
 
+def append_tag_tuple(tags, id_, k, v, tp):
+    """
+    Create a tuple of the tag data, in the NODE_TAGS_FIELDS/WAY_TAGS_FIELDS order, and append
+    it to the 'tags' list
+
+        Args:
+            tags: Tags list
+            id_: id of parent element
+            k: key
+            v: value
+            tp: type
+
+        Returns:
+            Nothing
+    """
+    tags.append((id_, k, v, tp))
+
+def cleaning_transform(fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                       problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """
+    Compiles the cleaning dictionaries in a TagTransform (see the tagtransform module), built
+    once for a run and given to the shape functions as their transform argument
+    The last transform is memoized by the ids and sizes of the dictionaries, so the shape
+    functions called without a transform don't compile it again for every element (the
+    dictionaries are kept referenced, so their ids aren't reused while they're memoized)
+    The dictionaries shouldn't be changed while the transform is used
+
+    Args:
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        problem_chars: a regular expression to search for problematic characters
+        default_tag_type: type to be used if no type is specified at the tag
+
+    Returns:
+        A TagTransform object
+    """
+    dictionaries = (fixedStreetNames, specialStreetOverrides, fixedPostcodes)
+    key = (tuple(id(d) for d in dictionaries) + tuple(len(d) for d in dictionaries) +
+           (problem_chars, default_tag_type))
+    if _cleaning.get('key') != key:
+        _cleaning.update(key=key, dictionaries=dictionaries,
+                         transform=tagtransform.build_cleaning_transform(
+                             fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                             problem_chars, default_tag_type))
+    return _cleaning['transform']
+
 def shape_tags(tagElements, id_, tags, problem_chars, default_tag_type,
-               fixedStreetNames, specialStreetOverrides, fixedPostcodes):
+               fixedStreetNames, specialStreetOverrides, fixedPostcodes, append=append_tag_dic,
+               transform=None):
     """
     Shapes the tags to the and appends to the tags dictionary
+    The cleaning rules are compiled in a TagTransform (see cleaning_transform)
 
     Args:
         tagElements: Tag elements
@@ -97,55 +250,118 @@ def shape_tags(tagElements, id_, tags, problem_chars, default_tag_type,
         fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
         specialStreetOverrides: dictionary of special street names that were fixed by hand
         fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        append: function used to append a tag, append_tag_dic or append_tag_tuple
+        transform: TagTransform built by cleaning_transform, reused for every element of a run,
+                   if None the memoized one of the dictionaries is used (see cleaning_transform)
 
     Returns:
         Nothing
     """
-    for item in tagElements:
-        key = item.attrib['k']
-        if problem_chars.search(key):
-            continue # If we have problematics characters, ignore the tag
-        keylist = key.split(':') # Splits the tag if they have a :
-        if len(keylist) > 1:
-            tp = keylist[0] # If we have a :, the type is the first word, before the :
-            if len(keylist[1:]) > 1: # If we have more than 1 :, the ramaining words are
-                                     # treated as a key
-                k = keylist[1]
-                for key in keylist[2:]:
-                    k = k + ':{}'.format(key)
-            else:
-                k = keylist[1]
-        else:
-            k = keylist[0]
-            tp = default_tag_type # If we don't have a :, the type used is the default "regular"
-        v = item.attrib['v']
-        if k == 'street' and tp == 'addr': # If we have a street adress tag
-            if v in fixedStreetNames.keys(): # Checks if the name was fixed using the
-                                             # audit_streetnames module
-                v = fixedStreetNames[v] # Uses the cleaned name
-                append_tag_dic(tags, id_, k, v, tp)
-            elif v in specialStreetOverrides.keys(): # If we have a special override, use it
-                listDics = specialStreetOverrides[v]
-                for dic in listDics:
-                    tags.append(dic)
-            else:
-                append_tag_dic(tags, id_, k, v, tp)
-
-        elif k == 'postal_code' or k == 'postcode': # If we have a postal code tag
-            if v in fixedPostcodes.keys(): # Checks if the name was fixed using the
-                                           # audit_postcodes module
-                v = fixedPostcodes[v] # Uses the cleaned name
-                if v != 'Invalid Postal Code': # Only appends valid postal codes to the dictionary
-                    append_tag_dic(tags, id_, k, v, tp)
-            else:
-                append_tag_dic(tags, id_, k, v, tp)
-        else:
-            append_tag_dic(tags, id_, k, v, tp)
+    if transform is None:
+        transform = cleaning_transform(fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                                       problem_chars, default_tag_type)
+    transform.shape(tagElements, id_, tags, append)
+
+def clean_tag(tags, id_, k, v, tp, fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+              append=append_tag_dic, default_tag_type='regular', transform=None):
+    """
+    Cleans the value of a single tag and appends the result to the tags dictionary
+
+    Args:
+        tags: Tags dictionary
+        id_: id of parent element
+        k: key
+        v: value
+        tp: type
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        append: function used to append a tag, append_tag_dic or append_tag_tuple
+        default_tag_type: type to be used if no type is specified at the tag
+        transform: TagTransform built by cleaning_transform, reused for every element of a run,
+                   if None the memoized one of the dictionaries is used (see cleaning_transform)
 
+    Returns:
+        Nothing
+    """
+    if transform is None:
+        transform = cleaning_transform(fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                                       PROBLEMCHARS, default_tag_type)
+    transform.rewrite(tags, id_, k, v, tp, append)
+
+def clean_tags(tags, fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+               default_tag_type='regular', transform=None):
+    """
+    Cleans a list of already shaped tags, used to fix data that was shaped without the
+    cleaning dictionaries
+
+    Args:
+        tags: list of shaped tag dictionaries
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        default_tag_type: type to be used if no type is specified at the tag
+        transform: TagTransform built by cleaning_transform, reused for every element of a run,
+                   if None the memoized one of the dictionaries is used (see cleaning_transform)
+
+    Returns:
+        A new list of cleaned tag dictionaries
+    """
+    if transform is None:
+        transform = cleaning_transform(fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                                       PROBLEMCHARS, default_tag_type)
+    cleaned = []
+    for tag in tags:
+        clean_tag(cleaned, tag['id'], tag['key'], tag['value'], tag['type'],
+                  fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                  default_tag_type=default_tag_type, transform=transform)
+    return cleaned
+
+
+class Interner(object):
+    """
+    Assigns sequential integer ids to values (strings or tuples) while the data is streamed,
+    used to dictionary encode the repeated strings (users, tag keys and values, see the
+    normalized layout of the sqlcreator module)
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.pending = [] # New (id, value) pairs, not yet taken by take_pending
+
+    def intern(self, value):
+        """
+        Returns the id of a value, assigning a new one if it wasn't seen before
+        """
+        id_ = self.ids.get(value)
+        if id_ is None:
+            id_ = self.ids[value] = len(self.ids) + 1
+            self.pending.append((id_, value))
+        return id_
+
+    def preload(self, pairs):
+        """
+        Adds values that already have ids (ex: read from a database), they aren't pending
+
+        Args:
+            pairs: iterable of (id, value) pairs, the ids must be 1, 2, 3...
+        """
+        for id_, value in pairs:
+            self.ids[value] = id_
+
+    def take_pending(self):
+        """
+        Returns the values added since the last call, as rows: (id,) + value for tuples and
+        (id, value) for the other values
+        """
+        rows = [(id_,) + value if isinstance(value, tuple) else (id_, value)
+                for id_, value in self.pending]
+        self.pending = []
+        return rows
 
 def shape_element(element, fixedStreetNames, specialStreetOverrides, fixedPostcodes,
                   node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular', transform=None):
     """
     Clean and shape node or way XML element to Python dict
     Args:
@@ -157,6 +373,8 @@ def shape_element(element, fixedStreetNames, specialStreetOverrides, fixedPostco
         way_attr_fields: standard way attributes declared before
         problem_chars: a regular expression to search for problematic characters
         default_tag_type: type to be used if no type is specified at the tag
+        transform: TagTransform built by cleaning_transform, reused for every element of a run,
+                   if None the memoized one of the dictionaries is used (see cleaning_transform)
 
     Returns:
         A dictionary specific to the input element
@@ -186,25 +404,121 @@ def shape_element(element, fixedStreetNames, specialStreetOverrides, fixedPostco
             pos += 1
     tagElements = element.iter('tag')
     shape_tags(tagElements, id_, tags, problem_chars, default_tag_type, fixedStreetNames,
-               specialStreetOverrides, fixedPostcodes)
+               specialStreetOverrides, fixedPostcodes, transform=transform)
     if element.tag == 'node':
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
+def shape_element_rows(element, fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                       problem_chars=PROBLEMCHARS, default_tag_type='regular', transform=None):
+    """
+    Same as shape_element, but the rows are tuples in the order of the CSV fields
+    (NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS and WAY_TAGS_FIELDS)
+    instead of dictionaries, it's faster and uses less memory
+
+    Args:
+        element: XML emelement to shape
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        problem_chars: a regular expression to search for problematic characters
+        default_tag_type: type to be used if no type is specified at the tag
+        transform: TagTransform built by cleaning_transform, reused for every element of a run,
+                   if None the memoized one of the dictionaries is used (see cleaning_transform)
+
+    Returns:
+        A tuple (element tag, element row, tags rows, way nodes rows)
+        The way nodes rows are empty for nodes
+    """
+    attr = element.attrib
+    id_ = attr['id']
+    tags = []
+    way_nodes = []
+    if element.tag == 'node':
+        row = (id_, attr['lat'], attr['lon'], attr['user'], attr['uid'], attr['version'],
+               attr['changeset'], attr['timestamp'])
+    else:
+        row = (id_, attr['user'], attr['uid'], attr['version'], attr['changeset'],
+               attr['timestamp'])
+        way_nodes = [(id_, nd.attrib['ref'], pos) for pos, nd in enumerate(element.iter('nd'))]
+    shape_tags(element.iter('tag'), id_, tags, problem_chars, default_tag_type, fixedStreetNames,
+               specialStreetOverrides, fixedPostcodes, append_tag_tuple, transform)
+    return element.tag, row, tags, way_nodes
+
+def rows_to_element(rows):
+    """
+    Converts the tuples returned by shape_element_rows to the dictionary format returned by
+    shape_element
+
+    Args:
+        rows: tuple returned by shape_element_rows
+
+    Returns:
+        A dictionary specific to the element
+    """
+    tag, row, tags, way_nodes = rows
+    tagsList = [dict(zip(NODE_TAGS_FIELDS, t)) for t in tags]
+    if tag == 'node':
+        return {'node': dict(zip(NODE_FIELDS, row)), 'node_tags': tagsList}
+    return {'way': dict(zip(WAY_FIELDS, row)),
+            'way_nodes': [dict(zip(WAY_NODES_FIELDS, wn)) for wn in way_nodes],
+            'way_tags': tagsList}
+
+def shape_way_geometry(way_nodes, nodeStore):
+    """
+    Computes the geometry of a way using the stored node locations
+
+    Args:
+        way_nodes: way nodes rows, as returned by shape_element_rows
+        nodeStore: nodestore.NodeLocationStore with the locations of the nodes already parsed
+
+    Returns:
+        A tuple (coordinates, geometry row), coordinates is a list of (lat, lon) tuples (nodes
+        without a known location are skipped), the row is in the WAY_GEOMETRY_FIELDS order, it's
+        None if no node has a known location (like sqlcreator.build_way_geometry, which joins
+        the ways with the loaded nodes)
+    """
+    coords = []
+    for id_, node_id, position in way_nodes:
+        location = nodeStore.get(node_id)
+        if location is not None:
+            coords.append(location)
+    if not coords:
+        return coords, None
+    return coords, ((way_nodes[0][0],) + geometry.way_geometry(coords) +
+                    (geometry.encode_coords(coords).hex(),))
+
 def execute(osmPath, validate=False, fixedStreetNames={},
-            specialStreetOverrides={}, fixedPostcodes={}):
+            specialStreetOverrides={}, fixedPostcodes={}, validateEvery=1, rowTuples=True,
+            locations=None, checkpointEvery=None, resume=False, workers=1):
     """
     Main function of this module:
     Iteratively process each XML element and write to CSV files
     Args:
-        osmPath: path and/or name of the OpenStreetMap XML file to parse
-        validate: if True, use cerberus to validate the schema (slow)
+        osmPath: path and/or name of the OpenStreetMap XML file to parse, can be compressed
+                 (.gz, .bz2 or .xz) or a PBF file (.pbf)
+        validate: if True, validate the elements against the schema
         fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
         specialStreetOverrides: dictionary of special street names that were fixed by hand
         fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
-
-        -> The last 3 defaults of empty dictionaries so this module can be used to parse dirty data
+        validateEvery: validates only every Nth element (sampling), 1 validates all of them
+        rowTuples: if True, uses the faster tuple rows (shape_element_rows and write_csv_rows),
+                   if False, uses the dictionaries (shape_element and write_csvs)
+        locations: 'dense' or 'sparse' stores the node locations in a memory mapped file
+                   (see the nodestore module) and computes the length and bounding box of the
+                   ways in the same pass, written to ways_geometry.csv (only with rowTuples),
+                   loaded by sqlcreator.execute(wayGeometry=True)
+        The statistics of the data are accumulated in the same pass and written to
+        load_stats.json (see the loadstats module)
+        checkpointEvery: if given, a checkpoint is saved every checkpointEvery elements (only
+                         for uncompressed OSM XML files, with rowTuples and without locations)
+        resume: if True and there's a checkpoint of the same input file, the run continues
+                from it, the CSV files are truncated to the checkpoint and only the rest of
+                the input is parsed
+        workers: number of processes used to decode the blobs of a PBF file
+
+        -> The fixed dictionaries defaults of empty dictionaries so this module can be used to parse dirty data
         -> and to fix it afterwards.
     Returns:
         Nothing
@@ -216,11 +530,183 @@ def execute(osmPath, validate=False, fixedStreetNames={},
             - ways_tags.csv
     """
 
-    with codecs.open(NODES_PATH, 'wb') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'wb') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'wb') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'wb') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'wb') as way_tags_file:
+    if validateEvery < 1:
+        raise ValueError('validateEvery must be 1 or more')
+    if checkpointEvery is not None or resume is True:
+        if rowTuples is not True or locations is not None:
+            raise ValueError('Checkpoints are only supported with rowTuples and without locations')
+        execute_checkpointed(osmPath, validate, fixedStreetNames, specialStreetOverrides,
+                             fixedPostcodes, validateEvery, checkpointEvery, resume)
+        return
+    # The cleaning rules are compiled once for the whole file
+    transform = cleaning_transform(fixedStreetNames, specialStreetOverrides, fixedPostcodes)
+    if rowTuples is True:
+        rows = (shape_element_rows(element, fixedStreetNames, specialStreetOverrides,
+                                   fixedPostcodes, transform=transform)
+                for element in get_element(osmPath, tags=('node', 'way'), workers=workers))
+        nodeStore = None
+        if locations is not None:
+            nodeStore = nodestore.NodeLocationStore(LOCATIONS_PATH, locations)
+        stats = loadstats.LoadStats()
+        try:
+            write_csv_rows(rows, validate, validateEvery=validateEvery, nodeStore=nodeStore,
+                           stats=stats)
+        finally:
+            if nodeStore is not None:
+                nodeStore.close()
+        stats.save(STATS_PATH)
+        return
+    elements = (shape_element(element, fixedStreetNames=fixedStreetNames,
+                              specialStreetOverrides=specialStreetOverrides,
+                              fixedPostcodes=fixedPostcodes, transform=transform)
+                for element in get_element(osmPath, tags=('node', 'way'), workers=workers))
+    stats = loadstats.LoadStats()
+    write_csvs(elements, validate, validateEvery=validateEvery, stats=stats)
+    stats.save(STATS_PATH)
+
+def input_source(osmPath):
+    """
+    Identifies an input file in the checkpoints: path, size and modification time
+    """
+    stat = os.stat(osmPath)
+    return {'path': os.path.abspath(osmPath), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def locate_element(osm_file, tag, id_, offset, margin=CHECKPOINT_MARGIN):
+    """
+    Finds the start of an element in an OSM XML file, searching backwards from a position
+
+    Args:
+        osm_file: OSM XML file opened in binary mode
+        tag: 'node' or 'way'
+        id_: id of the element
+        offset: position of the input file when the element was parsed (the parser reads
+                ahead, so the element starts before it)
+        margin: number of bytes searched before offset
+
+    Returns:
+        The position of the element
+    """
+    start = max(0, offset - margin)
+    osm_file.seek(start)
+    block = osm_file.read(offset - start)
+    pattern = re.compile(r'<{}\s[^>]*\bid=["\']{}["\']'.format(
+        tag, re.escape(str(id_))).encode('utf-8'))
+    matches = list(pattern.finditer(block))
+    if not matches:
+        raise Exception('The element {} {} of the checkpoint was not found, '
+                        'run again without resume'.format(tag, id_))
+    return start + matches[-1].start()
+
+def execute_checkpointed(osmPath, validate=False, fixedStreetNames={}, specialStreetOverrides={},
+                         fixedPostcodes={}, validateEvery=1, checkpointEvery=None, resume=False,
+                         checkpointPath=CHECKPOINT_PATH):
+    """
+    Same as execute with rowTuples, saving checkpoints and resuming from them
+
+    A checkpoint has the last written element, the position of the input file and the sizes
+    of the CSV files after they were flushed, it's written to checkpointPath atomically.
+    To resume, the CSV files are truncated to those sizes, the element is searched before the
+    input position and the parsing continues after it.
+    The statistics file isn't written when a run is resumed (sqlcreator computes them).
+
+    Returns:
+        The number of written elements (including the ones written before the checkpoint)
+    """
+    if is_pbf(osmPath) or osmPath.lower().endswith(tuple(OPENERS)):
+        raise Exception('Checkpoints need an uncompressed OSM XML file')
+    source = input_source(osmPath)
+    checkpoint = None
+    if resume is True and os.path.exists(checkpointPath):
+        with open(checkpointPath) as f:
+            checkpoint = json.load(f)
+        if checkpoint['source'] != source:
+            raise Exception('The checkpoint was saved for another input file, '
+                            'run again without resume')
+
+    with open(osmPath, 'rb') as osm_file:
+        if checkpoint is None:
+            reader = osm_file
+            position = osm_file.tell
+        else:
+            start = locate_element(osm_file, checkpoint['tag'], checkpoint['id'],
+                                   checkpoint['offset'])
+            end = byteranges.find_end(osm_file, source['size'])
+            reader = byteranges.RangeReader(osmPath, start, end)
+            position = reader.osm_file.tell
+            for path, size in zip(CSV_PATHS, checkpoint['sizes']):
+                with open(path, 'r+b') as csvFile:
+                    csvFile.truncate(size)
+        try:
+            elements = get_element(reader, tags=('node', 'way'))
+            if checkpoint is not None:
+                element = next(elements) # The last element of the checkpoint, already written
+                if (element.tag, element.attrib['id']) != (checkpoint['tag'], checkpoint['id']):
+                    raise Exception('The checkpoint does not match the input file')
+
+            # Input position after each element was parsed, by element number: the writer
+            # reads a whole batch before writing it, the position at the checkpoint is ahead
+            positions = collections.deque()
+
+            def save(count, el, sizes):
+                while positions[0][0] < count:
+                    positions.popleft()
+                data = {'source': source, 'count': count, 'tag': el[0], 'id': el[1][0],
+                        'offset': positions[0][1], 'sizes': sizes}
+                with open(checkpointPath + '.tmp', 'w') as f:
+                    json.dump(data, f)
+                os.replace(checkpointPath + '.tmp', checkpointPath)
+
+            transform = cleaning_transform(fixedStreetNames, specialStreetOverrides,
+                                           fixedPostcodes)
+            first = checkpoint['count'] if checkpoint else 0
+
+            def shaped():
+                for number, element in enumerate(elements, first + 1):
+                    positions.append((number, position()))
+                    yield shape_element_rows(element, fixedStreetNames, specialStreetOverrides,
+                                             fixedPostcodes, transform=transform)
+
+            rows = shaped() if checkpointEvery else (
+                shape_element_rows(element, fixedStreetNames, specialStreetOverrides,
+                                   fixedPostcodes, transform=transform) for element in elements)
+            stats = loadstats.LoadStats() if checkpoint is None else None
+            count = write_csv_rows(rows, validate, validateEvery=validateEvery, stats=stats,
+                                   append=checkpoint is not None,
+                                   first=first, checkpoint=save if checkpointEvery else None,
+                                   checkpointEvery=checkpointEvery)
+        finally:
+            if reader is not osm_file:
+                reader.close()
+    if stats is not None:
+        stats.save(STATS_PATH)
+    elif os.path.exists(STATS_PATH):
+        os.remove(STATS_PATH) # Only has the statistics of the elements before the checkpoint
+    if os.path.exists(checkpointPath):
+        os.remove(checkpointPath)
+    return count
+
+def write_csvs(elements, validate=False, paths=CSV_PATHS, header=True, validateEvery=1,
+               stats=None):
+    """
+    Writes shaped elements to the 5 CSV files
+
+    Args:
+        elements: iterable of shaped elements, as returned by shape_element
+        validate: if True, validate the elements against the schema
+        paths: paths of the nodes, nodes tags, ways, way nodes and way tags CSV files
+        header: if False, the header rows aren't written (used to write parts of the files)
+        validateEvery: validates only every Nth element (sampling), 1 validates all of them
+        stats: if given, a loadstats.LoadStats object updated with every element
+
+    Returns:
+        The number of written elements
+    """
+    nodes_path, node_tags_path, ways_path, way_nodes_path, way_tags_path = paths
+    with codecs.open(nodes_path, 'wb') as nodes_file, \
+         codecs.open(node_tags_path, 'wb') as nodes_tags_file, \
+         codecs.open(ways_path, 'wb') as ways_file, \
+         codecs.open(way_nodes_path, 'wb') as way_nodes_file, \
+         codecs.open(way_tags_path, 'wb') as way_tags_file:
 
         nodes_writer = csv.DictWriter(nodes_file, NODE_FIELDS)
         node_tags_writer = csv.DictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
@@ -228,29 +714,122 @@ def execute(osmPath, validate=False, fixedStreetNames={},
         way_nodes_writer = csv.DictWriter(way_nodes_file, WAY_NODES_FIELDS)
         way_tags_writer = csv.DictWriter(way_tags_file, WAY_TAGS_FIELDS)
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(osmPath, tags=('node', 'way')):
-            el = shape_element(element, fixedStreetNames=fixedStreetNames, 
-                               specialStreetOverrides=specialStreetOverrides,
-                               fixedPostcodes=fixedPostcodes)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
+        if header is True:
+            nodes_writer.writeheader()
+            node_tags_writer.writeheader()
+            ways_writer.writeheader()
+            way_nodes_writer.writeheader()
+            way_tags_writer.writeheader()
+
+        validator = fastvalidator.Validator() # Compiled from the schema only once
+
+        count = 0
+        # The elements are validated in batches, before any element of the batch is written
+        for batch in iter_batches(el for el in elements if el):
+            if validate is True:
+                validate_elements([el for index, el in enumerate(batch, count)
+                                   if index % validateEvery == 0], validator)
+            for el in batch:
+                count += 1
+                if stats is not None:
+                    stats.add_element(el)
+
+                if 'node' in el:
                     nodes_writer.writerow(el['node'])
                     node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
+                elif 'way' in el:
                     ways_writer.writerow(el['way'])
                     way_nodes_writer.writerows(el['way_nodes'])
                     way_tags_writer.writerows(el['way_tags'])
+    return count
+
+def write_csv_rows(rows, validate=False, paths=CSV_PATHS, header=True, validateEvery=1,
+                   nodeStore=None, geometryPath=WAY_GEOMETRY_PATH, stats=None, append=False,
+                   first=0, checkpoint=None, checkpointEvery=None):
+    """
+    Same as write_csvs, but for the tuples returned by shape_element_rows, written with
+    csv.writer instead of csv.DictWriter
+
+    Args:
+        rows: iterable of tuples, as returned by shape_element_rows
+        validate: if True, validate the elements against the schema
+        paths: paths of the nodes, nodes tags, ways, way nodes and way tags CSV files
+        header: if False, the header rows aren't written (used to write parts of the files)
+        validateEvery: validates only every Nth element (sampling), 1 validates all of them
+        nodeStore: if given, a nodestore.NodeLocationStore: the node locations are stored and
+                   the geometry of the ways is written to geometryPath
+        geometryPath: path of the ways geometry CSV file
+        stats: if given, a loadstats.LoadStats object updated with every element
+        append: if True, the rows are appended to the files, without the headers
+        first: number of elements already written (used when resuming from a checkpoint)
+        checkpoint: if given, a function called every checkpointEvery elements, after the
+                    files are flushed, with (count, last element, sizes of the CSV files)
+
+    Returns:
+        The number of written elements (including the first ones)
+    """
+    nodes_path, node_tags_path, ways_path, way_nodes_path, way_tags_path = paths
+    mode = 'ab' if append is True else 'wb'
+    header = header and not append
+    geometry_path = geometryPath if nodeStore is not None else os.devnull
+    # The geometry file is closed last, so it isn't older than the nodes file (sqlcreator
+    # ignores a geometry file older than the nodes file)
+    with codecs.open(geometry_path, mode) as geometry_file, \
+         codecs.open(nodes_path, mode) as nodes_file, \
+         codecs.open(node_tags_path, mode) as nodes_tags_file, \
+         codecs.open(ways_path, mode) as ways_file, \
+         codecs.open(way_nodes_path, mode) as way_nodes_file, \
+         codecs.open(way_tags_path, mode) as way_tags_file:
+
+        geometry_writer = csv.writer(geometry_file)
+        nodes_writer = csv.writer(nodes_file)
+        node_tags_writer = csv.writer(nodes_tags_file)
+        ways_writer = csv.writer(ways_file)
+        way_nodes_writer = csv.writer(way_nodes_file)
+        way_tags_writer = csv.writer(way_tags_file)
+
+        if header is True:
+            nodes_writer.writerow(NODE_FIELDS)
+            node_tags_writer.writerow(NODE_TAGS_FIELDS)
+            ways_writer.writerow(WAY_FIELDS)
+            way_nodes_writer.writerow(WAY_NODES_FIELDS)
+            way_tags_writer.writerow(WAY_TAGS_FIELDS)
+            geometry_writer.writerow(WAY_GEOMETRY_FIELDS)
+
+        validator = fastvalidator.Validator()
+        files = [nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file]
+
+        count = first
+        # The elements are validated in batches, before any element of the batch is written
+        for batch in iter_batches(rows):
+            if validate is True:
+                validate_elements([rows_to_element(el) for index, el in enumerate(batch, count)
+                                   if index % validateEvery == 0], validator)
+            for el in batch:
+                tag, row, tags, way_nodes = el
+                count += 1
+                if stats is not None:
+                    stats.add_rows(tag, row, tags)
+
+                if tag == 'node':
+                    nodes_writer.writerow(row)
+                    node_tags_writer.writerows(tags)
+                    if nodeStore is not None:
+                        nodeStore.set(row[0], row[1], row[2])
+                else:
+                    ways_writer.writerow(row)
+                    way_nodes_writer.writerows(way_nodes)
+                    way_tags_writer.writerows(tags)
+                    if nodeStore is not None:
+                        coords, geometryRow = shape_way_geometry(way_nodes, nodeStore)
+                        if geometryRow is not None:
+                            geometry_writer.writerow(geometryRow)
+                if checkpoint is not None and count % checkpointEvery == 0:
+                    for csvFile in files:
+                        csvFile.flush()
+                        os.fsync(csvFile.fileno())
+                    checkpoint(count, el, [csvFile.tell() for csvFile in files])
+    return count
 
 if __name__ == '__main__':
     # If the module is used directly, execute the main function with standard arguments,
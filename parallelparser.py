@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel version of osmparser.execute
+
+The OSM XML file is split in byte ranges that start at the beginning of a <node or <way
+element (see the byteranges module), each range is parsed and shaped by a different process,
+and the CSV parts written by each process are merged in the order of the ranges, so the result
+is the same as the one written by osmparser.execute
+"""
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+import byteranges
+import osmparser
+
+
+def part_paths(tmpDir, index):
+    """
+    Returns the paths of the CSV parts written by a worker
+
+    Args:
+        tmpDir: directory of the parts
+        index: index of the byte range
+
+    Returns:
+        A list of paths in the same order as osmparser.CSV_PATHS
+    """
+    return [os.path.join(tmpDir, '{}.{}'.format(index, os.path.basename(path)))
+            for path in osmparser.CSV_PATHS]
+
+
+def shape_range(task):
+    """
+    Parses and shapes a byte range of the OSM XML file, writing the resulting CSV parts
+    Runs in the worker processes
+
+    Args:
+        task: tuple of (osmPath, start, end, index, tmpDir, validate, fixedStreetNames,
+              specialStreetOverrides, fixedPostcodes)
+
+    Returns:
+        The number of shaped elements
+    """
+    (osmPath, start, end, index, tmpDir, validate,
+     fixedStreetNames, specialStreetOverrides, fixedPostcodes) = task
+    transform = osmparser.cleaning_transform(fixedStreetNames, specialStreetOverrides,
+                                             fixedPostcodes)
+    reader = byteranges.RangeReader(osmPath, start, end)
+    try:
+        elements = (osmparser.shape_element(element, fixedStreetNames=fixedStreetNames,
+                                            specialStreetOverrides=specialStreetOverrides,
+                                            fixedPostcodes=fixedPostcodes, transform=transform)
+                    for element in osmparser.get_element(reader, tags=('node', 'way')))
+        return osmparser.write_csvs(elements, validate, paths=part_paths(tmpDir, index),
+                                    header=(index == 0))
+    finally:
+        reader.close()
+
+
+def merge_parts(tmpDir, count):
+    """
+    Concatenates the CSV parts, in the order of the byte ranges, into the final CSV files
+
+    Args:
+        tmpDir: directory of the parts
+        count: number of byte ranges
+
+    Returns:
+        Nothing
+    """
+    for i, path in enumerate(osmparser.CSV_PATHS):
+        with open(path, 'wb') as output:
+            for index in range(count):
+                with open(part_paths(tmpDir, index)[i], 'rb') as part:
+                    shutil.copyfileobj(part, output)
+
+
+def execute(osmPath, workers=None, validate=False, fixedStreetNames={},
+            specialStreetOverrides={}, fixedPostcodes={}, chunksPerWorker=4):
+    """
+    Main function of this module:
+    Same as osmparser.execute, but the parsing is done by a pool of processes
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file to parse (uncompressed)
+        workers: number of processes, defaults to the number of CPUs
+        validate: if True, validate the elements against the schema
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        chunksPerWorker: number of byte ranges per process, more ranges balance better the
+                         work between the processes
+
+    Returns:
+        The number of shaped elements
+        Writes the same 5 csv files as osmparser.execute
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if osmparser.is_pbf(osmPath) or osmPath.lower().endswith(tuple(osmparser.OPENERS)):
+        raise Exception('Parallel parsing by byte ranges needs an uncompressed OSM XML file, '
+                        'use osmparser.execute for compressed and PBF files')
+    ranges = byteranges.find_boundaries(osmPath, workers * chunksPerWorker)
+    tmpDir = tempfile.mkdtemp(prefix='osmparser-', dir=os.path.dirname(os.path.abspath(
+        osmparser.NODES_PATH)))
+    try:
+        tasks = [(osmPath, start, end, index, tmpDir, validate, fixedStreetNames,
+                  specialStreetOverrides, fixedPostcodes)
+                 for index, (start, end) in enumerate(ranges)]
+        counts = []
+        if workers == 1:
+            counts = [shape_range(task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                counts = pool.map(shape_range, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        if not tasks: # No elements, writes only the headers
+            osmparser.write_csvs([], validate)
+        else:
+            merge_parts(tmpDir, len(tasks))
+    finally:
+        shutil.rmtree(tmpDir)
+    return sum(counts)
+
+
+if __name__ == '__main__':
+    # If the module is used directly, execute the main function with standard arguments,
+    # creating a dirty set of CSVs
+    execute('curitiba.osm')
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+Pure Python reader of OpenStreetMap PBF files (.osm.pbf)
+
+The file is a sequence of blobs, each one a zlib compressed protocol buffers message with a
+block of nodes, ways and relations. The blobs are decoded independently (optionally by a pool
+of processes) and converted to the same XML elements that the OSM XML parser yields, so they
+can be used by osmparser.shape_element and by the audit modules without any changes.
+
+Format reference: https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+import collections
+import struct
+import time
+import zlib
+import multiprocessing
+import xml.etree.cElementTree as ET
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+BLOBS_PER_WORKER = 2 # Blobs read ahead for each decoding process
+
+
+def read_varint(buf, pos):
+    """
+    Reads a protocol buffers varint
+
+    Args:
+        buf: bytes
+        pos: position of the varint
+
+    Returns:
+        value, position after the varint
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(value):
+    """
+    Decodes a zigzag encoded signed integer (sint32/sint64)
+    """
+    return (value >> 1) ^ -(value & 1)
+
+
+def signed(value):
+    """
+    Converts a varint to a signed 64 bits integer (int32/int64)
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def iter_fields(buf):
+    """
+    Iterates over the fields of a protocol buffers message
+
+    Args:
+        buf: bytes of the message
+
+    Yields:
+        (field number, value) tuples, value is an int for varints and bytes for length
+        delimited fields
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        number = key >> 3
+        wireType = key & 0x7
+        if wireType == 0:
+            value, pos = read_varint(buf, pos)
+        elif wireType == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wireType == 1:
+            value = struct.unpack_from('<q', buf, pos)[0]
+            pos += 8
+        elif wireType == 5:
+            value = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4
+        else:
+            raise Exception('Unsupported protocol buffers wire type {}'.format(wireType))
+        yield number, value
+
+
+def packed(buf):
+    """
+    Decodes a packed repeated varint field
+
+    Args:
+        buf: bytes of the field
+
+    Returns:
+        A list of unsigned values
+    """
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def packed_delta(buf):
+    """
+    Decodes a packed, delta coded, zigzag encoded field (ids, coordinates of dense nodes, refs)
+
+    Args:
+        buf: bytes of the field
+
+    Returns:
+        A list of the decoded values
+    """
+    values = []
+    last = 0
+    for value in packed(buf):
+        last += zigzag(value)
+        values.append(last)
+    return values
+
+
+def iter_blobs(osmPath):
+    """
+    Iterates over the blobs of a PBF file
+
+    Args:
+        osmPath: path and/or name of the PBF file
+
+    Yields:
+        (blob type, blob bytes) tuples, the type is 'OSMHeader' or 'OSMData'
+    """
+    with open(osmPath, 'rb') as pbf:
+        while True:
+            size = pbf.read(4)
+            if len(size) < 4:
+                break
+            header = pbf.read(struct.unpack('>I', size)[0])
+            blobType = None
+            dataSize = 0
+            for number, value in iter_fields(header):
+                if number == 1:
+                    blobType = value.decode('utf-8')
+                elif number == 3:
+                    dataSize = value
+            yield blobType, pbf.read(dataSize)
+
+
+def blob_data(blob):
+    """
+    Returns the uncompressed data of a blob
+
+    Args:
+        blob: bytes of the Blob message
+
+    Returns:
+        The bytes of the uncompressed message
+    """
+    for number, value in iter_fields(blob):
+        if number == 1: # raw
+            return value
+        if number == 3: # zlib_data
+            return zlib.decompress(value)
+    raise Exception('Unsupported PBF blob compression (only raw and zlib are supported)')
+
+
+def format_coordinate(nano):
+    """
+    Formats a coordinate in nanodegrees as a decimal string, like the ones of the OSM XML files
+    """
+    sign = '-' if nano < 0 else ''
+    degrees, fraction = divmod(abs(nano), 1000000000)
+    text = '{}{}.{:09d}'.format(sign, degrees, fraction).rstrip('0')
+    return text + '0' if text.endswith('.') else text
+
+
+def format_timestamp(milliseconds):
+    """
+    Formats a timestamp in milliseconds like the ones of the OSM XML files
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(milliseconds // 1000))
+
+
+def decode_info(buf, strings, dateGranularity, attrib):
+    """
+    Decodes an Info message into the attributes dictionary of an element
+    """
+    for number, value in iter_fields(buf):
+        if number == 1:
+            attrib['version'] = str(signed(value))
+        elif number == 2:
+            attrib['timestamp'] = format_timestamp(signed(value) * dateGranularity)
+        elif number == 3:
+            attrib['changeset'] = str(signed(value))
+        elif number == 4:
+            attrib['uid'] = str(signed(value))
+        elif number == 5:
+            attrib['user'] = strings[value]
+
+
+def decode_dense(buf, strings, block):
+    """
+    Decodes a DenseNodes message
+
+    Returns:
+        A list of ('node', attributes, tags) tuples
+    """
+    ids = lats = lons = keysVals = []
+    info = {}
+    for number, value in iter_fields(buf):
+        if number == 1:
+            ids = packed_delta(value)
+        elif number == 5:
+            for infoNumber, infoValue in iter_fields(value):
+                info[infoNumber] = infoValue
+        elif number == 8:
+            lats = packed_delta(value)
+        elif number == 9:
+            lons = packed_delta(value)
+        elif number == 10:
+            keysVals = packed(value)
+
+    versions = [signed(v) for v in packed(info[1])] if 1 in info else None
+    timestamps = packed_delta(info[2]) if 2 in info else None
+    changesets = packed_delta(info[3]) if 3 in info else None
+    uids = packed_delta(info[4]) if 4 in info else None
+    userSids = packed_delta(info[5]) if 5 in info else None
+
+    granularity, latOffset, lonOffset, dateGranularity = block
+    nodes = []
+    kv = 0
+    for i, id_ in enumerate(ids):
+        attrib = {'id': str(id_),
+                  'lat': format_coordinate(latOffset + granularity * lats[i]),
+                  'lon': format_coordinate(lonOffset + granularity * lons[i])}
+        if versions is not None:
+            attrib['version'] = str(versions[i])
+        if timestamps is not None:
+            attrib['timestamp'] = format_timestamp(timestamps[i] * dateGranularity)
+        if changesets is not None:
+            attrib['changeset'] = str(changesets[i])
+        if uids is not None:
+            attrib['uid'] = str(uids[i])
+        if userSids is not None:
+            attrib['user'] = strings[userSids[i]]
+        tags = []
+        if keysVals:
+            while keysVals[kv] != 0: # Each node's tags end with a 0
+                tags.append((strings[keysVals[kv]], strings[keysVals[kv + 1]]))
+                kv += 2
+            kv += 1
+        nodes.append(('node', attrib, tags))
+    return nodes
+
+
+def decode_element(kind, buf, strings, block):
+    """
+    Decodes a Node, Way or Relation message
+
+    Returns:
+        A (kind, attributes, tags) tuple for nodes, and a (kind, attributes, tags, children)
+        tuple for ways (children are the node refs) and relations (children are the members)
+    """
+    granularity, latOffset, lonOffset, dateGranularity = block
+    attrib = {}
+    keys = vals = refs = roles = memids = types = []
+    lat = lon = 0
+    for number, value in iter_fields(buf):
+        if number == 1:
+            attrib['id'] = str(zigzag(value) if kind == 'node' else signed(value))
+        elif number == 2:
+            keys = packed(value)
+        elif number == 3:
+            vals = packed(value)
+        elif number == 4:
+            decode_info(value, strings, dateGranularity, attrib)
+        elif number == 8:
+            if kind == 'node':
+                lat = zigzag(value)
+            elif kind == 'way':
+                refs = packed_delta(value)
+            else:
+                roles = packed(value)
+        elif number == 9:
+            if kind == 'node':
+                lon = zigzag(value)
+            else:
+                memids = packed_delta(value)
+        elif number == 10:
+            types = packed(value)
+    tags = [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+    if kind == 'node':
+        attrib['lat'] = format_coordinate(latOffset + granularity * lat)
+        attrib['lon'] = format_coordinate(lonOffset + granularity * lon)
+        return (kind, attrib, tags)
+    if kind == 'way':
+        return (kind, attrib, tags, refs)
+    members = [(MEMBER_TYPES[t], m, strings[r]) for t, m, r in zip(types, memids, roles)]
+    return (kind, attrib, tags, members)
+
+
+def decode_blob(blob):
+    """
+    Decodes an OSMData blob
+    Only uses plain Python types, so it can be run by the worker processes
+
+    Args:
+        blob: bytes of the Blob message
+
+    Returns:
+        A list of element tuples, see decode_element
+    """
+    data = blob_data(blob)
+    strings = []
+    groups = []
+    granularity, latOffset, lonOffset, dateGranularity = 100, 0, 0, 1000
+    for number, value in iter_fields(data):
+        if number == 1:
+            strings = [s.decode('utf-8') for n, s in iter_fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 18:
+            dateGranularity = value
+        elif number == 19:
+            latOffset = signed(value)
+        elif number == 20:
+            lonOffset = signed(value)
+    block = (granularity, latOffset, lonOffset, dateGranularity)
+
+    elements = []
+    for group in groups:
+        for number, value in iter_fields(group):
+            if number == 1:
+                elements.append(decode_element('node', value, strings, block))
+            elif number == 2:
+                elements.extend(decode_dense(value, strings, block))
+            elif number == 3:
+                elements.append(decode_element('way', value, strings, block))
+            elif number == 4:
+                elements.append(decode_element('relation', value, strings, block))
+    return elements
+
+
+def make_element(item):
+    """
+    Converts an element tuple to the XML element that the OSM XML parser would yield
+
+    Args:
+        item: element tuple, see decode_element
+
+    Returns:
+        An ElementTree Element
+    """
+    kind, attrib, tags = item[:3]
+    element = ET.Element(kind, attrib)
+    if kind == 'way':
+        for ref in item[3]:
+            ET.SubElement(element, 'nd', {'ref': str(ref)})
+    elif kind == 'relation':
+        for memberType, ref, role in item[3]:
+            ET.SubElement(element, 'member', {'type': memberType, 'ref': str(ref), 'role': role})
+    for k, v in tags:
+        ET.SubElement(element, 'tag', {'k': k, 'v': v})
+    return element
+
+
+def bounded_imap(pool, function, items, window):
+    """
+    Same as pool.imap, but at most window items are read and being processed at a time (imap
+    reads the whole iterable ahead, a large file would be loaded in memory)
+
+    Args:
+        pool: multiprocessing.Pool object
+        function: function applied to each item
+        items: iterable of items
+        window: maximum number of items in flight
+
+    Yields:
+        The results, in the order of the items
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_elements(osmPath, tags=('node', 'way', 'relation'), workers=1):
+    """
+    Yields the elements of a PBF file, in the order of the file
+
+    Args:
+        osmPath: path and/or name of the PBF file
+        tags: elements to yield
+        workers: number of processes used to decode the blobs, each one gets at most
+                 BLOBS_PER_WORKER blobs ahead, so the memory used is bounded
+
+    Yields:
+        elem: element, the same as the one yielded by osmparser.get_element for an OSM XML file
+    """
+    blobs = (blob for blobType, blob in iter_blobs(osmPath) if blobType == 'OSMData')
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        decoded = bounded_imap(pool, decode_blob, blobs, BLOBS_PER_WORKER * workers)
+    else:
+        pool = None
+        decoded = (decode_blob(blob) for blob in blobs)
+    try:
+        for items in decoded:
+            for item in items:
+                if item[0] in tags:
+                    yield make_element(item)
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined version of osmparser.execute
+
+The work is split in stages connected by bounded queues, so the XML parsing, the shaping and
+validation of the elements and the writing of the CSV files overlap:
+    - parse: a thread reads the OSM file and sends batches of plain element tuples
+    - shape: a pool of processes shapes (and validates) the batches, the results are taken in
+             the order of the batches, so the output is the same as the serial one
+    - write: one thread for each CSV file
+A full queue blocks the stage that feeds it (backpressure), so the memory used is bounded by
+the sizes of the queues. The depth of each queue is sampled every time an item is added.
+"""
+
+import codecs
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+import unicodecsv as csv
+import fastvalidator
+import loadstats
+import osmparser
+import pbfparser
+
+BATCH_SIZE = 1000 # Elements in each batch sent to the shape stage
+QUEUE_SIZE = 8 # Maximum number of batches waiting in each queue
+OUTPUTS = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags'] # Same order as CSV_PATHS
+FIELDS = [osmparser.NODE_FIELDS, osmparser.NODE_TAGS_FIELDS, osmparser.WAY_FIELDS,
+          osmparser.WAY_NODES_FIELDS, osmparser.WAY_TAGS_FIELDS]
+DONE = None # Sent through the queues after the last item
+
+# Settings of the shape worker processes, set by init_shape_worker
+_worker = {}
+
+
+class QueueMetrics(object):
+    """
+    Depth samples and time spent waiting (blocked by backpressure) of a queue
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.total = 0
+        self.maxDepth = 0
+        self.blocked = 0.0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total += depth
+        self.maxDepth = max(self.maxDepth, depth)
+
+    def summary(self):
+        return {'maxDepth': self.maxDepth,
+                'meanDepth': self.total / self.samples if self.samples else 0.0,
+                'blockedSeconds': self.blocked}
+
+
+def put(q, item, metrics, stop):
+    """
+    Adds an item to a bounded queue, waiting while it's full, unless the pipeline is stopped
+
+    Returns:
+        False if the pipeline was stopped
+    """
+    metrics.sample(q.qsize())
+    start = time.perf_counter()
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            metrics.blocked += time.perf_counter() - start
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get(q, stop):
+    """
+    Takes an item from a queue, waiting while it's empty, unless the pipeline is stopped
+
+    Returns:
+        The item, or DONE if the pipeline was stopped
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return DONE
+
+
+def element_item(element):
+    """
+    Converts an element to a plain tuple that can be sent to other processes, in the format
+    of pbfparser.decode_element (rebuilt with pbfparser.make_element)
+    """
+    tags = [(tag.attrib['k'], tag.attrib['v']) for tag in element.iter('tag')]
+    if element.tag == 'way':
+        return ('way', dict(element.attrib), tags, [nd.attrib['ref'] for nd in element.iter('nd')])
+    return ('node', dict(element.attrib), tags)
+
+
+def parse_stage(osmPath, batches, metrics, stop, errors, batchSize):
+    """
+    Parse stage: reads the elements and sends them in batches
+    """
+    try:
+        batch = []
+        for element in osmparser.get_element(osmPath, tags=('node', 'way')):
+            batch.append(element_item(element))
+            if len(batch) >= batchSize:
+                if not put(batches, batch, metrics, stop):
+                    return
+                batch = []
+        if batch:
+            put(batches, batch, metrics, stop)
+    except Exception as error:
+        errors.append(error)
+    finally:
+        put(batches, DONE, metrics, stop)
+
+
+def init_shape_worker(fixedStreetNames, specialStreetOverrides, fixedPostcodes, validate,
+                      validateEvery):
+    """
+    Initializer of the shape worker processes, the dictionaries are sent only once and the
+    cleaning rules are compiled once in each worker
+    """
+    _worker.update(transform=osmparser.cleaning_transform(fixedStreetNames,
+                                                          specialStreetOverrides, fixedPostcodes),
+                   fixedStreetNames=fixedStreetNames,
+                   specialStreetOverrides=specialStreetOverrides, fixedPostcodes=fixedPostcodes,
+                   validate=validate, validateEvery=validateEvery,
+                   validator=fastvalidator.Validator() if validate else None)
+
+
+def shape_batch(task):
+    """
+    Shape stage: shapes (and validates) a batch of element tuples
+
+    Args:
+        task: (index of the first element, list of element tuples) tuple
+
+    Returns:
+        A list of the tuples returned by osmparser.shape_element_rows
+    """
+    first, items = task
+    rows = []
+    for item in items:
+        rows.append(osmparser.shape_element_rows(pbfparser.make_element(item),
+                                                 _worker['fixedStreetNames'],
+                                                 _worker['specialStreetOverrides'],
+                                                 _worker['fixedPostcodes'],
+                                                 transform=_worker['transform']))
+    if _worker['validate'] is True: # The sampled elements of the batch are validated at once
+        osmparser.validate_elements([osmparser.rows_to_element(el)
+                                     for index, el in enumerate(rows, first)
+                                     if index % _worker['validateEvery'] == 0],
+                                    _worker['validator'])
+    return rows
+
+
+def write_stage(path, fields, rows, header, errors, stop):
+    """
+    Write stage: writes the lists of rows received from a queue to a CSV file, if it fails
+    the pipeline is stopped
+    """
+    try:
+        with codecs.open(path, 'wb') as csvFile:
+            writer = csv.writer(csvFile)
+            if header is True:
+                writer.writerow(fields)
+            while True:
+                batch = rows.get()
+                if batch is DONE:
+                    return
+                writer.writerows(batch)
+    except Exception as error:
+        errors.append(error)
+        stop.set() # The parse and shape stages stop too
+        while rows.get() is not DONE: # Keeps consuming, so the other stages don't block
+            pass
+
+
+def execute(osmPath, validate=False, fixedStreetNames={}, specialStreetOverrides={},
+            fixedPostcodes={}, validateEvery=1, workers=None, batchSize=BATCH_SIZE,
+            queueSize=QUEUE_SIZE, paths=osmparser.CSV_PATHS, header=True):
+    """
+    Main function of this module:
+    Same as osmparser.execute, but with the parse, shape and write stages running at the same
+    time, the CSV files are the same
+
+    Args:
+        osmPath: path and/or name of the OpenStreetMap XML file to parse, can be compressed
+                 (.gz, .bz2 or .xz) or a PBF file (.pbf)
+        validate: if True, validate the elements against the schema
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        validateEvery: validates only every Nth element (sampling), 1 validates all of them
+        workers: number of shape processes, defaults to the number of CPUs, 0 shapes the
+                 batches in the main thread
+        batchSize: number of elements in each batch
+        queueSize: maximum number of batches in each queue (and being shaped)
+        paths: paths of the nodes, nodes tags, ways, way nodes and way tags CSV files
+        header: if False, the header rows aren't written
+
+    Returns:
+        count, metrics: the number of written elements, and a dictionary with the depth and
+        the blocked time of each queue ('parse', 'shape' and one for each CSV file)
+    """
+    if validateEvery < 1:
+        raise ValueError('validateEvery must be 1 or more')
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    stop = threading.Event()
+    errors = []
+    metrics = {name: QueueMetrics() for name in ['parse', 'shape'] + OUTPUTS}
+
+    batches = queue.Queue(queueSize)
+    parser = threading.Thread(target=parse_stage, daemon=True,
+                              args=(osmPath, batches, metrics['parse'], stop, errors, batchSize))
+    outputs = [queue.Queue(queueSize) for _ in OUTPUTS]
+    writers = [threading.Thread(target=write_stage, daemon=True,
+                                args=(path, fields, rows, header, errors, stop))
+               for path, fields, rows in zip(paths, FIELDS, outputs)]
+
+    initArgs = (fixedStreetNames, specialStreetOverrides, fixedPostcodes, validate, validateEvery)
+    pool = None
+    if workers > 0:
+        pool = multiprocessing.Pool(workers, init_shape_worker, initArgs)
+    else:
+        init_shape_worker(*initArgs)
+
+    stats = loadstats.LoadStats()
+    count = 0
+
+    def dispatch(rows):
+        # Splits the shaped elements in the rows of each CSV file
+        parts = [[] for _ in OUTPUTS]
+        for el in rows:
+            tag, row, tags, way_nodes = el
+            stats.add_rows(tag, row, tags)
+            if tag == 'node':
+                parts[0].append(row)
+                parts[1].extend(tags)
+            else:
+                parts[2].append(row)
+                parts[3].extend(way_nodes)
+                parts[4].extend(tags)
+        for name, rowsQueue, part in zip(OUTPUTS, outputs, parts):
+            if part:
+                put(rowsQueue, part, metrics[name], stop)
+        return len(rows)
+
+    parser.start()
+    for writer in writers:
+        writer.start()
+    try:
+        shaping = collections.deque() # Batches being shaped, in order
+        first = 0
+        while True:
+            batch = get(batches, stop)
+            if stop.is_set():
+                break # A writer failed, its error is raised below
+            if batch is not DONE:
+                task = (first, batch)
+                first += len(batch)
+                if pool is None:
+                    count += dispatch(shape_batch(task))
+                    continue
+                metrics['shape'].sample(len(shaping))
+                shaping.append(pool.apply_async(shape_batch, (task,)))
+            # The oldest batch is written when the shape stage is full, or at the end
+            while shaping and (len(shaping) >= queueSize or batch is DONE):
+                start = time.perf_counter()
+                rows = shaping.popleft().get()
+                metrics['shape'].blocked += time.perf_counter() - start
+                count += dispatch(rows)
+            if batch is DONE:
+                break
+    except:
+        stop.set()
+        raise
+    finally:
+        if pool is not None:
+            if stop.is_set():
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        for rowsQueue in outputs:
+            rowsQueue.put(DONE) # The writers always consume their queues, this doesn't block
+        for writer in writers:
+            writer.join()
+        parser.join()
+    if errors:
+        raise errors[0]
+    stats.save(osmparser.STATS_PATH)
+    return count, {name: m.summary() for name, m in metrics.items()}
+
+
+if __name__ == '__main__':
+    # If the module is used directly, execute the main function with standard arguments,
+    # creating a dirty set of CSVs, and prints the metrics of the queues
+    print(execute('curitiba.osm'))
@@ -1,20 +1,150 @@
+import os
+import sqlite3
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
+from matplotlib.colors import LogNorm
 import sqloperations as sql
 
-def execute():
+# Coordinates of the nodes of the ways, one row for each tag of the way (like the scatter plot)
+POINTS_QUERY = '''
+        SELECT lat, lon FROM NODES n JOIN ways_nodes wn ON n.id = wn.node_id
+        JOIN ways_tags wt ON wn.id = wt.id
+        '''
+BOUNDS_QUERY = 'SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM nodes'
+RESOLUTION = 1000 # Default number of bins in each direction of the density raster
+CHUNK_SIZE = 100000 # Number of rows fetched from the database at once
+RASTER_PATH = 'curitiba_raster.npz'
+
+
+def stream_points(dbName, chunkSize=CHUNK_SIZE, query=POINTS_QUERY):
+    """
+    Streams the coordinates of the map from the database in chunks, reusing the same
+    preallocated NumPy array, so the whole list of points is never in memory
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        chunkSize: number of rows fetched at once
+        query: query that returns (lat, lon) rows
+
+    Yields:
+        A (n, 2) float64 view of the preallocated array, valid until the next chunk is yielded
+    """
+    conn = sqlite3.Connection(dbName)
+    try:
+        cursor = conn.execute(query)
+        points = np.empty((chunkSize, 2), dtype=np.float64)
+        while True:
+            rows = cursor.fetchmany(chunkSize)
+            if not rows:
+                break
+            points[:len(rows)] = rows
+            yield points[:len(rows)]
+    finally:
+        conn.close()
+
+
+def density_raster(dbName, resolution=RESOLUTION, chunkSize=CHUNK_SIZE, query=POINTS_QUERY):
+    """
+    Bins the coordinates of the map in a 2D density raster (a 2D histogram)
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        resolution: number of bins, an int (same number for lat and lon) or a (lat, lon) tuple
+        chunkSize: number of rows fetched at once
+        query: query that returns (lat, lon) rows
+
+    Returns:
+        raster: (lat bins, lon bins) int64 array with the number of points in each bin
+        extent: (minLat, maxLat, minLon, maxLon) tuple, the limits of the raster
+    """
+    latBins, lonBins = (resolution, resolution) if np.isscalar(resolution) else resolution
+    conn = sqlite3.Connection(dbName)
+    try:
+        minLat, maxLat, minLon, maxLon = conn.execute(BOUNDS_QUERY).fetchone()
+    finally:
+        conn.close()
+    raster = np.zeros(latBins * lonBins, dtype=np.int64)
+    if minLat is None:
+        return raster.reshape(latBins, lonBins), (0.0, 0.0, 0.0, 0.0)
+    # Scale factors from coordinates to bins, the maximum coordinate goes to the last bin
+    latScale = latBins / ((maxLat - minLat) or 1.0)
+    lonScale = lonBins / ((maxLon - minLon) or 1.0)
+    for points in stream_points(dbName, chunkSize, query):
+        rows = ((points[:, 0] - minLat) * latScale).astype(np.int64)
+        cols = ((points[:, 1] - minLon) * lonScale).astype(np.int64)
+        np.clip(rows, 0, latBins - 1, out=rows)
+        np.clip(cols, 0, lonBins - 1, out=cols)
+        raster += np.bincount(rows * lonBins + cols, minlength=latBins * lonBins)
+    return raster.reshape(latBins, lonBins), (minLat, maxLat, minLon, maxLon)
+
+
+def raster_key(dbName, resolution, query):
+    """
+    Key of a cached raster: the database must not have changed since it was created
+    """
+    stat = os.stat(dbName)
+    return '{}|{}|{}|{}'.format(stat.st_size, stat.st_mtime_ns, resolution, ' '.join(query.split()))
+
+
+def cached_raster(dbName, resolution=RESOLUTION, rasterPath=RASTER_PATH, chunkSize=CHUNK_SIZE,
+                  query=POINTS_QUERY):
+    """
+    Returns the density raster of the map, loading it from a file if it was already computed
+    for the same database, resolution and query, or computing and saving it if not
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        resolution: number of bins, an int or a (lat, lon) tuple
+        rasterPath: .npz file used to cache the raster, None disables the cache
+        chunkSize: number of rows fetched at once
+        query: query that returns (lat, lon) rows
+
+    Returns:
+        raster, extent: see density_raster
+    """
+    if rasterPath is None:
+        return density_raster(dbName, resolution, chunkSize, query)
+    key = raster_key(dbName, resolution, query)
+    if os.path.exists(rasterPath):
+        with np.load(rasterPath) as cached:
+            if str(cached['key']) == key:
+                return cached['raster'], tuple(cached['extent'])
+    raster, extent = density_raster(dbName, resolution, chunkSize, query)
+    with open(rasterPath, 'wb') as f: # A file object, so numpy doesn't change the extension
+        np.savez(f, raster=raster, extent=np.array(extent), key=np.array(key))
+    return raster, extent
+
+
+def execute(dbName='curitiba.db', mode='scatter', resolution=RESOLUTION, rasterPath=RASTER_PATH,
+            chunkSize=CHUNK_SIZE):
     """
     Produces a plot of the map data
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        mode: 'scatter' plots every point, 'density' plots a density raster of the points,
+              much faster and lighter for big maps
+        resolution: number of bins of the density raster, an int or a (lat, lon) tuple
+        rasterPath: file used to cache the density raster, None disables the cache
+        chunkSize: number of rows fetched at once by the density mode
+
+    Returns:
+        Nothing
     """
 
     matplotlib.rcParams['figure.figsize'] = (10.0, 10.0)
-    query = sql.execute('curitiba.db',
-        '''
-        SELECT lat, lon FROM NODES n JOIN ways_nodes wn ON n.id = wn.node_id
-        JOIN ways_tags wt ON wn.id = wt.id
-        '''
-            )
+    if mode == 'density':
+        raster, (minLat, maxLat, minLon, maxLon) = cached_raster(dbName, resolution, rasterPath,
+                                                                 chunkSize)
+        # Same orientation as the scatter plot: latitude on the x axis, longitude on the y axis
+        plt.imshow(np.ma.masked_equal(raster, 0).T, origin='lower', norm=LogNorm(),
+                   extent=(minLat, maxLat, minLon, maxLon), aspect='auto',
+                   interpolation='nearest')
+        plt.show()
+        return
+    query = sql.execute(dbName, POINTS_QUERY)
     coordList = query[0]
     lat, lon = zip(*coordList)
     plt.scatter(lat, lon, 0.05, marker='.')
-    plt.show()
\ No newline at end of file
+    plt.show()
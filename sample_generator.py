@@ -1,34 +1,211 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+Extracts a sample of an OSM file, selecting the elements by bounding box, by tags and/or
+taking every k-th element
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+The sample is referentially complete: every node used by a selected way is written too, so
+the joins between ways_nodes and nodes work on the sample. The file is read twice, the first
+pass selects the elements and keeps the needed ids in sorted arrays (see IdSet), the second one
+writes them. The memory used is 8 bytes for each id kept (the nodes and ways of the sample and,
+with a bounding box, the nodes inside it), not for each element of the file, plus a copy of the
+largest set while it's sorted.
+
+Usage: python sample_generator.py [osm file] [sample file]
+"""
+
+import sys
+from array import array
+import xml.etree.cElementTree as ET
+import numpy as np
+from osmparser import get_element # Handles compressed (.gz, .bz2, .xz) and PBF (.pbf) files
 
 OSM_FILE = "curitiba.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
 k = 5 # Parameter: take every k-th top level element
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
 
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+class IdSet(object):
+    """
+    Set of element ids stored as a sorted int64 array, 8 bytes for each id whatever the range
+    of the ids is (OSM ids are spread over ~1e10, so a bitmap would allocate most of its pages)
+
+    The ids are appended to a buffer (array('q')) and merged in the sorted array, without the
+    repeated ids, the first time the set is searched after they were added. The OSM files have
+    all the nodes before the ways, so each set is sorted only once or twice.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64) # Sorted, without repeated ids
+        self.pending = array('q')
+
+    def add(self, id_):
+        self.pending.append(int(id_))
+
+    def update(self, ids):
+        self.pending.extend(int(id_) for id_ in ids)
+
+    def merge(self):
+        """
+        Merges the pending ids in the sorted array
+        """
+        if self.pending:
+            pending = np.frombuffer(self.pending, dtype=np.int64)
+            self.ids = np.union1d(self.ids, pending)
+            self.pending = array('q')
+
+    def __contains__(self, id_):
+        self.merge()
+        id_ = int(id_)
+        index = np.searchsorted(self.ids, id_)
+        return index < len(self.ids) and self.ids[index] == id_
+
+    def contains_any(self, ids):
+        """
+        Checks if at least one of the ids is in the set, with a single vectorized search
+        """
+        self.merge()
+        if not ids or len(self.ids) == 0:
+            return False
+        ids = np.array(ids, dtype=np.int64)
+        indexes = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return bool((self.ids[indexes] == ids).any())
+
+    def __len__(self):
+        self.merge()
+        return len(self.ids)
+
+    def memory(self):
+        """
+        Returns the bytes used by the ids
+        """
+        return self.ids.nbytes + self.pending.itemsize * len(self.pending)
+
+
+def in_bbox(element, bbox):
+    """
+    Checks if a node is inside a (minLat, minLon, maxLat, maxLon) bounding box
+    """
+    minLat, minLon, maxLat, maxLon = bbox
+    return (minLat <= float(element.attrib['lat']) <= maxLat and
+            minLon <= float(element.attrib['lon']) <= maxLon)
+
+
+def match_tags(element, tags):
+    """
+    Checks if an element has one of the tags of a filter
+
+    Args:
+        element: XML element
+        tags: dictionary, key -> value, a None value matches any value of the key
+
+    Returns:
+        True if a tag matches
+    """
+    for tag in element.iter('tag'):
+        key = tag.attrib['k']
+        if key in tags and (tags[key] is None or tags[key] == tag.attrib['v']):
+            return True
+    return False
+
+
+def select_elements(osmPath, bbox=None, tags=None, every=1):
+    """
+    First pass: selects the nodes and ways of the sample
+
+    A node is selected if it's inside the bounding box and matches the tag filter, a way is
+    selected if it matches the tag filter and has at least one node inside the bounding box,
+    then every k-th of the selected elements is kept. The nodes of the kept ways are added to
+    the nodes of the sample.
+
+    Args:
+        osmPath: path and/or name of the OSM file
+        bbox: (minLat, minLon, maxLat, maxLon) tuple, None selects everything
+        tags: tag filter, see match_tags, None selects everything
+        every: keeps only every k-th selected element
+
+    Returns:
+        (nodes, ways) tuple of IdSet objects with the ids of the elements of the sample
+    """
+    nodes = IdSet()
+    ways = IdSet()
+    inside = IdSet() # Nodes inside the bounding box, tagged or not
+    count = 0
+    for element in get_element(osmPath, tags=('node', 'way')):
+        if element.tag == 'node':
+            if bbox is not None:
+                if not in_bbox(element, bbox):
+                    continue
+                inside.add(element.attrib['id'])
+        else:
+            refs = [int(nd.attrib['ref']) for nd in element.iter('nd')]
+            if bbox is not None and not inside.contains_any(refs):
+                continue
+        if tags is not None and not match_tags(element, tags):
+            continue
+        count += 1
+        if (count - 1) % every != 0:
+            continue
+        if element.tag == 'node':
+            nodes.add(element.attrib['id'])
+        else:
+            ways.add(element.attrib['id'])
+            nodes.update(refs) # Keeps the sample referentially complete
+    return nodes, ways
+
+
+def execute(osmPath=OSM_FILE, samplePath=SAMPLE_FILE, bbox=None, tags=None, every=1,
+            relations=True):
+    """
+    Main function of this module:
+    Writes a referentially complete sample of an OSM file
+
+    Args:
+        osmPath: path and/or name of the OSM file, can be compressed or a PBF file
+        samplePath: path of the OSM XML file to write
+        bbox: (minLat, minLon, maxLat, maxLon) tuple, None selects everything
+        tags: tag filter, dictionary key -> value (None matches any value), ex:
+              {'amenity': 'restaurant', 'highway': None}, None selects everything
+        every: keeps only every k-th selected element
+        relations: if True, the relations with a member in the sample are written too (their
+                   other members aren't added)
+
+    Returns:
+        A dictionary with the number of written elements of each type
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    nodes, ways = select_elements(osmPath, bbox, tags, every)
+    counts = {'node': 0, 'way': 0, 'relation': 0}
+    elementTags = ('node', 'way', 'relation') if relations is True else ('node', 'way')
+    with open(samplePath, 'wb') as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write(b'<osm version="0.6" generator="sample_generator">\n')
+        if bbox is not None:
+            output.write('  <bounds minlat="{}" minlon="{}" maxlat="{}" maxlon="{}"/>\n'.format(
+                *bbox).encode('utf-8'))
 
+        # Second pass: writes the selected elements, in the order of the file
+        for element in get_element(osmPath, tags=elementTags):
+            id_ = element.attrib['id']
+            if element.tag == 'node':
+                keep = id_ in nodes
+            elif element.tag == 'way':
+                keep = id_ in ways
+            else:
+                keep = any((member.attrib['type'] == 'node' and member.attrib['ref'] in nodes) or
+                           (member.attrib['type'] == 'way' and member.attrib['ref'] in ways)
+                           for member in element.iter('member'))
+            if keep:
+                element.tail = '\n'
+                output.write(b'  ' + ET.tostring(element, encoding='utf-8'))
+                counts[element.tag] += 1
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write(b'<osm>\n  ')
+        output.write(b'</osm>\n')
+    return counts
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
 
-    output.write(b'</osm>')
\ No newline at end of file
+if __name__ == '__main__':
+    # If the module is used directly, writes the sample used in the project: every k-th
+    # top level element, with the nodes of the ways
+    osmPath, samplePath = sys.argv[1:3] if len(sys.argv) > 2 else (OSM_FILE, SAMPLE_FILE)
+    print(execute(osmPath, samplePath, every=k))
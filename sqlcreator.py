@@ -1,63 +1,289 @@
+import csv
+import itertools
+import os
 import sqlite3
-import pandas as pd
+import geometry
+import loadstats
+import nodestore
+import osmparser
 
-def execute(dbname):
+SQL_SCHEMA = '''CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+);
+
+CREATE TABLE ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);
+
+CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+)
+'''
+
+# Normalized layout: the users and the tag keys (with their types) and values are stored once,
+# in dictionary tables, and the data tables reference them by id. Views with the names and
+# columns of the tables of SQL_SCHEMA (with INSTEAD OF triggers for the insertions and
+# deletions) keep the queries and the other modules working with both layouts
+NORMALIZED_SCHEMA = [
+    '''CREATE TABLE users (
+    id INTEGER PRIMARY KEY NOT NULL,
+    uid INTEGER,
+    user TEXT,
+    UNIQUE (uid, user)
+)''',
+    '''CREATE TABLE tag_keys (
+    id INTEGER PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL,
+    type TEXT,
+    UNIQUE (key, type)
+)''',
+    '''CREATE TABLE tag_values (
+    id INTEGER PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL UNIQUE
+)''',
+    '''CREATE TABLE nodes_data (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user_id INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+)''',
+    '''CREATE TABLE nodes_tags_data (
+    id INTEGER,
+    key_id INTEGER,
+    value_id INTEGER,
+    FOREIGN KEY (id) REFERENCES nodes_data(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id)
+)''',
+    '''CREATE TABLE ways_data (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user_id INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+)''',
+    '''CREATE TABLE ways_tags_data (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways_data(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id)
+)''',
+    '''CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways_data(id),
+    FOREIGN KEY (node_id) REFERENCES nodes_data(id)
+)''',
+    '''CREATE VIEW nodes AS
+    SELECT n.id, n.lat, n.lon, u.user, u.uid, n.version, n.changeset, n.timestamp
+    FROM nodes_data n LEFT JOIN users u ON u.id = n.user_id''',
+    '''CREATE VIEW ways AS
+    SELECT w.id, u.user, u.uid, w.version, w.changeset, w.timestamp
+    FROM ways_data w LEFT JOIN users u ON u.id = w.user_id''',
+    '''CREATE VIEW nodes_tags AS
+    SELECT t.id, k.key, v.value, k.type
+    FROM nodes_tags_data t JOIN tag_keys k ON k.id = t.key_id
+    JOIN tag_values v ON v.id = t.value_id''',
+    '''CREATE VIEW ways_tags AS
+    SELECT t.id, k.key, v.value, k.type
+    FROM ways_tags_data t JOIN tag_keys k ON k.id = t.key_id
+    JOIN tag_values v ON v.id = t.value_id''']
+for element in ('nodes', 'ways'):
+    NORMALIZED_SCHEMA += [
+        '''CREATE TRIGGER {0}_tags_insert INSTEAD OF INSERT ON {0}_tags BEGIN
+    INSERT OR IGNORE INTO tag_keys (key, type) VALUES (NEW.key, NEW.type);
+    INSERT OR IGNORE INTO tag_values (value) VALUES (NEW.value);
+    INSERT INTO {0}_tags_data VALUES (NEW.id,
+        (SELECT id FROM tag_keys WHERE key = NEW.key AND type IS NEW.type),
+        (SELECT id FROM tag_values WHERE value = NEW.value));
+END'''.format(element),
+        '''CREATE TRIGGER {0}_tags_delete INSTEAD OF DELETE ON {0}_tags BEGIN
+    DELETE FROM {0}_tags_data WHERE id = OLD.id
+        AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key AND type IS OLD.type)
+        AND value_id = (SELECT id FROM tag_values WHERE value = OLD.value);
+END'''.format(element),
+        '''CREATE TRIGGER {0}_delete INSTEAD OF DELETE ON {0} BEGIN
+    DELETE FROM {0}_data WHERE id = OLD.id;
+END'''.format(element)]
+NORMALIZED_SCHEMA += [
+    '''CREATE TRIGGER nodes_insert INSTEAD OF INSERT ON nodes BEGIN
+    INSERT OR IGNORE INTO users (uid, user) VALUES (NEW.uid, NEW.user);
+    INSERT INTO nodes_data VALUES (NEW.id, NEW.lat, NEW.lon,
+        (SELECT id FROM users WHERE uid IS NEW.uid AND user IS NEW.user),
+        NEW.version, NEW.changeset, NEW.timestamp);
+END''',
+    '''CREATE TRIGGER ways_insert INSTEAD OF INSERT ON ways BEGIN
+    INSERT OR IGNORE INTO users (uid, user) VALUES (NEW.uid, NEW.user);
+    INSERT INTO ways_data VALUES (NEW.id,
+        (SELECT id FROM users WHERE uid IS NEW.uid AND user IS NEW.user),
+        NEW.version, NEW.changeset, NEW.timestamp);
+END''']
+
+# Table (and columns) of the normalized layout where the rows of each table are stored
+NORMALIZED_TABLES = {
+    'nodes': ('nodes_data', ['id', 'lat', 'lon', 'user_id', 'version', 'changeset', 'timestamp']),
+    'nodes_tags': ('nodes_tags_data', ['id', 'key_id', 'value_id']),
+    'ways': ('ways_data', ['id', 'user_id', 'version', 'changeset', 'timestamp']),
+    'ways_nodes': ('ways_nodes', osmparser.WAY_NODES_FIELDS),
+    'ways_tags': ('ways_tags_data', ['id', 'key_id', 'value_id'])}
+DICTIONARY_TABLES = [('users', ['id', 'uid', 'user']),
+                     ('tag_keys', ['id', 'key', 'type']),
+                     ('tag_values', ['id', 'value'])]
+
+# Rows of each CSV file already loaded, updated in the same transaction as each batch, so an
+# interrupted load can be resumed (see execute), the table is dropped when the load finishes
+LOAD_CHECKPOINT_SCHEMA = '''CREATE TABLE load_checkpoint (
+    fname TEXT PRIMARY KEY NOT NULL,
+    rows INTEGER
+)'''
+
+# Order of the tables/columns, matches the fields order used by osmparser
+TABLES = [('nodes', osmparser.NODE_FIELDS),
+          ('nodes_tags', osmparser.NODE_TAGS_FIELDS),
+          ('ways', osmparser.WAY_FIELDS),
+          ('ways_nodes', osmparser.WAY_NODES_FIELDS),
+          ('ways_tags', osmparser.WAY_TAGS_FIELDS)]
+
+BATCH_SIZE = 50000 # Number of rows inserted by each executemany call
+
+# Pragmas used while bulk loading: no rollback journal on disk and no fsync, the database is
+# being created from scratch, so if the load fails it can simply be done again
+LOAD_PRAGMAS = ['PRAGMA journal_mode = MEMORY', 'PRAGMA synchronous = OFF',
+                'PRAGMA cache_size = -200000']
+DEFAULT_PRAGMAS = ['PRAGMA journal_mode = DELETE', 'PRAGMA synchronous = FULL']
+
+# Indexes built after the load, so the insertions don't have to maintain them
+# They cover the joins used by the analysis (see Project.ipynb):
+# - nodes JOIN nodes_tags ON id / ways_tags filtered by key and/or value
+# - nodes JOIN ways_nodes ON node_id, then ways_tags ON id
+# - the nodes of a way in order
+INDEXES = ['CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags (key, value, id)',
+           'CREATE INDEX IF NOT EXISTS nodes_tags_value ON nodes_tags (value, id)',
+           'CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id, key, value)',
+           'CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags (key, value, id)',
+           'CREATE INDEX IF NOT EXISTS ways_tags_value ON ways_tags (value, id)',
+           'CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id, key, value)',
+           'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id, id)',
+           'CREATE INDEX IF NOT EXISTS ways_nodes_id_position ON ways_nodes (id, position, node_id)']
+
+NORMALIZED_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags_data (key_id, value_id, id)',
+    'CREATE INDEX IF NOT EXISTS nodes_tags_value ON nodes_tags_data (value_id, id)',
+    'CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags_data (id, key_id, value_id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags_data (key_id, value_id, id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_value ON ways_tags_data (value_id, id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags_data (id, key_id, value_id)',
+    'CREATE INDEX IF NOT EXISTS tag_keys_type ON tag_keys (type, key)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id, id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_id_position ON ways_nodes (id, position, node_id)']
+
+# R*Tree virtual tables with the bounding box of every node (a point) and every way, used by
+# the bounding box queries of sqloperations (features_in_bbox)
+SPATIAL_TABLES = ['nodes_rtree', 'ways_rtree']
+SPATIAL_SCHEMA = [
+    'CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, minLat, maxLat, minLon, maxLon)',
+    'CREATE VIRTUAL TABLE ways_rtree USING rtree(id, minLat, maxLat, minLon, maxLon)']
+SPATIAL_LOAD = [
+    'INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL',
+    '''INSERT INTO ways_rtree
+       SELECT wn.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon)
+       FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id
+       GROUP BY wn.id''']
+# Optional table with the geometry of each way: length (meters), bounding box and the ordered
+# coordinates packed in a blob of fixed point int32 (lat, lon) pairs (see geometry.encode_coords)
+WAY_GEOMETRY_FIELDS = osmparser.WAY_GEOMETRY_FIELDS
+WAY_GEOMETRY_SCHEMA = '''CREATE TABLE way_geometry (
+    id INTEGER PRIMARY KEY NOT NULL,
+    length REAL,
+    min_lat REAL,
+    min_lon REAL,
+    max_lat REAL,
+    max_lon REAL,
+    coords BLOB,
+    FOREIGN KEY (id) REFERENCES ways(id)
+)'''
+# Coordinates of the nodes of the ways, in order, used to build the way_geometry table from the
+# loaded tables
+WAY_COORDS_QUERY = '''SELECT wn.id, n.lat, n.lon
+                      FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id
+                      {}
+                      ORDER BY wn.id, wn.position'''
+
+# Statements used to keep the R*Tree tables updated when single elements change
+NODE_RTREE_UPDATE = '''INSERT OR REPLACE INTO nodes_rtree
+                       SELECT id, lat, lat, lon, lon FROM nodes WHERE id = ? AND lat IS NOT NULL'''
+WAY_RTREE_UPDATE = '''INSERT OR REPLACE INTO ways_rtree
+                      SELECT wn.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon)
+                      FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id
+                      WHERE wn.id = ? GROUP BY wn.id'''
+
+
+def create_tables(conn, normalized=False):
     """
-    Creates a SQLite database from the OSM data
+    Creates the tables of the database, dropping them first if they already exist
 
     Args:
-        dbName: a SQLite database name, ex: 'example.db'
+        conn: sqlite3 Connection object
+        normalized: if True, creates the normalized layout (NORMALIZED_SCHEMA)
 
     Returns:
         Nothing
     """
-    conn = sqlite3.Connection(dbname)
     cursor = conn.cursor()
-    sqlCommands = '''CREATE TABLE nodes (
-        id INTEGER PRIMARY KEY NOT NULL,
-        lat REAL,
-        lon REAL,
-        user TEXT,
-        uid INTEGER,
-        version INTEGER,
-        changeset INTEGER,
-        timestamp TEXT
-    );
-
-    CREATE TABLE nodes_tags (
-        id INTEGER,
-        key TEXT,
-        value TEXT,
-        type TEXT,
-        FOREIGN KEY (id) REFERENCES nodes(id)
-    );
-
-    CREATE TABLE ways (
-        id INTEGER PRIMARY KEY NOT NULL,
-        user TEXT,
-        uid INTEGER,
-        version TEXT,
-        changeset INTEGER,
-        timestamp TEXT
-    );
-
-    CREATE TABLE ways_tags (
-        id INTEGER NOT NULL,
-        key TEXT NOT NULL,
-        value TEXT NOT NULL,
-        type TEXT,
-        FOREIGN KEY (id) REFERENCES ways(id)
-    );
-
-    CREATE TABLE ways_nodes (
-        id INTEGER NOT NULL,
-        node_id INTEGER NOT NULL,
-        position INTEGER NOT NULL,
-        FOREIGN KEY (id) REFERENCES ways(id),
-        FOREIGN KEY (node_id) REFERENCES nodes(id)
-    )
-    '''
-    sqlCommands = sqlCommands.split(';')
+    names = ([table for table, fields in TABLES] + SPATIAL_TABLES + ['way_geometry'] +
+             loadstats.STATS_TABLES + [table for table, fields in NORMALIZED_TABLES.values()] +
+             [table for table, fields in DICTIONARY_TABLES] + ['load_checkpoint'])
+    for kind, name in cursor.execute("SELECT type, name FROM sqlite_master "
+                                     "WHERE type IN ('table', 'view')").fetchall():
+        if name in names: # Views and tables of both layouts
+            cursor.execute('DROP {} IF EXISTS {}'.format(kind.upper(), name))
+    conn.commit()
+    if normalized is True:
+        for sqlCommand in NORMALIZED_SCHEMA:
+            cursor.execute(sqlCommand)
+        conn.commit()
+        return
+    sqlCommands = SQL_SCHEMA.split(';')
     for s in sqlCommands:
         try:
             cursor.execute(s)
@@ -66,18 +292,547 @@ def execute(dbname):
         finally:
             conn.commit()
 
+
+def is_normalized(conn):
+    """
+    Checks if a database uses the normalized layout
+    """
+    return has_table(conn, 'nodes_data')
+
+
+class Dictionaries(object):
+    """
+    Interners of the dictionary tables of the normalized layout, used to convert the rows of
+    the tables of SQL_SCHEMA to the rows of the normalized tables while they are loaded
+    """
+
+    def __init__(self):
+        self.users = osmparser.Interner() # (uid, user)
+        self.keys = osmparser.Interner() # (key, type)
+        self.values = osmparser.Interner()
+
+    def normalize(self, table, rows):
+        """
+        Converts rows of a table of SQL_SCHEMA (in the TABLES fields order) to rows of its
+        normalized table (see NORMALIZED_TABLES)
+        """
+        if table == 'nodes':
+            intern = self.users.intern
+            return [(id_, lat, lon, intern((uid, user)), version, changeset, timestamp)
+                    for id_, lat, lon, user, uid, version, changeset, timestamp in rows]
+        if table == 'ways':
+            intern = self.users.intern
+            return [(id_, intern((uid, user)), version, changeset, timestamp)
+                    for id_, user, uid, version, changeset, timestamp in rows]
+        if table in ('nodes_tags', 'ways_tags'):
+            internKey = self.keys.intern
+            internValue = self.values.intern
+            return [(id_, internKey((key, tp)), internValue(value))
+                    for id_, key, value, tp in rows]
+        return rows
+
+    def load(self, conn):
+        """
+        Loads the values already stored in the dictionary tables (used to resume a load)
+        """
+        self.users.preload(((id_, (str(uid) if uid is not None else None, user))
+                            for id_, uid, user in conn.execute(
+                                'SELECT id, uid, user FROM users ORDER BY id')))
+        self.keys.preload(((id_, (key, tp)) for id_, key, tp in conn.execute(
+            'SELECT id, key, type FROM tag_keys ORDER BY id')))
+        self.values.preload(conn.execute('SELECT id, value FROM tag_values ORDER BY id'))
+
+    def insert_pending(self, cursor):
+        """
+        Inserts the values interned since the last call in the dictionary tables
+        """
+        for (table, fields), interner in zip(DICTIONARY_TABLES,
+                                             (self.users, self.keys, self.values)):
+            insert_rows(cursor, table, fields, interner.take_pending())
+
+
+def bump_generation(conn):
+    """
+    Increments the load generation of the database (PRAGMA user_version), so the query results
+    cached by the sqloperations module are invalidated, should be called after every change
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        The new generation
+    """
+    generation = conn.execute('PRAGMA user_version').fetchone()[0] + 1
+    conn.execute('PRAGMA user_version = {}'.format(generation))
+    return generation
+
+
+def create_indexes(conn, analyze=True):
+    """
+    Creates the indexes of the database, should be called after the data is loaded
+    Can also be used on an existing database, the indexes that already exist are kept
+
+    Args:
+        conn: sqlite3 Connection object
+        analyze: if True, runs ANALYZE so the query planner knows the indexes statistics
+
+    Returns:
+        Nothing
+    """
+    cursor = conn.cursor()
+    for sqlCommand in (NORMALIZED_INDEXES if is_normalized(conn) else INDEXES):
+        cursor.execute(sqlCommand)
+    conn.commit()
+    if analyze is True:
+        cursor.execute('ANALYZE')
+        conn.commit()
+
+
+def create_spatial_index(conn):
+    """
+    Creates and fills the R*Tree tables (SPATIAL_TABLES), should be called after the data
+    is loaded
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        Nothing
+    """
+    cursor = conn.cursor()
+    for table in SPATIAL_TABLES:
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
+    for sqlCommand in SPATIAL_SCHEMA + SPATIAL_LOAD:
+        cursor.execute(sqlCommand)
+    conn.commit()
+
+
+def create_way_geometry_table(conn):
+    """
+    Creates the way_geometry table, dropping it first if it already exists
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        Nothing
+    """
+    conn.execute('DROP TABLE IF EXISTS way_geometry')
+    conn.execute(WAY_GEOMETRY_SCHEMA)
+    conn.commit()
+
+
+def way_geometry_row(id_, coords):
+    """
+    Creates a row of the way_geometry table
+
+    Args:
+        id_: way id
+        coords: list of (lat, lon) tuples, in degrees, in the order of the way
+
+    Returns:
+        A tuple in the WAY_GEOMETRY_FIELDS order
+    """
+    return (id_,) + geometry.way_geometry(coords) + (geometry.encode_coords(coords),)
+
+
+def load_way_geometry(conn, fname=osmparser.WAY_GEOMETRY_PATH, csvPath=osmparser.NODES_PATH,
+                      batchSize=BATCH_SIZE):
+    """
+    Fills the way_geometry table from the ways geometry CSV file written by osmparser (with
+    the node locations stored, see osmparser.execute), so the geometry computed while the
+    file was parsed isn't computed again
+
+    Args:
+        conn: sqlite3 Connection object
+        fname: ways geometry CSV file
+        csvPath: the geometry file is ignored if it's older than this CSV file (it was written
+                 with other CSV files)
+        batchSize: number of rows inserted at once
+
+    Returns:
+        True if the file was loaded, False if it doesn't exist or is outdated
+    """
+    if not os.path.exists(fname) or (os.path.exists(csvPath) and
+                                     os.path.getmtime(fname) < os.path.getmtime(csvPath)):
+        return False
+    create_way_geometry_table(conn)
+    cursor = conn.cursor()
+    with open(fname, 'r', encoding='utf-8', newline='') as csvFile:
+        reader = csv.reader(csvFile)
+        header = next(reader)
+        if header != WAY_GEOMETRY_FIELDS:
+            raise Exception("The columns of {} {} don't match the table columns {}".format(
+                fname, header, WAY_GEOMETRY_FIELDS))
+        while True:
+            rows = [row[:-1] + [bytes.fromhex(row[-1])]
+                    for row in itertools.islice(reader, batchSize)]
+            if not rows:
+                break
+            insert_rows(cursor, 'way_geometry', WAY_GEOMETRY_FIELDS, rows)
+    conn.commit()
+    return True
+
+
+def build_way_geometry(conn, wayIds=None, batchSize=BATCH_SIZE):
+    """
+    Fills the way_geometry table using the loaded nodes and ways_nodes tables
+
+    Args:
+        conn: sqlite3 Connection object
+        wayIds: if given, only the geometry of these ways is (re)built, the table must exist,
+                if not, the table is created and every way is built
+        batchSize: number of rows inserted at once
+
+    Returns:
+        Nothing
+    """
+    if wayIds is None:
+        create_way_geometry_table(conn)
+        query = conn.execute(WAY_COORDS_QUERY.format(''))
+    else:
+        wayIds = list(wayIds)
+        conn.executemany('DELETE FROM way_geometry WHERE id = ?', [(id_,) for id_ in wayIds])
+        query = conn.execute(WAY_COORDS_QUERY.format('WHERE wn.id IN ({})'.format(
+            ', '.join('?' * len(wayIds)))), wayIds) if wayIds else iter([])
+    cursor = conn.cursor()
+    rows = []
+    for id_, coords in itertools.groupby(query, key=lambda row: row[0]):
+        rows.append(way_geometry_row(id_, [(lat, lon) for _, lat, lon in coords]))
+        if len(rows) >= batchSize:
+            insert_rows(cursor, 'way_geometry', WAY_GEOMETRY_FIELDS, rows)
+            rows = []
+    insert_rows(cursor, 'way_geometry', WAY_GEOMETRY_FIELDS, rows)
+    if wayIds is None:
+        conn.commit()
+
+
+def has_table(conn, table):
+    """
+    Checks if a database has a table
+
+    Args:
+        conn: sqlite3 Connection object
+        table: name of the table
+
+    Returns:
+        True if the table exists
+    """
+    query = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (table,))
+    return query.fetchone()[0] == 1
+
+
+def has_spatial_index(conn):
+    """
+    Checks if a database has the R*Tree tables
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        True if the tables exist
+    """
+    query = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ({})".format(
+        ', '.join('?' * len(SPATIAL_TABLES))), SPATIAL_TABLES)
+    return query.fetchone()[0] == len(SPATIAL_TABLES)
+
+
+def start_load(conn):
+    """
+    Prepares a connection for a bulk load: explicit transactions and the LOAD_PRAGMAS
+
+    Args:
+        conn: sqlite3 Connection object
+
+    Returns:
+        The previous isolation level of the connection, to be given to finish_load
+    """
+    isolation = conn.isolation_level
+    conn.isolation_level = None # Transactions are handled explicitly
+    for pragma in LOAD_PRAGMAS:
+        conn.execute(pragma)
+    return isolation
+
+
+def finish_load(conn, isolation):
+    """
+    Restores a connection prepared by start_load, the batch that was being inserted when the
+    load failed (if any) is rolled back
+
+    Args:
+        conn: sqlite3 Connection object
+        isolation: isolation level returned by start_load
+
+    Returns:
+        Nothing
+    """
+    if conn.in_transaction:
+        conn.execute('ROLLBACK')
+    for pragma in DEFAULT_PRAGMAS:
+        conn.execute(pragma)
+    conn.isolation_level = isolation
+
+
+def execute(dbname, batchSize=BATCH_SIZE, indexes=True, spatial=True, wayGeometry=False,
+            stats=True, normalized=False, resume=False):
+    """
+    Creates a SQLite database from the OSM data
+    The CSV files are read and inserted in batches of rows, so the memory used doesn't depend
+    on the size of the files, and the tables keep the schema declared in SQL_SCHEMA
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        batchSize: number of rows inserted by each transaction
+        indexes: if False, the indexes aren't created (faster, for throwaway databases)
+        spatial: if False, the R*Tree tables aren't created
+        wayGeometry: if True, the way_geometry table is loaded from the ways geometry CSV file
+                     (see load_way_geometry), or built after the load when it doesn't exist
+                     or is outdated
+        stats: if True, the statistics tables are created (see the loadstats module), from the
+               statistics file written with the CSV files, or computed from the loaded tables
+               when it doesn't exist or is outdated
+        normalized: if True, the data is stored in the normalized layout (see NORMALIZED_SCHEMA)
+        resume: if True and the database has an interrupted load, the load continues from the
+                last committed batch of each CSV file, instead of creating the tables again
+
+    Returns:
+        Nothing
+    """
+    conn = sqlite3.Connection(dbname)
+    loaded = {}
+    if resume is True and has_table(conn, 'load_checkpoint'):
+        normalized = is_normalized(conn) # The layout of the interrupted load is kept
+        loaded = dict(conn.execute('SELECT fname, rows FROM load_checkpoint').fetchall())
+    else:
+        create_tables(conn, normalized)
+        conn.execute(LOAD_CHECKPOINT_SCHEMA)
+        conn.commit()
+    dictionaries = Dictionaries() if normalized is True else None
+    if dictionaries is not None and loaded:
+        dictionaries.load(conn)
+
     CSV_FILES = ['nodes.csv', 'nodes_tags.csv', 'ways.csv', 'ways_nodes.csv', 'ways_tags.csv']
-    TABLE_NAMES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags']
-    NAMES = zip(CSV_FILES, TABLE_NAMES)
+    NAMES = zip(CSV_FILES, TABLES)
+
+    isolation = start_load(conn)
+    try:
+        for fname, (table, fields) in NAMES:
+            load_csv(conn, fname, table, fields, batchSize, dictionaries,
+                     skip=loaded.get(fname, 0), checkpoint=True)
+    finally:
+        finish_load(conn, isolation)
+    conn.execute('DROP TABLE load_checkpoint')
+    conn.commit()
+    if indexes is True:
+        create_indexes(conn) # Indexes are built only after the load, it's faster
+    if spatial is True:
+        create_spatial_index(conn)
+    if wayGeometry is True and not load_way_geometry(conn, batchSize=batchSize):
+        build_way_geometry(conn, batchSize=batchSize)
+    if stats is True:
+        if not loadstats.load_file(conn, osmparser.STATS_PATH, osmparser.NODES_PATH):
+            loadstats.compute(conn)
+        conn.commit()
+    bump_generation(conn)
+
+    conn.close()
+
+
+def load_csv(conn, fname, table, fields, batchSize=BATCH_SIZE, dictionaries=None, skip=0,
+             checkpoint=False):
+    """
+    Inserts the rows of a CSV file in a table, in batches of rows, each batch inside an
+    explicit transaction
+
+    Args:
+        conn: sqlite3 Connection object prepared by start_load
+        fname: CSV file, with a header row with the same columns as fields
+        table: name of the table
+        fields: list of the columns names
+        batchSize: number of rows inserted by each transaction
+        dictionaries: a Dictionaries object, if given the rows are inserted in the normalized
+                      table (see NORMALIZED_TABLES)
+        skip: number of rows at the start of the file that were already loaded
+        checkpoint: if True, the number of loaded rows is saved in the load_checkpoint table
+                    with each batch
+
+    Returns:
+        The number of loaded rows (including the skipped ones)
+    """
+    cursor = conn.cursor()
+    count = skip
+    with open(fname, 'r', encoding='utf-8', newline='') as csvFile:
+        reader = csv.reader(csvFile)
+        header = next(reader)
+        if header != list(fields):
+            raise Exception("The columns of {} {} don't match the table columns {}".format(
+                fname, header, fields))
+        next(itertools.islice(reader, skip, skip), None) # Skips the rows already loaded
+        while True:
+            rows = list(itertools.islice(reader, batchSize))
+            if not rows:
+                break
+            cursor.execute('BEGIN')
+            if dictionaries is None:
+                insert_rows(cursor, table, fields, rows)
+            else:
+                rows = dictionaries.normalize(table, rows)
+                dictionaries.insert_pending(cursor)
+                insert_rows(cursor, *NORMALIZED_TABLES[table], rows=rows)
+            count += len(rows)
+            if checkpoint is True:
+                cursor.execute('INSERT OR REPLACE INTO load_checkpoint VALUES (?, ?)',
+                               (fname, count))
+            cursor.execute('COMMIT')
+    return count
+
+
+def insert_rows(cursor, table, fields, rows):
+    """
+    Inserts a batch of rows in a table using a single executemany call
+
+    Args:
+        cursor: sqlite3 Cursor object
+        table: name of the table
+        fields: list of the columns names, in the same order as the values of the rows
+        rows: list of tuples of values
 
-    for fname, table in NAMES:
-        df = pd.read_csv(fname, encoding='utf-8')
-        df.to_sql(table, conn, if_exists='replace', index=False)
-        # Uses pandas to handle secure database insertion.
-        # Can be a problem if the data is bigger than the available memory,
-        # But for this project it works perfectly.
+    Returns:
+        Nothing
+    """
+    sqlCommand = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        table, ', '.join('"{}"'.format(f) for f in fields), ', '.join('?' * len(fields)))
+    cursor.executemany(sqlCommand, rows)
+
+
+def load_elements(conn, elements, batchSize=BATCH_SIZE, nodeStore=None, stats=None,
+                  dictionaries=None):
+    """
+    Inserts shaped elements directly in the database, in batches of rows, each batch inside
+    an explicit transaction
+
+    Args:
+        conn: sqlite3 Connection object, with the tables already created
+        elements: iterable of shaped elements, as returned by osmparser.shape_element
+        batchSize: number of buffered rows that triggers a batch insertion
+        nodeStore: if given, a nodestore.NodeLocationStore used to compute the geometry of the
+                   ways while they are loaded, inserted in the way_geometry table (it must exist)
+        stats: if given, a loadstats.LoadStats object updated with every element
+        dictionaries: a Dictionaries object, if given the rows are inserted in the normalized
+                      tables (see NORMALIZED_TABLES)
+
+    Returns:
+        The number of loaded elements
+    """
+    tables = TABLES + ([('way_geometry', WAY_GEOMETRY_FIELDS)] if nodeStore is not None else [])
+    buffers = {table: [] for table, fields in tables}
+    fieldsOf = dict(tables)
+    isolation = start_load(conn)
+    cursor = conn.cursor()
+
+    def flush():
+        cursor.execute('BEGIN')
+        for table, fields in tables:
+            if buffers[table]:
+                if dictionaries is not None and table in NORMALIZED_TABLES:
+                    rows = dictionaries.normalize(table, buffers[table])
+                    dictionaries.insert_pending(cursor)
+                    insert_rows(cursor, *NORMALIZED_TABLES[table], rows=rows)
+                else:
+                    insert_rows(cursor, table, fields, buffers[table])
+                buffers[table] = []
+        cursor.execute('COMMIT')
+
+    count = 0
+    buffered = 0
+    try:
+        for el in elements:
+            if not el:
+                continue
+            if 'node' in el:
+                parts = (('nodes', [el['node']]), ('nodes_tags', el['node_tags']))
+            else:
+                parts = (('ways', [el['way']]), ('ways_nodes', el['way_nodes']),
+                         ('ways_tags', el['way_tags']))
+            for table, rows in parts:
+                fields = fieldsOf[table]
+                buffers[table].extend(tuple(row[f] for f in fields) for row in rows)
+                buffered += len(rows)
+            if nodeStore is not None:
+                if 'node' in el:
+                    nodeStore.set(el['node']['id'], el['node']['lat'], el['node']['lon'])
+                else:
+                    coords = [coord for coord in (nodeStore.get(wn['node_id'])
+                                                  for wn in el['way_nodes'])
+                              if coord is not None]
+                    if coords: # Like build_way_geometry, ways without located nodes are left out
+                        buffers['way_geometry'].append(way_geometry_row(el['way']['id'], coords))
+            if stats is not None:
+                stats.add_element(el)
+            count += 1
+            if buffered >= batchSize:
+                flush()
+                buffered = 0
+        flush()
+    finally:
+        finish_load(conn, isolation)
+    return count
+
+
+def execute_direct(dbname, osmPath, fixedStreetNames={}, specialStreetOverrides={},
+                   fixedPostcodes={}, batchSize=BATCH_SIZE, indexes=True, spatial=True,
+                   wayGeometry=False, locations='dense', stats=True, normalized=False):
+    """
+    Creates a SQLite database directly from the OSM XML file, without the intermediate CSVs
 
+    Args:
+        dbname: a SQLite database name, ex: 'example.db'
+        osmPath: path and/or name of the OpenStreetMap XML file to parse
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        batchSize: number of buffered rows that triggers a batch insertion
+        indexes: if False, the indexes aren't created (faster, for throwaway databases)
+        spatial: if False, the R*Tree tables aren't created
+        wayGeometry: if True, the way_geometry table is built while the data is loaded, using a
+                     node locations store (see the nodestore module)
+        locations: mode of the node locations store, 'dense' or 'sparse'
+        stats: if True, the statistics tables are created with the statistics accumulated
+               while the data is loaded (see the loadstats module)
+        normalized: if True, the data is stored in the normalized layout (see NORMALIZED_SCHEMA)
+
+    Returns:
+        The number of loaded elements
+    """
+    conn = sqlite3.Connection(dbname)
+    create_tables(conn, normalized)
+    dictionaries = Dictionaries() if normalized is True else None
+    nodeStore = None
+    if wayGeometry is True:
+        create_way_geometry_table(conn)
+        nodeStore = nodestore.NodeLocationStore(osmparser.LOCATIONS_PATH, locations)
+    transform = osmparser.cleaning_transform(fixedStreetNames, specialStreetOverrides,
+                                             fixedPostcodes)
+    elements = (osmparser.shape_element(element, fixedStreetNames=fixedStreetNames,
+                                        specialStreetOverrides=specialStreetOverrides,
+                                        fixedPostcodes=fixedPostcodes, transform=transform)
+                for element in osmparser.get_element(osmPath, tags=('node', 'way')))
+    loadStats = loadstats.LoadStats() if stats is True else None
+    try:
+        count = load_elements(conn, elements, batchSize, nodeStore, loadStats, dictionaries)
+    finally:
+        if nodeStore is not None:
+            nodeStore.close()
+    if loadStats is not None:
+        loadstats.write_tables(conn, loadStats.table_rows())
+        conn.commit()
+    if indexes is True:
+        create_indexes(conn)
+    if spatial is True:
+        create_spatial_index(conn)
+    bump_generation(conn)
     conn.close()
+    return count
 
 if __name__ == '__main__':
     # If the module is used directly, execute the main function with standard arguments
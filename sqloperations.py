@@ -1,8 +1,441 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import hashlib
+import os
+import pickle
+import re
 import sqlite3
+import threading
 
-def execute(dbName, sqlCommands, commit=False):
+FETCH_SIZE = 10000 # Rows fetched at once by the streaming queries
+STATEMENT_CACHE = 256 # Prepared statements kept by each connection
+
+CACHE_ENTRIES = 128 # Results kept in memory by a ResultCache
+# Only commands starting with these words can be cached, if they don't change the database
+READ_ONLY = ('SELECT', 'WITH', 'VALUES', 'EXPLAIN')
+# Authorizer actions of the statements that don't change the database (see Session.is_read_only)
+READ_ONLY_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                     sqlite3.SQLITE_RECURSIVE}
+EXPLAIN_RE = re.compile(r'^\s*EXPLAIN(?:\s+QUERY\s+PLAN)?\s+', re.IGNORECASE)
+
+_local = threading.local() # The pool of each thread (see SessionPool), released when it ends
+
+
+class QueryError(sqlite3.Error):
+    """
+    Error raised when a statement fails, with the statement in the message
+    """
+
+    def __init__(self, error, statement):
+        super(QueryError, self).__init__('{} (statement: {})'.format(error, statement.strip()))
+        self.error = error
+        self.statement = statement
+
+
+def split_statements(sqlCommands):
+    """
+    Splits a string of SQL commands in statements, semicolons inside literals, quoted names
+    and comments don't split a statement
+
+    Args:
+        sqlCommands: string of commands (separated by a ;)
+
+    Returns:
+        A list of statements, empty statements are removed
+    """
+    statements = []
+    current = ''
+    parts = sqlCommands.split(';')
+    for i, part in enumerate(parts):
+        current += part
+        if i < len(parts) - 1:
+            current += ';'
+            if not sqlite3.complete_statement(current):
+                continue # The semicolon is inside a literal or a comment
+        if current.strip().rstrip(';').strip():
+            statements.append(current.strip())
+        current = ''
+    return statements
+
+
+class Session(object):
+    """
+    Reusable connection to a SQLite database
+
+    The prepared statements are cached by the connection (the same SQL text with different
+    parameters is only compiled once), so queries should use parameters (? or :name) instead
+    of formatting the values in the SQL text
+    """
+
+    def __init__(self, dbName, fetchSize=FETCH_SIZE, statementCache=STATEMENT_CACHE):
+        """
+        Args:
+            dbName: a SQLite database name, ex: 'example.db'
+            fetchSize: default number of rows fetched at once by iterate
+            statementCache: number of prepared statements kept by the connection
+        """
+        self.dbName = dbName
+        self.fetchSize = fetchSize
+        self.conn = sqlite3.connect(dbName, cached_statements=statementCache)
+        self.readOnly = {} # Memo of is_read_only, by statement
+
+    def execute(self, statement, params=()):
+        """
+        Executes a single statement
+
+        Args:
+            statement: SQL statement
+            params: sequence or dictionary with the values of the parameters
+
+        Returns:
+            The sqlite3 Cursor object
+        """
+        try:
+            return self.conn.execute(statement, params)
+        except sqlite3.Error as error:
+            raise QueryError(error, statement) from error
+
+    def executemany(self, statement, paramsList):
+        """
+        Executes a statement once for each set of parameters
+
+        Returns:
+            The sqlite3 Cursor object
+        """
+        try:
+            return self.conn.executemany(statement, paramsList)
+        except sqlite3.Error as error:
+            raise QueryError(error, statement) from error
+
+    def is_read_only(self, statement, params=()):
+        """
+        Checks if a statement doesn't change the database: it's compiled (not run) with an
+        authorizer that records every action it would do, so writes hidden after a CTE
+        (WITH ... DELETE) or in a trigger are found, the result is memoized by statement
+
+        Args:
+            statement: SQL statement
+            params: sequence or dictionary with the values of the parameters
+
+        Returns:
+            True if the statement only reads the database, False if it writes or can't be
+            compiled (ex: it uses a table created by a previous statement of the same script)
+        """
+        if statement not in self.readOnly:
+            actions = set()
+
+            def authorizer(action, arg1, arg2, dbName, source):
+                actions.add(action)
+                return sqlite3.SQLITE_OK
+
+            self.conn.set_authorizer(authorizer)
+            try:
+                self.conn.execute('EXPLAIN ' + EXPLAIN_RE.sub('', statement), params)
+            except sqlite3.Error:
+                return False
+            finally:
+                self.conn.set_authorizer(None)
+            self.readOnly[statement] = actions <= READ_ONLY_ACTIONS
+        return self.readOnly[statement]
+
+    def query(self, statement, params=()):
+        """
+        Executes a query and returns all the rows
+
+        Returns:
+            A list of tuples
+        """
+        return self.execute(statement, params).fetchall()
+
+    def iterate(self, statement, params=(), fetchSize=None):
+        """
+        Executes a query and yields its rows, fetching them in blocks, so the whole result is
+        never in memory
+
+        Args:
+            statement: SQL query
+            params: sequence or dictionary with the values of the parameters
+            fetchSize: number of rows fetched at once, defaults to the one of the session
+
+        Yields:
+            The rows, as tuples
+        """
+        cursor = self.execute(statement, params)
+        fetchSize = fetchSize or self.fetchSize
+        try:
+            while True:
+                rows = cursor.fetchmany(fetchSize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def script(self, sqlCommands, commit=False):
+        """
+        Executes many commands, separated by a ;
+
+        Args:
+            sqlCommands: string of commands (separated by a ;)
+            commit: True commits the changes, False doesn't
+
+        Returns:
+            A list of the result(s) of the query(ies)
+        """
+        results = []
+        try:
+            for statement in split_statements(sqlCommands):
+                results.append(self.query(statement))
+        except:
+            if commit is True:
+                self.conn.rollback()
+            raise
+        if commit is True:
+            self.conn.commit()
+        return results
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        """
+        Closes the connection, and removes the session from the pool if it's there (a session
+        is only used by its own thread, so it can only be in the pool of the current thread)
+        """
+        pool = getattr(_local, 'pool', None)
+        if pool is not None:
+            pool.remove(self)
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+class SessionPool(object):
+    """
+    Pooled sessions of a thread, by database path
+
+    Each thread has its own pool in a threading.local, so when the thread ends the pool is
+    released and its sessions are closed (a connection can only be used by its own thread)
+    """
+
+    def __init__(self):
+        self.sessions = {}
+
+    def get(self, dbName, fetchSize=FETCH_SIZE):
+        """
+        Returns the session of a database, opening it if it isn't in the pool
+        """
+        key = os.path.abspath(dbName)
+        if key not in self.sessions:
+            self.sessions[key] = Session(dbName, fetchSize)
+        return self.sessions[key]
+
+    def remove(self, session):
+        """
+        Removes a session from the pool, without closing it
+        """
+        for key, pooled in list(self.sessions.items()):
+            if pooled is session:
+                del self.sessions[key]
+
+    def close(self):
+        """
+        Closes every session of the pool
+        """
+        for session in list(self.sessions.values()):
+            session.close()
+
+    def __del__(self):
+        self.close()
+
+
+def get_pool():
+    """
+    Returns the session pool of the current thread
+    """
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = _local.pool = SessionPool()
+    return pool
+
+
+def get_session(dbName, fetchSize=FETCH_SIZE):
+    """
+    Returns a pooled session of a database, the same session is reused by every call of the
+    same thread, so the connection and its prepared statements are kept between calls, it's
+    closed when the thread ends (see SessionPool)
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        fetchSize: default number of rows fetched at once by the session's iterate
+
+    Returns:
+        A Session object
+    """
+    return get_pool().get(dbName, fetchSize)
+
+
+def close_sessions():
+    """
+    Closes every pooled session of the current thread (the sessions of the other threads are
+    closed when they end)
+    """
+    get_pool().close()
+
+
+def fingerprint(dbName):
+    """
+    Identifies the state of a database: its path, size, modification time and load generation
+    (PRAGMA user_version, incremented by the sqlcreator and osmchange modules)
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+
+    Returns:
+        A tuple, different after every change of the database
+    """
+    stat = os.stat(dbName)
+    generation = get_session(dbName).query('PRAGMA user_version')[0][0]
+    return (os.path.abspath(dbName), stat.st_size, stat.st_mtime_ns, generation)
+
+
+def normalize_sql(sqlCommands):
+    """
+    Normalizes SQL text for the cache keys: the statements are split and their whitespace is
+    collapsed (whitespace inside literals is collapsed too, so it's only used in keys)
+    """
+    return ';'.join(' '.join(statement.split()) for statement in split_statements(sqlCommands))
+
+
+def is_read_only(dbName, sqlCommands, params=()):
+    """
+    Returns True if every command is a query that doesn't change the database, the commands
+    are checked by the database itself (see Session.is_read_only)
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        sqlCommands: string of commands (separated by a ;)
+        params: values of the parameters, only allowed with a single command
+    """
+    statements = split_statements(sqlCommands)
+    if not statements or (params and len(statements) != 1):
+        return False
+    if not all(statement.lstrip('( \n\t').split(None, 1)[0].upper() in READ_ONLY
+               for statement in statements):
+        return False
+    session = get_session(dbName)
+    return all(session.is_read_only(statement, params) for statement in statements)
+
+
+class ResultCache(object):
+    """
+    Cache of query results: a LRU dictionary in memory and, optionally, a directory with one
+    pickle file for each result
+
+    The keys have the normalized SQL, the parameters and the fingerprint of the database, so
+    the results are invalidated automatically when the database changes
+    """
+
+    def __init__(self, maxEntries=CACHE_ENTRIES, cacheDir=None):
+        """
+        Args:
+            maxEntries: number of results kept in memory
+            cacheDir: directory of the on disk tier, None disables it
+        """
+        self.maxEntries = maxEntries
+        self.cacheDir = cacheDir
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    def key(self, dbName, sqlCommands, params=()):
+        """
+        Returns the key of a query
+        """
+        return (fingerprint(dbName), normalize_sql(sqlCommands), repr(params))
+
+    def path(self, key):
+        """
+        Returns the file of a key in the on disk tier
+        """
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, digest + '.pickle')
+
+    def get(self, key):
+        """
+        Returns a cached result, or None if it isn't cached
+        The results are stored as tuples, each call returns new lists, so changing a returned
+        result doesn't change the cached one
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return [list(rows) for rows in self.entries[key]]
+        if self.cacheDir is not None and os.path.exists(self.path(key)):
+            with open(self.path(key), 'rb') as f:
+                storedKey, result = pickle.load(f)
+            if storedKey == key:
+                self.diskHits += 1
+                self.remember(key, result)
+                return [list(rows) for rows in result]
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """
+        Stores a result in memory and on disk
+        """
+        result = tuple(tuple(rows) for rows in result) # A copy, see get
+        self.remember(key, result)
+        if self.cacheDir is not None:
+            with open(self.path(key), 'wb') as f:
+                pickle.dump((key, result), f, pickle.HIGHEST_PROTOCOL)
+
+    def remember(self, key, result):
+        """
+        Stores a result in memory, removing the least recently used one if the cache is full
+        """
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes every cached result, from memory and from disk
+        """
+        self.entries.clear()
+        if self.cacheDir is not None:
+            for name in os.listdir(self.cacheDir):
+                if name.endswith('.pickle'):
+                    os.remove(os.path.join(self.cacheDir, name))
+
+    def stats(self):
+        """
+        Returns a dictionary with the hits (memory and disk), misses and entries of the cache
+        """
+        lookups = self.hits + self.diskHits + self.misses
+        return {'hits': self.hits, 'diskHits': self.diskHits, 'misses': self.misses,
+                'entries': len(self.entries),
+                'hitRate': (self.hits + self.diskHits) / lookups if lookups else 0.0}
+
+
+default_cache = ResultCache() # Used by execute when cache is True
+
+
+def execute(dbName, sqlCommands, commit=False, params=(), cache=None):
     """
     Executes commands in a SQLite database, many commands can be executed, they just need
     to be separated by a ; (standard SQL synthax)
@@ -11,26 +444,102 @@ def execute(dbName, sqlCommands, commit=False):
         dbName: a SQLite database name, ex: 'example.db'
         sqlCommands: string of commands (separated by a ;)
         commit: True commits Changes, False doesn't
+        params: values of the parameters, only allowed with a single command
+        cache: a ResultCache, or True to use default_cache, the results of commands that don't
+               change the database are taken from it when they're there
 
     Returns:
         A list of the result(s) of the query(ies)
     """
 
-    conn = sqlite3.Connection(dbName)
-    cursor = conn.cursor()
-    sqlCommands = sqlCommands.split(';')
-    results = []
-    for s in sqlCommands:
+    if cache is not None and cache is not False:
+        cache = default_cache if cache is True else cache
         try:
-            cursor.execute(s)
-            query = cursor.fetchall()
-            results.append(query)
-        except:
-            print(s)
-        finally:
+            key = cache.key(dbName, sqlCommands, params)
+        except FileNotFoundError: # The database doesn't exist yet, it's created uncached
+            key = None
+        if key is not None and is_read_only(dbName, sqlCommands, params):
+            results = cache.get(key)
+            if results is None:
+                results = execute(dbName, sqlCommands, commit, params)
+                cache.put(key, results)
+            return results
+
+    session = get_session(dbName)
+    try:
+        if params:
+            statements = split_statements(sqlCommands)
+            if len(statements) != 1:
+                raise ValueError('Parameters can only be used with a single command')
+            results = [session.query(statements[0], params)]
             if commit is True:
-                conn.commit()
-    conn.close()
+                session.commit()
+            return results
+        return session.script(sqlCommands, commit)
+    finally:
+        if session.conn.in_transaction:
+            session.rollback() # Changes that weren't committed are discarded, like on close
+
+
+def iterate(dbName, sqlCommand, params=(), fetchSize=FETCH_SIZE):
+    """
+    Executes a query in a SQLite database and yields its rows, without loading the whole
+    result in memory
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        sqlCommand: a single SQL query
+        params: values of the parameters of the query
+        fetchSize: number of rows fetched at once
+
+    Yields:
+        The rows, as tuples
+    """
+    return get_session(dbName).iterate(sqlCommand, params, fetchSize)
+
+def features_in_bbox(dbName, bbox, key=None, value=None):
+    """
+    Finds the nodes inside and the ways that intersect a bounding box, using the R*Tree tables
+    created by the sqlcreator module
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        bbox: bounding box, a (minLat, minLon, maxLat, maxLon) tuple
+        key: if given, only features with a tag with this key are returned, ex: 'amenity'
+        value: if given, only features with a tag with this value are returned
+
+    Returns:
+        A list of (type, id, minLat, minLon, maxLat, maxLon) tuples, type is 'node' or 'way'
+        (for nodes the minimum and maximum coordinates are the same)
+    """
+    minLat, minLon, maxLat, maxLon = bbox
+    tagFilter = ''
+    tagParams = []
+    if key is not None:
+        tagFilter += ' AND t.key = ?'
+        tagParams.append(key)
+    if value is not None:
+        tagFilter += ' AND t.value = ?'
+        tagParams.append(value)
+    nodesQuery = '''SELECT 'node', n.id, n.lat, n.lon, n.lat, n.lon
+                    FROM nodes_rtree r JOIN nodes n ON n.id = r.id
+                    WHERE r.maxLat >= ? AND r.minLat <= ? AND r.maxLon >= ? AND r.minLon <= ?
+                    AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?'''
+    waysQuery = '''SELECT 'way', r.id, r.minLat, r.minLon, r.maxLat, r.maxLon
+                   FROM ways_rtree r
+                   WHERE r.maxLat >= ? AND r.minLat <= ? AND r.maxLon >= ? AND r.minLon <= ?'''
+    # The R*Tree stores 32 bits floats, rounded outwards, so the nodes are filtered again using
+    # their exact coordinates
+    bboxParams = [minLat, maxLat, minLon, maxLon]
+    if tagFilter:
+        nodesQuery += ' AND EXISTS (SELECT 1 FROM nodes_tags t WHERE t.id = n.id{})'.format(
+            tagFilter)
+        waysQuery += ' AND EXISTS (SELECT 1 FROM ways_tags t WHERE t.id = r.id{})'.format(
+            tagFilter)
+
+    session = get_session(dbName)
+    results = session.query(nodesQuery, bboxParams + bboxParams + tagParams)
+    results += session.query(waysQuery, bboxParams + tagParams)
     return results
 
 if __name__ == '__main__':
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled tag transforms, used by osmparser.shape_tags to clean the tags
+
+The cleaning rules are compiled once in a TagTransform, instead of being checked with a chain
+of conditions for every tag:
+    - the classification of each raw key (problematic characters, split in type and key) is
+      memoized, so it's done once for each distinct key instead of once for each tag
+    - the value rules of each (type, key) are merged in a single dictionary, so the value of a
+      tag is cleaned with one lookup
+New cleaners are added as rules (see TagTransform.add_map, add_drop, add_expansion and
+add_rule), not as new branches in the loop over the tags.
+"""
+
+import sys
+
+ANY_TYPE = None # Type of the rules that apply to a key with any type
+INVALID_POSTCODE = 'Invalid Postal Code' # Value given by audit_postcodes to the invalid codes
+DROP = () # Result of a rule that drops the tag
+
+
+class TagTransform(object):
+    """
+    Set of rules that classify the keys of the tags and rewrite (or drop) their values
+
+    The result of a value rule is one of:
+        - a string: the new value of the tag
+        - a list of (id, key, value, type) tuples: the tags that replace the tag (with their
+          own ids), DROP (an empty tuple) drops the tag
+    """
+
+    def __init__(self, problemChars, defaultType='regular'):
+        """
+        Args:
+            problemChars: a regular expression, tags with a key that matches it are dropped
+            defaultType: type used if the key doesn't have a type (a prefix before a ':')
+        """
+        self.problemChars = problemChars
+        self.defaultType = defaultType
+        self.values = {} # (type, key) -> value -> result
+        self.functions = {} # (type, key) -> list of functions
+        self.keys = {} # Memo: raw key -> (type, key, compiled rules), None if it's dropped
+        self.compiled = {} # Memo: (type, key) -> (values, functions), None without rules
+
+    def clear(self):
+        """
+        Forgets the memoized classifications, called when the rules change
+        """
+        self.keys.clear()
+        self.compiled.clear()
+
+    def add_map(self, tp, key, mapping):
+        """
+        Adds value rewrites to a key
+
+        Args:
+            tp: type of the key, ANY_TYPE applies them to every type
+            key: key, without the type
+            mapping: dictionary, old value -> new value
+        """
+        self.values.setdefault((tp, key), {}).update(mapping)
+        self.clear()
+
+    def add_drop(self, tp, key, values):
+        """
+        Drops the tags of a key with one of the values
+        """
+        self.add_map(tp, key, dict.fromkeys(values, DROP))
+
+    def add_expansion(self, tp, key, expansions):
+        """
+        Replaces the tags of a key with a value by a list of tags
+
+        Args:
+            tp: type of the key, ANY_TYPE applies them to every type
+            key: key, without the type
+            expansions: dictionary, value -> list of (id, key, value, type) tuples
+        """
+        self.add_map(tp, key, {value: tuple(tags) for value, tags in expansions.items()})
+
+    def add_rule(self, tp, key, function):
+        """
+        Adds a function rule to a key, the values not found in the rewrite maps are given to
+        the functions of the key (in the order they were added) until one returns a result
+        (see TagTransform), the results are memoized
+
+        Args:
+            tp: type of the key, ANY_TYPE applies it to every type
+            key: key, without the type
+            function: function(value) that returns a result, or None to keep the value
+        """
+        self.functions.setdefault((tp, key), []).append(function)
+        self.clear()
+
+    def compile_rules(self, tp, k):
+        """
+        Merges the rules of a (type, key) with the ANY_TYPE rules of the key, the rules of the
+        type have precedence
+
+        Returns:
+            (values, functions) tuple, or None if the key has no rules
+        """
+        if (tp, k) not in self.compiled:
+            values = dict(self.values.get((ANY_TYPE, k), {}))
+            values.update(self.values.get((tp, k), {}))
+            functions = self.functions.get((tp, k), []) + self.functions.get((ANY_TYPE, k), [])
+            self.compiled[tp, k] = (values, functions) if values or functions else None
+        return self.compiled[tp, k]
+
+    def classify(self, rawKey):
+        """
+        Splits a raw key in type and key (the type is the word before the first ':'), the
+        result is memoized
+
+        Returns:
+            (type, key, compiled rules) tuple, or None if the key has problematic characters
+        """
+        if rawKey not in self.keys:
+            if self.problemChars.search(rawKey):
+                self.keys[rawKey] = None
+            else:
+                tp, sep, k = rawKey.partition(':')
+                if not sep:
+                    tp, k = self.defaultType, rawKey
+                # Keys and types repeat on most tags, interning them keeps a single copy
+                tp, k = sys.intern(tp), sys.intern(k)
+                self.keys[rawKey] = (tp, k, self.compile_rules(tp, k))
+        return self.keys[rawKey]
+
+    def apply_functions(self, rules, v):
+        """
+        Calls the function rules for a value, memoizing the result in the compiled values
+        """
+        values, functions = rules
+        result = v
+        for function in functions:
+            output = function(v)
+            if output is not None:
+                result = output
+                break
+        values[v] = result
+        return result
+
+    def shape(self, tagElements, id_, tags, append):
+        """
+        Classifies and cleans the tags of an element and appends them
+
+        Args:
+            tagElements: tag XML elements (or objects with an attrib dictionary)
+            id_: id of the element
+            tags: list where the tags are appended
+            append: function used to append a tag, see osmparser.append_tag_dic
+
+        Returns:
+            Nothing
+        """
+        keys = self.keys
+        for item in tagElements:
+            attrib = item.attrib
+            rawKey = attrib['k']
+            entry = keys[rawKey] if rawKey in keys else self.classify(rawKey)
+            if entry is None:
+                continue # If we have problematics characters, ignore the tag
+            tp, k, rules = entry
+            v = attrib['v']
+            if rules is not None:
+                result = rules[0].get(v)
+                if result is None and rules[1]:
+                    result = self.apply_functions(rules, v)
+                if result is not None:
+                    if result.__class__ is str:
+                        v = result
+                    else:
+                        for tag in result:
+                            append(tags, *tag)
+                        continue
+            append(tags, id_, k, v, tp)
+
+    def rewrite(self, tags, id_, k, v, tp, append):
+        """
+        Cleans the value of an already classified tag and appends the result
+
+        Args:
+            tags: list where the tags are appended
+            id_: id of the element
+            k: key
+            v: value
+            tp: type
+            append: function used to append a tag, see osmparser.append_tag_dic
+
+        Returns:
+            Nothing
+        """
+        rules = self.compile_rules(tp, k)
+        if rules is not None:
+            result = rules[0].get(v)
+            if result is None and rules[1]:
+                result = self.apply_functions(rules, v)
+            if result is not None:
+                if result.__class__ is not str:
+                    for tag in result:
+                        append(tags, *tag)
+                    return
+                v = result
+        append(tags, id_, k, v, tp)
+
+
+def build_cleaning_transform(fixedStreetNames, specialStreetOverrides, fixedPostcodes,
+                             problemChars, defaultType='regular'):
+    """
+    Compiles the cleaning dictionaries in a TagTransform
+
+    Args:
+        fixedStreetNames: dictionary of fixed street names provided by the audit_streetnames module
+        specialStreetOverrides: dictionary of special street names that were fixed by hand
+        fixedPostcodes: dictionary of fixed postal codes provided by the audit_postcodes module
+        problemChars: a regular expression to search for problematic characters
+        defaultType: type to be used if no type is specified at the tag
+
+    Returns:
+        A TagTransform object
+    """
+    transform = TagTransform(problemChars, defaultType)
+    # A fixed street name has precedence over a special override
+    transform.add_expansion('addr', 'street', {
+        value: [(tag['id'], tag['key'], tag['value'], tag['type']) for tag in tags]
+        for value, tags in specialStreetOverrides.items()})
+    transform.add_map('addr', 'street', fixedStreetNames)
+    for key in ('postal_code', 'postcode'):
+        transform.add_map(ANY_TYPE, key, {value: fixed for value, fixed in fixedPostcodes.items()
+                                          if fixed != INVALID_POSTCODE})
+        transform.add_drop(ANY_TYPE, key, [value for value, fixed in fixedPostcodes.items()
+                                           if fixed == INVALID_POSTCODE])
+    return transform
+
@@ -0,0 +1,8 @@
+"""
+Makes the modules of the repository importable by the tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
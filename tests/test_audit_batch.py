@@ -0,0 +1,139 @@
+"""
+Compares the batch audits (audit_postcodes.audit_postcodes, audit_streetnames.audit_street_types
+and update_names) with the per value logic they replaced, kept here as the reference: the
+problematic values dictionaries must be the same, in the same order
+"""
+
+import random
+import re
+from collections import defaultdict
+import pytest
+import audit_postcodes
+import audit_streetnames
+
+postalCodeRe = re.compile(r'^\d{5}-\d{3}')
+
+
+def reference_test_postcode(value):
+    try:
+        testCode = int(value.replace('-', ''))
+        return audit_postcodes.POSTCODE_MIN <= testCode <= audit_postcodes.POSTCODE_MAX
+    except:
+        return False
+
+
+def reference_audit_postcode(postal_codes, value):
+    """
+    audit_postcode before the batch version
+    """
+    correct = postalCodeRe.search(value)
+    if correct:
+        if not reference_test_postcode(value): # If it's not in the acceptable range
+            postal_codes[value] = 'Invalid Postal Code'
+    if not correct: # If the postal code is not in the standard format
+        if len(value) == 8:
+            correctValue = value[:5] + '-' + value[5:]
+            if not reference_test_postcode(correctValue):
+                correctValue = 'Invalid Postal Code'
+        elif '.' in value:
+            correctValue = value.replace('.', '')
+            if not reference_test_postcode(correctValue):
+                correctValue = 'Invalid Postal Code'
+        else:
+            correctValue = 'Invalid Postal Code'
+        postal_codes[value] = (correctValue)
+
+
+def reference_audit_street_type(street_types, street_name):
+    """
+    audit_street_type before the batch version
+    """
+    m = audit_streetnames.street_type_re.search(street_name)
+    if m:
+        street_type = m.group()
+        if street_type not in audit_streetnames.expected:
+            street_types[street_type].add(street_name)
+
+
+def reference_update_name(name, mapping):
+    """
+    update_name before it was rewritten with str.partition
+    """
+    n = name.split(' ')
+    if n[0] in mapping.keys():
+        n[0] = mapping[n[0]]
+        name = n[0]
+        for word in n[1:]:
+            name = name + ' {}'.format(word)
+    return name
+
+
+POSTCODES = [
+    '80000-000', '80000-001', '83800-999', '83801-000', '79999-999', '80010-000',
+    '80000-0001', '80010-0000', '80010-000 ', '80010-000a', '83800-9999', # Regex prefix matches
+    '80000001', '80010000', '83800999', '83801000', '79999999', '99999999', '00000000',
+    '8001000a', '8001-000', '-8001000', ' 8001000', '+8001000', '80 10000', # 8 characters
+    '80.010-000', '8.0010000', '80.010.000', '80.010-00', '83.801-000', '.', '..', '80.0a0-000',
+    '80.010-000.', # Dotted
+    '', '8', '8001', '800100000', '8' * 30, '80010_000', '٣٣٣٣٣٣٣٣', '80010-00', 'abc', 'CEP']
+
+
+def random_postcodes(rand):
+    """
+    About 30 thousand random values, most of them near the formats handled by the audit
+    """
+    alphabet = '0123456789-. a+_٣x'
+    values = [''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 11)))
+              for _ in range(20000)]
+    values += ['{}{:04d}-{:03d}'.format(rand.choice('789'), rand.randint(0, 9999),
+                                        rand.randint(0, 999)) for _ in range(5000)]
+    values += ['{}{:07d}'.format(rand.choice('789'), rand.randint(0, 9999999))
+               for _ in range(5000)]
+    values += [value + rand.choice(['0', '-', '.', 'x']) for value in values[-2000:]]
+    return values
+
+
+@pytest.mark.parametrize('values', [POSTCODES, 'random'])
+def test_audit_postcodes(values):
+    if values == 'random':
+        values = POSTCODES + random_postcodes(random.Random(25))
+    expected = defaultdict(set)
+    for value in values:
+        reference_audit_postcode(expected, value)
+    actual = audit_postcodes.audit_postcodes(values)
+    assert actual == expected
+    assert list(actual) == list(expected)
+    # The per value version, now a wrapper of the batch one
+    single = defaultdict(set)
+    for value in values:
+        audit_postcodes.audit_postcode(single, value)
+    assert single == expected
+
+
+NAMES = ['Av. Brasil', 'Av Brasil', 'R. XV  de Novembro', 'rua', 'RUA  a', 'Rua b', 'Praça c',
+         'av x', 'Av.', ' Av x', 'R.\tx', 'Av.  ', '', ' ', 'R. ', 'Avenida', 'Rua rua RUA',
+         'Rodovia BR-277', 'BR-277', 'Estrada da Graciosa', 'estrada', 'Travessa Oliveira']
+
+
+def random_names(rand):
+    words = ['Av', 'Av.', 'R.', 'rua', 'RUA', 'Rua', 'Praça', 'x', '', ' ', '\t', 'São']
+    return [' '.join(rand.choice(words) for _ in range(rand.randint(1, 4)))
+            for _ in range(5000)] + [''.join(rand.choice('AvR. rua\t') for _ in range(8))
+                                      for _ in range(5000)]
+
+
+@pytest.mark.parametrize('names', [NAMES, 'random'])
+def test_street_names(names):
+    if names == 'random':
+        names = NAMES + random_names(random.Random(25))
+    expected = defaultdict(set)
+    for name in names:
+        reference_audit_street_type(expected, name)
+    actual = audit_streetnames.audit_street_types(names)
+    assert actual == expected
+    assert list(actual) == list(expected)
+
+    mapping = dict(audit_streetnames.mapping, Avenida='Av.') # Also maps an expected type
+    updated = audit_streetnames.update_names(names, mapping)
+    assert updated == {name: reference_update_name(name, mapping) for name in names}
+    assert all(audit_streetnames.update_name(name, mapping) == updated[name] for name in names)
@@ -0,0 +1,80 @@
+"""
+Memory ceiling of the streamed audits (audit_streetnames and audit_postcodes)
+
+Each audit runs in its own process over generated OSM XML files, its peak resident set size
+must stay under MEMORY_CEILING_MB and must not grow with the size of the file (only with the
+number of distinct street names and postal codes, which is fixed here)
+"""
+
+import os
+import subprocess
+import sys
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMORY_CEILING_MB = 100 # Includes the interpreter and the imported modules
+GROWTH_LIMIT_MB = 5 # Maximum growth of the peak when the file is 8 times larger
+DISTINCT_VALUES = 500 # Distinct street names and postal codes in the generated files
+
+AUDIT_SCRIPT = '''
+import sys
+import utils
+import {module}
+utils.reset_peak_rss()
+{module}.audit(sys.argv[1])
+print(utils.peak_rss())
+'''
+
+
+def write_osm(path, nodes):
+    """
+    Writes an OSM XML file with nodes tagged with street names and postal codes, and a way
+    for every 10 nodes
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for i in range(1, nodes + 1):
+            value = i % DISTINCT_VALUES
+            f.write('  <node id="{}" lat="-25.{:07d}" lon="-49.{:07d}" version="1" '
+                    'timestamp="2017-01-01T00:00:00Z" changeset="1" uid="1" user="u">\n'
+                    '    <tag k="addr:street" v="R. Numero {}"/>\n'
+                    '    <tag k="addr:postcode" v="8{:04d}{:03d}"/>\n'
+                    '  </node>\n'.format(i, i % 10 ** 7, i % 10 ** 7, value, value, value))
+        for i in range(1, nodes // 10 + 1):
+            f.write('  <way id="{}" version="1" timestamp="2017-01-01T00:00:00Z" changeset="1" '
+                    'uid="1" user="u">\n    <nd ref="{}"/>\n    <nd ref="{}"/>\n'
+                    '    <tag k="addr:street" v="Av. Numero {}"/>\n  </way>\n'.format(
+                        i, i, i + 1, i % DISTINCT_VALUES))
+        f.write('</osm>\n')
+
+
+def audit_peak(module, path):
+    """
+    Runs an audit in a new process and returns its peak memory usage in megabytes
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO] + [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.check_output([sys.executable, '-c', AUDIT_SCRIPT.format(module=module),
+                                      path], cwd=REPO, env=env)
+    peak = output.decode().strip().splitlines()[-1]
+    if peak == 'None':
+        pytest.skip('The peak memory usage can\'t be measured on this platform')
+    return float(peak)
+
+
+@pytest.fixture(scope='module')
+def osm_files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('osm')
+    small, large = str(directory / 'small.osm'), str(directory / 'large.osm')
+    write_osm(small, 20000)
+    write_osm(large, 160000)
+    return small, large
+
+
+@pytest.mark.parametrize('module', ['audit_streetnames', 'audit_postcodes'])
+def test_audit_memory_ceiling(module, osm_files):
+    small, large = osm_files
+    smallPeak = audit_peak(module, small)
+    largePeak = audit_peak(module, large)
+    assert largePeak < MEMORY_CEILING_MB
+    assert largePeak - smallPeak < GROWTH_LIMIT_MB
@@ -0,0 +1,148 @@
+"""
+Interrupted runs of osmparser.execute_checkpointed and sqlcreator.execute, resumed from their
+checkpoints: the CSV files and the tables must be the same as the ones of an uninterrupted run
+"""
+
+import os
+import sqlite3
+import pytest
+import osmparser
+import sqlcreator
+
+
+class Interrupted(Exception):
+    """
+    Simulated crash of a run
+    """
+
+
+def write_osm(path, nodes=300, ways=60, noteSize=0):
+    """
+    Writes an OSM XML file with tagged and untagged nodes, and ways of 5 nodes, noteSize is
+    the length of a note tag added to every node
+    """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    for id_ in range(1, nodes + 1):
+        lines.append('  <node id="{}" lat="{:.7f}" lon="{:.7f}" version="1" changeset="{}" '
+                     'timestamp="2017-01-01T00:00:00Z" user="u{}" uid="{}">'.format(
+                         id_, -25.4 - id_ * 1e-4, -49.2 - id_ * 1e-4, id_ % 7, id_ % 5, id_ % 5))
+        if id_ % 3 == 0:
+            lines.append('    <tag k="amenity" v="cafe {}"/>'.format(id_ % 11))
+            lines.append('    <tag k="addr:street" v="Rua {}"/>'.format(id_ % 13))
+        if noteSize:
+            lines.append('    <tag k="note" v="{}"/>'.format('x' * noteSize))
+        lines.append('  </node>')
+    for id_ in range(1, ways + 1):
+        lines.append('  <way id="{}" version="2" changeset="3" '
+                     'timestamp="2017-01-02T00:00:00Z" user="u{}" uid="{}">'.format(
+                         1000 + id_, id_ % 4, id_ % 4))
+        lines.extend('    <nd ref="{}"/>'.format((id_ * 5 + i) % nodes + 1) for i in range(5))
+        lines.append('    <tag k="highway" v="{}"/>'.format(('residential', 'service')[id_ % 2]))
+        lines.append('  </way>')
+    path.write('\n'.join(lines + ['</osm>']) + '\n')
+    return str(path)
+
+
+def read_csvs():
+    """
+    Returns the contents of the CSV files of the working directory
+    """
+    contents = []
+    for path in osmparser.CSV_PATHS:
+        with open(path, 'rb') as csvFile:
+            contents.append(csvFile.read())
+    return contents
+
+
+def interrupt_after(monkeypatch, module, name, calls):
+    """
+    Replaces a function of a module by one that raises Interrupted on the given call
+    """
+    function = getattr(module, name)
+    count = [0]
+
+    def wrapper(*args, **kwargs):
+        count[0] += 1
+        if count[0] == calls:
+            raise Interrupted()
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, wrapper)
+
+
+@pytest.mark.parametrize('stopAfter', [1, 999, 1001, 1600, 2001, 2599])
+def test_resumed_csvs_match_an_uninterrupted_run(tmpdir, monkeypatch, stopAfter):
+    """
+    The writer reads batches of VALIDATE_BATCH_SIZE elements, the notes make a batch longer
+    than the CHECKPOINT_MARGIN, searched for the element of the checkpoint when resuming
+    """
+    monkeypatch.chdir(tmpdir)
+    osmPath = write_osm(tmpdir.join('test.osm'), nodes=2000, ways=600, noteSize=4000)
+    assert osmparser.execute_checkpointed(osmPath, checkpointEvery=550) == 2600
+    expected = read_csvs()
+    assert not os.path.exists(osmparser.CHECKPOINT_PATH)
+
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, osmparser, 'shape_element_rows', stopAfter)
+        with pytest.raises(Interrupted):
+            osmparser.execute_checkpointed(osmPath, checkpointEvery=550)
+    # No checkpoint before the first batch is written, and elements are written after the
+    # last checkpoint, before the crash
+    batchSize = osmparser.VALIDATE_BATCH_SIZE
+    assert os.path.exists(osmparser.CHECKPOINT_PATH) is (stopAfter > batchSize)
+    assert read_csvs() != expected
+    assert osmparser.execute_checkpointed(osmPath, checkpointEvery=550, resume=True) == 2600
+    assert read_csvs() == expected
+    assert not os.path.exists(osmparser.CHECKPOINT_PATH)
+    # The statistics file of a resumed run would only count the elements after the checkpoint
+    assert os.path.exists(osmparser.STATS_PATH) is (stopAfter <= batchSize)
+
+
+def test_resume_needs_the_same_input(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    osmPath = write_osm(tmpdir.join('test.osm'), nodes=1500)
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, osmparser, 'shape_element_rows', 1200)
+        with pytest.raises(Interrupted):
+            osmparser.execute_checkpointed(osmPath, checkpointEvery=25)
+    assert os.path.exists(osmparser.CHECKPOINT_PATH)
+    write_osm(tmpdir.join('test.osm'), nodes=1510)
+    with pytest.raises(Exception, match='another input file'):
+        osmparser.execute_checkpointed(osmPath, checkpointEvery=25, resume=True)
+
+
+def read_tables(dbName):
+    """
+    Returns the sorted rows of every table and view of a database
+    """
+    conn = sqlite3.Connection(dbName)
+    names = [name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name")]
+    tables = {name: sorted(conn.execute('SELECT * FROM "{}"'.format(name)).fetchall(),
+                           key=repr) for name in names}
+    conn.close()
+    return tables
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+@pytest.mark.parametrize('stopAfter', [1, 4, 9, 20])
+def test_resumed_load_matches_an_uninterrupted_load(tmpdir, monkeypatch, normalized, stopAfter):
+    monkeypatch.chdir(tmpdir)
+    osmparser.execute(write_osm(tmpdir.join('test.osm')))
+    sqlcreator.execute('expected.db', batchSize=40, wayGeometry=True, normalized=normalized)
+    expected = read_tables('expected.db')
+    assert 'load_checkpoint' not in expected
+
+    # Each batch is inserted by one call, the normalized layout also inserts the dictionaries
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, sqlcreator, 'insert_rows', stopAfter)
+        with pytest.raises(Interrupted):
+            sqlcreator.execute('resumed.db', batchSize=40, wayGeometry=True,
+                               normalized=normalized)
+    conn = sqlite3.Connection('resumed.db')
+    assert sqlcreator.has_table(conn, 'load_checkpoint')
+    conn.close()
+    # The layout of the interrupted load is kept, whatever the argument
+    sqlcreator.execute('resumed.db', batchSize=40, wayGeometry=True,
+                       normalized=not normalized, resume=True)
+    assert read_tables('resumed.db') == expected
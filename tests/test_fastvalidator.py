@@ -0,0 +1,182 @@
+"""
+Compares the compiled validator (fastvalidator) with cerberus, which it replaces in the
+validation of the shaped elements: both must accept the same documents and report the same
+errors, with the same messages and in the same format
+"""
+
+import os
+import random
+import pytest
+
+cerberus = pytest.importorskip('cerberus')
+
+import fastvalidator
+import osmparser
+import schema
+
+NODE = {'id': '1', 'lat': '-25.43', 'lon': '-49.27', 'user': 'u', 'uid': '7', 'version': '2',
+        'changeset': '11', 'timestamp': '2017-01-01T00:00:00Z'}
+WAY = {'id': '5', 'user': 'u', 'uid': '7', 'version': '1', 'changeset': '11',
+       'timestamp': '2017-01-01T00:00:00Z'}
+TAG = {'id': '1', 'key': 'street', 'value': 'Rua XV', 'type': 'addr'}
+WAY_NODE = {'id': '5', 'node_id': '1', 'position': '0'}
+
+# Schema with the regex rule, not used by schema.py, at the top level and in sub-documents
+REGEX_SCHEMA = {
+    'code': {'type': 'string', 'regex': r'\d{5}-\d{3}'},
+    'number': {'type': 'integer', 'coerce': int},
+    'address': {'type': 'dict', 'schema': {'street': {'type': 'string', 'regex': r'[A-Z]\w*',
+                                                      'required': True}}},
+    'codes': {'type': 'list', 'schema': {'type': 'string', 'regex': r'\d+'}}
+}
+
+
+def assert_same_errors(document, schema_=schema.schema):
+    """
+    Validates a document with both validators and compares the results
+    """
+    expected = cerberus.Validator(schema_)
+    actual = fastvalidator.Validator(schema_)
+    assert actual.validate(document) == expected.validate(document)
+    assert actual.errors == expected.errors
+
+
+def test_valid_documents():
+    assert_same_errors({'node': dict(NODE), 'node_tags': [dict(TAG), dict(TAG, key='name')]})
+    assert_same_errors({'node': dict(NODE), 'node_tags': []})
+    assert_same_errors({'way': dict(WAY), 'way_nodes': [dict(WAY_NODE)],
+                        'way_tags': [dict(TAG, id='5')]})
+    # Values that are already of the final types
+    assert_same_errors({'node': dict(NODE, id=1, lat=-25.43, lon=-49.27, uid=7, changeset=11),
+                        'node_tags': [dict(TAG, id=1)]})
+
+
+@pytest.mark.parametrize('field, value', [('user', 5), ('version', 2), ('timestamp', []),
+                                          ('lat', [1.0]), ('id', {'a': 1})])
+def test_type_errors(field, value):
+    assert_same_errors({'node': dict(NODE, **{field: value}), 'node_tags': []})
+    assert_same_errors({'node': dict(NODE), 'node_tags': [dict(TAG, **{'key': value})]})
+    assert_same_errors({'node': 'not a dict', 'node_tags': 'not a list'})
+    assert_same_errors({'way': dict(WAY), 'way_nodes': [5], 'way_tags': [dict(TAG)]})
+
+
+@pytest.mark.parametrize('field', sorted(NODE))
+def test_missing_fields(field):
+    node = {k: v for k, v in NODE.items() if k != field}
+    assert_same_errors({'node': node, 'node_tags': []})
+    tag = {k: v for k, v in TAG.items() if k != 'value'}
+    assert_same_errors({'node': dict(NODE), 'node_tags': [tag]})
+
+
+def test_unknown_fields():
+    assert_same_errors({'node': dict(NODE, extra='x'), 'node_tags': [dict(TAG, extra=1)]})
+    assert_same_errors({'node': dict(NODE), 'relation': {}})
+
+
+@pytest.mark.parametrize('field', sorted(NODE))
+def test_null_values(field):
+    assert_same_errors({'node': dict(NODE, **{field: None}), 'node_tags': []})
+
+
+def test_null_sub_documents():
+    assert_same_errors({'node': None})
+    assert_same_errors({'node': dict(NODE), 'node_tags': None})
+    assert_same_errors({'node': dict(NODE), 'node_tags': [None, dict(TAG, type=None)]})
+    assert_same_errors({'way': None, 'way_nodes': None, 'way_tags': None})
+
+
+@pytest.mark.parametrize('value', ['x', '1.5', '', ' ', 'nan1', None, [1]])
+def test_coercion_errors(value):
+    assert_same_errors({'node': dict(NODE, id=value, lat=value, changeset=value),
+                        'node_tags': []})
+    assert_same_errors({'way': dict(WAY), 'way_nodes': [dict(WAY_NODE, position=value)],
+                        'way_tags': []})
+    # Top level fields, cerberus reports their coercion errors first
+    assert_same_errors({'number': value}, REGEX_SCHEMA)
+
+
+@pytest.mark.parametrize('document', [
+    {'code': '80010-000'}, {'code': '80010000'}, {'code': '80010-0001'}, {'code': 'x80010-000'},
+    {'code': 80010000}, {'address': {'street': 'Rua'}}, {'address': {'street': 'rua'}},
+    {'address': {'street': ''}}, {'codes': ['1', '12', 'a', '1a', None, 3]},
+    {'code': '1', 'address': {}, 'codes': [''], 'number': 'x'}])
+def test_regex_errors(document):
+    assert_same_errors(document, REGEX_SCHEMA)
+
+
+def test_random_documents():
+    """
+    Mutates valid documents at random (types, nulls, missing and unknown fields, values that
+    can't be coerced) and compares every result
+    """
+    rand = random.Random(42)
+    values = [None, '', 'x', '12', '-1.5', 3, 2.5, [], {}, ['1'], {'id': '1'}]
+    for _ in range(2000):
+        if rand.random() < 0.5:
+            document = {'node': dict(NODE), 'node_tags': [dict(TAG) for _ in range(2)]}
+        else:
+            document = {'way': dict(WAY), 'way_nodes': [dict(WAY_NODE) for _ in range(2)],
+                        'way_tags': [dict(TAG)]}
+        for _ in range(rand.randint(0, 3)):
+            key = rand.choice(list(document))
+            target = document[key]
+            if isinstance(target, list) and target:
+                target = rand.choice(target)
+            change = rand.random()
+            if change < 0.1:
+                document[key] = rand.choice(values)
+            elif isinstance(target, dict) and change < 0.3:
+                if target:
+                    del target[rand.choice(list(target))]
+            elif isinstance(target, dict) and change < 0.4:
+                target['extra'] = rand.choice(values)
+            elif isinstance(target, dict) and target:
+                target[rand.choice(list(target))] = rand.choice(values)
+        assert_same_errors(document)
+
+
+def test_validate_batch():
+    documents = [{'node': dict(NODE), 'node_tags': []},
+                 {'node': dict(NODE, id='x'), 'node_tags': []},
+                 {'node': dict(NODE), 'node_tags': []},
+                 {'node': None}]
+    invalid = fastvalidator.Validator().validate_batch(documents)
+    expected = []
+    for index, document in enumerate(documents):
+        validator = cerberus.Validator(schema.schema)
+        if not validator.validate(document):
+            expected.append((index, validator.errors))
+    assert invalid == expected
+
+
+def test_unsupported_rules():
+    with pytest.raises(ValueError):
+        fastvalidator.Validator({'a': {'type': 'string', 'minlength': 2}}).validate({'a': 'x'})
+
+
+def element_rows(id_, uid='7'):
+    """
+    Returns the rows of a node in the format of osmparser.shape_element_rows
+    """
+    return ('node', (str(id_), '-25.4', '-49.2', 'u', uid, '1', '11', 't'),
+            [(str(id_), 'name', 'n', 'regular')], [])
+
+
+def test_writers_validate_in_batches(tmpdir):
+    paths = [str(tmpdir.join(os.path.basename(path))) for path in osmparser.CSV_PATHS]
+    rows = [element_rows(i) for i in range(1, 2500)]
+    assert osmparser.write_csv_rows(rows, validate=True, paths=paths) == len(rows)
+
+    # The invalid element is in the second batch, the first one is written, not the second
+    rows[1500] = element_rows(1501, uid='x')
+    with pytest.raises(Exception, match='cannot be coerced'):
+        osmparser.write_csv_rows(rows, validate=True, paths=paths)
+    with open(paths[0]) as nodesFile:
+        assert len(nodesFile.readlines()) == osmparser.VALIDATE_BATCH_SIZE + 1 # With the header
+
+    # Sampling: the invalid element (index 1500) isn't one of the validated ones (every 7th)
+    assert osmparser.write_csv_rows(rows, validate=True, validateEvery=7, paths=paths) == len(rows)
+
+    elements = [osmparser.rows_to_element(el) for el in rows]
+    with pytest.raises(Exception, match='cannot be coerced'):
+        osmparser.write_csvs(elements, validate=True, paths=paths)
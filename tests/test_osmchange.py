@@ -0,0 +1,144 @@
+"""
+Applies a change file with the osmchange module and compares the database with a fresh load of
+the changed data: elements, tags, spatial indexes, ways geometry and statistics must be the same
+"""
+
+import sqlite3
+import pytest
+import loadstats
+import osmchange
+import sqlcreator
+
+ATTRIBUTES = 'version="{version}" changeset="1" timestamp="2017-01-01T00:00:00Z" ' \
+             'user="{user}" uid="{uid}"'
+USERS = {'ana': 1, 'bia': 2, 'eva': 3, 'ivo': 4}
+
+
+def node(id_, lat, lon, user='ana', version=1, tags=()):
+    return ('node', id_, {'lat': lat, 'lon': lon, 'user': user, 'version': version}, tags)
+
+
+def way(id_, refs, user='ana', version=1, tags=()):
+    return ('way', id_, {'refs': refs, 'user': user, 'version': version}, tags)
+
+
+BEFORE = [
+    node(1, -25.40, -49.30, tags=[('addr:street', 'Rua XV'), ('addr:postcode', '80010-000')]),
+    node(2, -25.41, -49.29),
+    node(3, -25.42, -49.28, user='bia', tags=[('amenity', 'cafe')]),
+    node(4, -25.43, -49.27, user='eva', tags=[('amenity', 'bank')]),
+    node(5, -25.44, -49.26),
+    node(6, -25.35, -49.25, user='bia'), # On the border of the bounding box
+    way(100, [1, 2, 3], tags=[('highway', 'residential'), ('name', 'Rua XV')]),
+    way(101, [3, 4, 5], user='bia', tags=[('highway', 'service')]),
+    way(102, [5, 6], tags=[('highway', 'footway')])]
+
+# (action, element) in the order of the change file
+CHANGES = [
+    ('create', node(7, -25.45, -49.24, user='ivo', tags=[('amenity', 'cafe')])),
+    ('create', way(103, [6, 7], user='ivo', tags=[('highway', 'residential')])),
+    ('modify', node(3, -25.425, -49.285, user='bia', version=2, tags=[('amenity', 'bar')])),
+    ('modify', node(1, -25.40, -49.30, version=2,
+                    tags=[('addr:street', 'Rua XV'), ('addr:postcode', '80010-001'),
+                          ('name', 'Casa')])),
+    ('modify', node(6, -25.38, -49.25, user='bia', version=2)),
+    ('modify', way(102, [5, 6, 7], user='ivo', version=2,
+                   tags=[('highway', 'footway'), ('surface', 'paved')])),
+    ('delete', way(101, [3, 4, 5], user='bia')),
+    ('delete', node(4, -25.43, -49.27, user='eva'))]
+
+
+def element_xml(element):
+    tag, id_, attrib, tags = element
+    lines = []
+    if tag == 'node':
+        lines.append('  <node id="{}" lat="{}" lon="{}" {}>'.format(
+            id_, attrib['lat'], attrib['lon'],
+            ATTRIBUTES.format(uid=USERS[attrib['user']], **attrib)))
+    else:
+        lines.append('  <way id="{}" {}>'.format(
+            id_, ATTRIBUTES.format(uid=USERS[attrib['user']], **attrib)))
+        lines.extend('    <nd ref="{}"/>'.format(ref) for ref in attrib['refs'])
+    lines.extend('    <tag k="{}" v="{}"/>'.format(key, value) for key, value in tags)
+    lines.append('  </{}>'.format(tag))
+    return '\n'.join(lines)
+
+
+def write_osm(path, elements):
+    elements = sorted(elements, key=lambda element: (element[0] == 'way', element[1]))
+    path.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n' +
+               '\n'.join(element_xml(element) for element in elements) + '\n</osm>\n')
+    return str(path)
+
+
+def write_osc(path, changes):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osmChange version="0.6">']
+    for action, element in changes:
+        lines.extend(['<{}>'.format(action), element_xml(element), '</{}>'.format(action)])
+    path.write('\n'.join(lines + ['</osmChange>']) + '\n')
+    return str(path)
+
+
+def apply_changes(elements, changes):
+    """
+    Applies the changes to a list of elements, returns the changed list
+    """
+    result = {element[:2]: element for element in elements}
+    for action, element in changes:
+        if action == 'delete':
+            del result[element[:2]]
+        else:
+            result[element[:2]] = element
+    return list(result.values())
+
+
+def table_rows(conn, table):
+    """
+    Returns the sorted rows of a table, with the floats rounded (the geometry of the fresh load
+    comes from the node locations store, the changed one from the nodes table)
+    """
+    return sorted(tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+                  for row in conn.execute('SELECT * FROM {}'.format(table)))
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+def test_changes_match_a_fresh_load(tmpdir, monkeypatch, normalized):
+    monkeypatch.chdir(tmpdir) # The node locations store is written in the working directory
+    osmPath = write_osm(tmpdir.join('before.osm'), BEFORE)
+    afterPath = write_osm(tmpdir.join('after.osm'), apply_changes(BEFORE, CHANGES))
+    oscPath = write_osc(tmpdir.join('changes.osc'), CHANGES)
+
+    dbName, freshName = str(tmpdir.join('changed.db')), str(tmpdir.join('fresh.db'))
+    sqlcreator.execute_direct(dbName, osmPath, wayGeometry=True, normalized=normalized)
+    counts = osmchange.execute(dbName, oscPath)
+    assert counts == {'create': 2, 'modify': 4, 'delete': 2}
+    sqlcreator.execute_direct(freshName, afterPath, wayGeometry=True, normalized=normalized)
+
+    changed, fresh = sqlite3.Connection(dbName), sqlite3.Connection(freshName)
+    assert sqlcreator.is_normalized(changed) is normalized
+    tables = (['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags', 'way_geometry'] +
+              sqlcreator.SPATIAL_TABLES + loadstats.STATS_TABLES)
+    for table in tables:
+        assert table_rows(changed, table) == table_rows(fresh, table), table
+    # The changes were really applied (not only the same on both sides)
+    assert changed.execute('SELECT lat FROM nodes WHERE id = 3').fetchone() == (-25.425,)
+    assert changed.execute('SELECT COUNT(*) FROM ways WHERE id = 101').fetchone() == (0,)
+    assert changed.execute('SELECT max_lat FROM stats_bbox').fetchone() == (-25.38,)
+    assert changed.execute("SELECT * FROM stats_users WHERE user = 'eva'").fetchall() == []
+    changed.close()
+    fresh.close()
+
+
+def test_failed_changes_are_rolled_back(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    dbName = str(tmpdir.join('changed.db'))
+    sqlcreator.execute_direct(dbName, write_osm(tmpdir.join('before.osm'), BEFORE))
+    oscPath = str(tmpdir.join('bad.osc'))
+    tmpdir.join('bad.osc').write(
+        '<osmChange version="0.6"><delete>\n' + element_xml(BEFORE[0]) +
+        '\n</delete><modify><node id="2" lat="x" lon="1"/></modify></osmChange>\n')
+    with pytest.raises(Exception):
+        osmchange.execute(dbName, oscPath)
+    conn = sqlite3.Connection(dbName)
+    assert conn.execute('SELECT COUNT(*) FROM nodes WHERE id = 1').fetchone() == (1,)
+    conn.close()
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+PBF reader (pbfparser): a small OSM XML file is encoded by hand as a PBF file and the elements
+read from it must have the same attributes, tags, node refs and members as the XML ones
+
+The encoder below is written from the format specification, independently of the decoder:
+https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+import calendar
+import multiprocessing.pool
+import struct
+import time
+import zlib
+import xml.etree.ElementTree as ET
+from decimal import Decimal
+import pytest
+
+import osmparser
+import pbfparser
+
+OSM_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="1" lat="-25.4284" lon="-49.2733" version="3" timestamp="2017-01-02T10:00:00Z"
+       changeset="101" uid="1" user="ana">
+  <tag k="addr:street" v="Rua XV de Novembro"/>
+  <tag k="addr:postcode" v="80020-310"/>
+ </node>
+ <node id="2" lat="-25.4301" lon="-49.2712" version="1" timestamp="2017-01-02T09:00:00Z"
+       changeset="99" uid="2" user="bruno"/>
+ <node id="10" lat="-25.3" lon="-49.15" version="2" timestamp="2016-12-31T23:59:59Z"
+       changeset="120" uid="1" user="ana">
+  <tag k="name" v="Praça Tiradentes ção"/>
+  <tag k="amenity" v="restaurant"/>
+  <tag k="cuisine" v="pizza"/>
+ </node>
+ <node id="11" lat="0.0" lon="0.0000001" version="1" timestamp="1970-01-01T00:00:00Z"
+       changeset="1" uid="0" user=""/>
+ <node id="12" lat="-25.5" lon="-49.5" version="1" timestamp="2017-01-03T00:00:00Z"
+       changeset="130" uid="3" user="carla">
+  <tag k="bad key" v="x"/>
+ </node>
+ <node id="13" lat="-25.441" lon="-49.287" version="4" timestamp="2017-02-01T12:30:00Z"
+       changeset="131" uid="3" user="carla">
+  <tag k="addr:postcode" v="80.010-000"/>
+ </node>
+ <node id="20" lat="-25.401" lon="-49.201" version="1" timestamp="2017-02-01T12:31:00Z"
+       changeset="140" uid="4" user="dora"/>
+ <node id="21" lat="-25.402" lon="-49.202" version="1" timestamp="2017-02-01T12:32:00Z"
+       changeset="140" uid="4" user="dora">
+  <tag k="highway" v="bus_stop"/>
+ </node>
+ <way id="100" version="2" timestamp="2017-01-05T10:00:00Z" changeset="150" uid="1" user="ana">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <nd ref="10"/>
+  <nd ref="1"/>
+  <tag k="highway" v="residential"/>
+  <tag k="name" v="Av. Sete de Setembro"/>
+ </way>
+ <way id="101" version="1" timestamp="2017-01-06T10:00:00Z" changeset="151" uid="2" user="bruno">
+  <nd ref="21"/>
+  <nd ref="20"/>
+ </way>
+ <relation id="1000" version="1" timestamp="2017-01-07T10:00:00Z" changeset="152" uid="2"
+           user="bruno">
+  <member type="way" ref="100" role="outer"/>
+  <member type="node" ref="12" role=""/>
+  <member type="relation" ref="999" role="sub"/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+</osm>
+'''
+
+
+def varint(value):
+    value &= (1 << 64) - 1 # Negative int64 values are written as 10 bytes varints
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def field_bytes(number, data):
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def field_packed(number, values):
+    return field_bytes(number, b''.join(varint(value) for value in values))
+
+
+def deltas(values):
+    """
+    Delta codes and zigzag encodes a list of values (sint64 packed fields)
+    """
+    last = 0
+    encoded = []
+    for value in values:
+        encoded.append(zigzag(value - last))
+        last = value
+    return encoded
+
+
+class Block(object):
+    """
+    Encoder of a PrimitiveBlock with its own string table and coordinates/dates settings
+    """
+
+    def __init__(self, granularity=100, latOffset=0, lonOffset=0, dateGranularity=1000):
+        self.strings = ['']
+        self.index = {'': 0}
+        self.groups = []
+        self.granularity = granularity
+        self.latOffset = latOffset
+        self.lonOffset = lonOffset
+        self.dateGranularity = dateGranularity
+
+    def string(self, text):
+        if text not in self.index:
+            self.index[text] = len(self.strings)
+            self.strings.append(text)
+        return self.index[text]
+
+    def coordinate(self, text, offset):
+        nano = int(Decimal(text) * 1000000000)
+        assert (nano - offset) % self.granularity == 0
+        return (nano - offset) // self.granularity
+
+    def date(self, text):
+        milliseconds = calendar.timegm(time.strptime(text, '%Y-%m-%dT%H:%M:%SZ')) * 1000
+        assert milliseconds % self.dateGranularity == 0
+        return milliseconds // self.dateGranularity
+
+    def info(self, elem):
+        return field_bytes(4, field_varint(1, int(elem.get('version'))) +
+                           field_varint(2, self.date(elem.get('timestamp'))) +
+                           field_varint(3, int(elem.get('changeset'))) +
+                           field_varint(4, int(elem.get('uid'))) +
+                           field_varint(5, self.string(elem.get('user'))))
+
+    def keys_vals(self, elem):
+        tags = elem.findall('tag')
+        return (field_packed(2, [self.string(tag.get('k')) for tag in tags]) +
+                field_packed(3, [self.string(tag.get('v')) for tag in tags]))
+
+    def add_dense(self, nodes):
+        keysVals = []
+        for node in nodes:
+            for tag in node.findall('tag'):
+                keysVals += [self.string(tag.get('k')), self.string(tag.get('v'))]
+            keysVals.append(0)
+        info = (field_packed(1, [int(n.get('version')) for n in nodes]) +
+                field_packed(2, deltas([self.date(n.get('timestamp')) for n in nodes])) +
+                field_packed(3, deltas([int(n.get('changeset')) for n in nodes])) +
+                field_packed(4, deltas([int(n.get('uid')) for n in nodes])) +
+                field_packed(5, deltas([self.string(n.get('user')) for n in nodes])))
+        dense = (field_packed(1, deltas([int(n.get('id')) for n in nodes])) +
+                 field_bytes(5, info) +
+                 field_packed(8, deltas([self.coordinate(n.get('lat'), self.latOffset)
+                                         for n in nodes])) +
+                 field_packed(9, deltas([self.coordinate(n.get('lon'), self.lonOffset)
+                                         for n in nodes])) +
+                 field_packed(10, keysVals))
+        self.groups.append(field_bytes(2, dense))
+
+    def add_nodes(self, nodes):
+        self.groups.append(b''.join(field_bytes(1, (
+            field_varint(1, zigzag(int(n.get('id')))) + self.keys_vals(n) + self.info(n) +
+            field_varint(8, zigzag(self.coordinate(n.get('lat'), self.latOffset))) +
+            field_varint(9, zigzag(self.coordinate(n.get('lon'), self.lonOffset)))))
+            for n in nodes))
+
+    def add_ways(self, ways):
+        self.groups.append(b''.join(field_bytes(3, (
+            field_varint(1, int(w.get('id'))) + self.keys_vals(w) + self.info(w) +
+            field_packed(8, deltas([int(nd.get('ref')) for nd in w.findall('nd')]))))
+            for w in ways))
+
+    def add_relations(self, relations):
+        types = {'node': 0, 'way': 1, 'relation': 2}
+        self.groups.append(b''.join(field_bytes(4, (
+            field_varint(1, int(r.get('id'))) + self.keys_vals(r) + self.info(r) +
+            field_packed(8, [self.string(m.get('role')) for m in r.findall('member')]) +
+            field_packed(9, deltas([int(m.get('ref')) for m in r.findall('member')])) +
+            field_packed(10, [types[m.get('type')] for m in r.findall('member')])))
+            for r in relations))
+
+    def encode(self):
+        table = b''.join(field_bytes(1, s.encode('utf-8')) for s in self.strings)
+        data = field_bytes(1, table) + b''.join(field_bytes(2, group) for group in self.groups)
+        if self.granularity != 100:
+            data += field_varint(17, self.granularity)
+        if self.dateGranularity != 1000:
+            data += field_varint(18, self.dateGranularity)
+        if self.latOffset:
+            data += field_varint(19, self.latOffset)
+        if self.lonOffset:
+            data += field_varint(20, self.lonOffset)
+        return data
+
+
+def blob(blobType, data, compressed=True):
+    """
+    Returns a blob with its header and the size prefix
+    """
+    if compressed:
+        body = field_varint(2, len(data)) + field_bytes(3, zlib.compress(data))
+    else:
+        body = field_bytes(1, data)
+    header = field_bytes(1, blobType.encode('utf-8')) + field_varint(3, len(body))
+    return struct.pack('>I', len(header)) + header + body
+
+
+@pytest.fixture
+def files(tmpdir):
+    """
+    Writes the OSM XML file and the same data as a PBF file, split in three blocks: dense
+    nodes (zlib), plain nodes with other granularity and offsets (raw), ways and relations
+    """
+    xmlPath = tmpdir.join('test.osm')
+    xmlPath.write_text(OSM_XML, encoding='utf-8')
+    root = ET.fromstring(OSM_XML.encode('utf-8'))
+    nodes = root.findall('node')
+    first = Block()
+    first.add_dense(nodes[:4])
+    second = Block(granularity=1000, latOffset=-25000000000, lonOffset=-49000000000,
+                   dateGranularity=60000)
+    second.add_nodes(nodes[4:6])
+    second.add_dense(nodes[6:])
+    third = Block()
+    third.add_ways(root.findall('way'))
+    third.add_relations(root.findall('relation'))
+    pbfPath = tmpdir.join('test.osm.pbf')
+    pbfPath.write_binary(blob('OSMHeader', field_bytes(4, b'OsmSchema-V0.6')) +
+                         blob('OSMData', first.encode()) +
+                         blob('OSMData', second.encode(), compressed=False) +
+                         blob('OSMData', third.encode()))
+    return str(xmlPath), str(pbfPath)
+
+
+def describe(elem):
+    """
+    Returns the comparable content of an element: its attributes (with the coordinates as
+    numbers, the PBF reader doesn't keep the trailing zeros), tags, node refs and members
+    """
+    attrib = dict(elem.attrib)
+    for field in ('lat', 'lon'):
+        if field in attrib:
+            attrib[field] = Decimal(attrib[field])
+    return (elem.tag, attrib,
+            [(tag.get('k'), tag.get('v')) for tag in elem.iter('tag')],
+            [nd.get('ref') for nd in elem.iter('nd')],
+            [(m.get('type'), m.get('ref'), m.get('role')) for m in elem.iter('member')])
+
+
+def test_varints():
+    for value in [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1]:
+        assert pbfparser.read_varint(b'\xff' + varint(value), 1) == (value, 1 + len(varint(value)))
+    for value in [0, -1, 1, -2, 2 ** 40, -2 ** 40]:
+        assert pbfparser.zigzag(zigzag(value)) == value
+        assert pbfparser.signed(int.from_bytes(struct.pack('<q', value), 'little')) == value
+    values = [5, 3, 3, 10 ** 12, -7]
+    assert pbfparser.packed_delta(b''.join(varint(v) for v in deltas(values))) == values
+
+
+def test_format_coordinate():
+    assert pbfparser.format_coordinate(-25428400000) == '-25.4284'
+    assert pbfparser.format_coordinate(0) == '0.0'
+    assert pbfparser.format_coordinate(100) == '0.0000001'
+    assert pbfparser.format_coordinate(-100) == '-0.0000001'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_same_elements_as_xml(files, workers):
+    xmlPath, pbfPath = files
+    expected = [describe(elem) for elem in osmparser.get_element(xmlPath)]
+    actual = [describe(elem) for elem in pbfparser.iter_elements(pbfPath, workers=workers)]
+    assert actual == expected
+    assert len(actual) == 11
+
+
+def test_get_element_reads_pbf(files):
+    xmlPath, pbfPath = files
+    tags = ('node', 'way')
+    assert ([describe(elem) for elem in osmparser.get_element(pbfPath, tags)] ==
+            [describe(elem) for elem in osmparser.get_element(xmlPath, tags)])
+
+
+def test_same_shaped_rows_as_xml(files):
+    xmlPath, pbfPath = files
+    expected = [osmparser.shape_element_rows(elem, {}, {}, {})
+                for elem in osmparser.get_element(xmlPath, ('node', 'way'))]
+    actual = [osmparser.shape_element_rows(elem, {}, {}, {})
+              for elem in osmparser.get_element(pbfPath, ('node', 'way'))]
+
+    def without_coordinates(rows): # Only the text of the coordinates can be different
+        return [(tag, row[:1] + row[3:] if tag == 'node' else row, tags, nodes)
+                for tag, row, tags, nodes in rows]
+    assert without_coordinates(actual) == without_coordinates(expected)
+
+
+def test_bounded_imap():
+    read = []
+
+    def items():
+        for i in range(20):
+            read.append(i)
+            yield i
+
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        results = []
+        for result in pbfparser.bounded_imap(pool, lambda x: x * x, items(), 3):
+            assert len(read) - len(results) <= 3 # Items read but not yet yielded
+            results.append(result)
+    assert results == [i * i for i in range(20)]
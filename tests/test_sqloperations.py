@@ -0,0 +1,88 @@
+"""
+Result cache and session pool of the sqloperations module
+"""
+
+import sqlite3
+import threading
+import pytest
+import sqloperations
+
+
+def make_db(tmpdir):
+    """
+    Creates a database with a table t(x) with the values 1 and 2
+    """
+    dbName = str(tmpdir.join('test.db'))
+    sqloperations.execute(dbName, 'CREATE TABLE t (x INTEGER); INSERT INTO t VALUES (1), (2)',
+                          commit=True)
+    return dbName
+
+
+def test_cached_results_are_copies(tmpdir):
+    dbName = make_db(tmpdir)
+    cache = sqloperations.ResultCache()
+    first = sqloperations.execute(dbName, 'SELECT x FROM t ORDER BY x', cache=cache)
+    first.append('junk')
+    first[0].append('junk')
+    second = sqloperations.execute(dbName, 'SELECT x FROM t ORDER BY x', cache=cache)
+    assert second == [[(1,), (2,)]]
+    second.append('junk')
+    assert sqloperations.execute(dbName, 'SELECT x FROM t ORDER BY x',
+                                 cache=cache) == [[(1,), (2,)]]
+    assert cache.stats()['hits'] == 2
+    sqloperations.close_sessions()
+
+
+def test_writes_are_not_cached(tmpdir):
+    dbName = make_db(tmpdir)
+    cache = sqloperations.ResultCache()
+    for statement in ['WITH a AS (SELECT 3) INSERT INTO t SELECT * FROM a',
+                      'WITH a AS (SELECT 1) DELETE FROM t WHERE x IN (SELECT * FROM a)',
+                      'WITH a AS (SELECT 2) UPDATE t SET x = x + 10 WHERE x IN a',
+                      'INSERT INTO t VALUES (4)', 'PRAGMA user_version = 3']:
+        assert sqloperations.is_read_only(dbName, statement) is False
+        sqloperations.execute(dbName, statement, commit=True, cache=cache)
+    assert len(cache.entries) == 0
+    assert sqloperations.execute(dbName, 'SELECT x FROM t ORDER BY x',
+                                 cache=cache) == [[(3,), (4,), (12,)]]
+    for statement in ['SELECT x FROM t', 'WITH a AS (SELECT x FROM t) SELECT * FROM a',
+                      'VALUES (1)', 'EXPLAIN QUERY PLAN SELECT x FROM t',
+                      'SELECT count(*) FROM t']:
+        assert sqloperations.is_read_only(dbName, statement) is True
+    sqloperations.close_sessions()
+
+
+def test_missing_database_is_not_cached(tmpdir):
+    dbName = str(tmpdir.join('new.db'))
+    cache = sqloperations.ResultCache()
+    assert sqloperations.execute(dbName, 'SELECT 1', cache=cache) == [[(1,)]]
+    assert cache.stats()['misses'] == 0 and len(cache.entries) == 0
+    assert tmpdir.join('new.db').check()
+    sqloperations.close_sessions()
+
+
+def test_sessions_are_closed_when_their_thread_ends(tmpdir, monkeypatch):
+    dbName = make_db(tmpdir)
+    closed = []
+    close = sqloperations.Session.close
+    monkeypatch.setattr(sqloperations.Session, 'close',
+                        lambda self: closed.append(threading.get_ident()) or close(self))
+    idents = []
+
+    def work():
+        session = sqloperations.get_session(dbName)
+        sqloperations.execute(dbName, 'SELECT x FROM t')
+        assert sqloperations.get_session(dbName) is session # Reused by the thread
+        idents.append(threading.get_ident())
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert closed == idents # Closed by their own threads
+
+    main = sqloperations.get_session(dbName)
+    sqloperations.close_sessions()
+    assert sqloperations.get_pool().sessions == {}
+    with pytest.raises(sqlite3.ProgrammingError, match='closed'):
+        main.conn.execute('SELECT 1')
@@ -0,0 +1,130 @@
+"""
+Precedence of the rules of a TagTransform (type specific and ANY_TYPE maps, drops, expansions
+and function rules) and the memoized transform of osmparser.cleaning_transform
+"""
+
+import types
+import osmparser
+import tagtransform
+from tagtransform import ANY_TYPE
+
+
+def tag(key, value):
+    return types.SimpleNamespace(attrib={'k': key, 'v': value})
+
+
+def shape(transform, *pairs):
+    """
+    Shapes (key, value) pairs with a transform, returns (key, value, type) tuples
+    """
+    tags = []
+    transform.shape([tag(k, v) for k, v in pairs], '1', tags, osmparser.append_tag_tuple)
+    return [row[1:] for row in tags]
+
+
+def rewrite(transform, k, v, tp):
+    tags = []
+    transform.rewrite(tags, '1', k, v, tp, osmparser.append_tag_tuple)
+    return [row[1:] for row in tags]
+
+
+def test_type_rules_have_precedence_over_any_type():
+    transform = tagtransform.TagTransform(osmparser.PROBLEMCHARS)
+    transform.add_map('addr', 'postcode', {'1': 'addr'})
+    transform.add_map(ANY_TYPE, 'postcode', {'1': 'any', '2': 'any'})
+    transform.add_map('regular', 'postcode', {'2': 'regular'})
+    assert shape(transform, ('addr:postcode', '1'), ('addr:postcode', '2'),
+                 ('postcode', '1'), ('postcode', '2'), ('other:postcode', '1'),
+                 ('other:postcode', '3')) == [
+        ('postcode', 'addr', 'addr'), ('postcode', 'any', 'addr'),
+        ('postcode', 'any', 'regular'), ('postcode', 'regular', 'regular'),
+        ('postcode', 'any', 'other'), ('postcode', '3', 'other')]
+    # The order the rules are added doesn't matter
+    transform.add_map(ANY_TYPE, 'postcode', {'1': 'later'})
+    assert shape(transform, ('addr:postcode', '1'), ('postcode', '1')) == [
+        ('postcode', 'addr', 'addr'), ('postcode', 'later', 'regular')]
+    assert rewrite(transform, 'postcode', '1', 'addr') == [('postcode', 'addr', 'addr')]
+
+
+def test_drops_and_expansions():
+    transform = tagtransform.TagTransform(osmparser.PROBLEMCHARS)
+    transform.add_drop(ANY_TYPE, 'postcode', ['x'])
+    transform.add_map('addr', 'postcode', {'x': '80010-000'}) # Type specific, not dropped
+    transform.add_expansion('addr', 'street', {'R. A e B': [('1', 'street', 'Rua A', 'addr'),
+                                                            ('1', 'street', 'Rua B', 'addr')]})
+    transform.add_drop(ANY_TYPE, 'street', ['R. A e B']) # The expansion has precedence
+    assert shape(transform, ('postcode', 'x'), ('addr:postcode', 'x'), ('postcode', 'y'),
+                 ('addr:street', 'R. A e B'), ('street', 'R. A e B')) == [
+        ('postcode', '80010-000', 'addr'), ('postcode', 'y', 'regular'),
+        ('street', 'Rua A', 'addr'), ('street', 'Rua B', 'addr')]
+    # For the same type and key, the last rule added for a value replaces the previous ones
+    transform.add_map('addr', 'street', {'R. A e B': 'Rua A e B'})
+    assert shape(transform, ('addr:street', 'R. A e B')) == [('street', 'Rua A e B', 'addr')]
+    assert rewrite(transform, 'street', 'R. A e B', 'regular') == []
+
+
+def test_function_rules():
+    calls = []
+
+    def rule(name, result):
+        def function(value):
+            calls.append((name, value))
+            return result(value)
+        return function
+
+    transform = tagtransform.TagTransform(osmparser.PROBLEMCHARS)
+    transform.add_rule(ANY_TYPE, 'name', rule('any', lambda v: v.upper() if v != 'keep' else None))
+    transform.add_rule('addr', 'name', rule('addr1', lambda v: None))
+    transform.add_rule('addr', 'name', rule('addr2', lambda v: 'addr' if v == 'a' else None))
+    transform.add_map(ANY_TYPE, 'name', {'mapped': 'map'}) # The maps are checked first
+    assert shape(transform, ('addr:name', 'a'), ('addr:name', 'b'), ('addr:name', 'keep'),
+                 ('addr:name', 'mapped'), ('name', 'a'), ('name', 'a'),
+                 ('addr:name', 'a')) == [
+        ('name', 'addr', 'addr'), ('name', 'B', 'addr'), ('name', 'keep', 'addr'),
+        ('name', 'map', 'addr'), ('name', 'A', 'regular'), ('name', 'A', 'regular'),
+        ('name', 'addr', 'addr')]
+    # Type specific functions first, in the order they were added, the results are memoized
+    assert calls == [('addr1', 'a'), ('addr2', 'a'), ('addr1', 'b'), ('addr2', 'b'),
+                     ('any', 'b'), ('addr1', 'keep'), ('addr2', 'keep'), ('any', 'keep'),
+                     ('any', 'a')]
+    # A rule added later is applied to the keys already classified
+    transform.add_map('regular', 'name', {'a': 'new'})
+    assert shape(transform, ('name', 'a')) == [('name', 'new', 'regular')]
+
+
+def test_keys_classification():
+    transform = tagtransform.TagTransform(osmparser.PROBLEMCHARS, defaultType='plain')
+    transform.add_drop(ANY_TYPE, 'street', ['x'])
+    assert shape(transform, ('name', 'n'), ('addr:street:name', 'x'), ('addr:street', 'x'),
+                 ('bad key', 'v'), ('a.b', 'v'), ('street', 'x')) == [
+        ('name', 'n', 'plain'), ('street:name', 'x', 'addr')]
+
+
+def test_cleaning_transform_is_memoized(monkeypatch):
+    builds = []
+    build = tagtransform.build_cleaning_transform
+    monkeypatch.setattr(tagtransform, 'build_cleaning_transform',
+                        lambda *args: builds.append(args) or build(*args))
+    streets, overrides, postcodes = {'R. XV': 'Rua XV'}, {}, {'123': 'Invalid Postal Code'}
+    for _ in range(3):
+        tags = []
+        osmparser.shape_tags([tag('addr:street', 'R. XV'), tag('postcode', '123')], '1', tags,
+                             osmparser.PROBLEMCHARS, 'regular', streets, overrides, postcodes,
+                             append=osmparser.append_tag_tuple)
+        assert tags == [('1', 'street', 'Rua XV', 'addr')]
+        assert osmparser.clean_tags([{'id': '1', 'key': 'street', 'value': 'R. XV',
+                                      'type': 'addr'}], streets, overrides,
+                                    postcodes)[0]['value'] == 'Rua XV'
+    assert len(builds) == 1
+    transform = osmparser.cleaning_transform(streets, overrides, postcodes)
+    assert osmparser.cleaning_transform(streets, overrides, postcodes) is transform
+
+    # Other dictionaries, or the same ones with new values, build a new transform
+    postcodes['80010000'] = '80010-000'
+    changed = osmparser.cleaning_transform(streets, overrides, postcodes)
+    assert changed is not transform
+    assert rewrite(changed, 'postcode', '80010000', 'addr') == [('postcode', '80010-000', 'addr')]
+    assert osmparser.cleaning_transform(dict(streets), overrides, postcodes) is not changed
+    assert osmparser.cleaning_transform(streets, overrides, postcodes,
+                                        default_tag_type='plain') is not changed
+    assert len(builds) == 4
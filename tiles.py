@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Generates a pyramid of map tiles (z/x/y, like the OpenStreetMap slippy map tiles) with the
+density of the points of the database created by the sqlcreator module
+
+The map is split in regions (the tiles of regionZoom), rendered in parallel by a pool of
+processes. Each region reads its points once (through the R*Tree tables, when they exist),
+bins them at the maximum zoom and builds the lower zooms by adding blocks of 2x2 pixels. The
+zooms below regionZoom are built from the region rasters. A checksum of the points of each
+region is kept in a manifest, so the regions whose data didn't change are skipped when the
+tiles are generated again.
+
+Tiles are saved as PNG images or as .npy density arrays (counts of points per pixel)
+
+Usage: python tiles.py curitiba.db tiles
+"""
+
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import sys
+import numpy as np
+import matplotlib
+import matplotlib.image
+import geometry
+import sqlcreator
+
+TILE_SIZE = 256 # Pixels of each side of a tile
+CHUNK_SIZE = 100000 # Number of rows fetched from the database at once
+MAX_DENSITY = 100 # Points per pixel that get the last color of the PNG color map
+COLOR_MAP = 'inferno'
+MANIFEST = 'manifest.json'
+REGIONS_DIR = 'regions' # Region rasters, used to build the zooms below regionZoom
+COUNT_DTYPE = np.int32 # Points per pixel of the rasters, 4 bytes (up to 2 ** 31 - 1 points)
+
+# Points of a region, by source, with and without the R*Tree tables
+POINT_QUERIES = {
+    ('nodes', True): '''SELECT n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.id = r.id
+                        WHERE r.maxLat >= ? AND r.minLat <= ? AND r.maxLon >= ? AND r.minLon <= ?
+                        ORDER BY n.id''',
+    ('nodes', False): '''SELECT lat, lon FROM nodes
+                         WHERE lat >= ? AND lat <= ? AND lon >= ? AND lon <= ?
+                         ORDER BY id''',
+    ('ways', True): '''SELECT g.coords FROM ways_rtree r JOIN way_geometry g ON g.id = r.id
+                       WHERE r.maxLat >= ? AND r.minLat <= ? AND r.maxLon >= ? AND r.minLon <= ?
+                       ORDER BY g.id''',
+    ('ways', False): '''SELECT coords FROM way_geometry
+                        WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+                        ORDER BY id'''}
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounding box of a tile
+
+    Args:
+        z, x, y: zoom and coordinates of the tile
+
+    Returns:
+        A (minLat, minLon, maxLat, maxLon) tuple
+    """
+    n = 2 ** z
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0
+
+
+def tile_of(lat, lon, z):
+    """
+    Returns the (x, y) coordinates of the tile of a zoom that contains a point
+    """
+    n = 2 ** z
+    x, y = to_pixels(np.array([lat]), np.array([lon]), z, 1)
+    return min(int(x[0]), n - 1), min(int(y[0]), n - 1)
+
+
+def to_pixels(lats, lons, z, tileSize=TILE_SIZE):
+    """
+    Projects coordinates to the global pixel coordinates of a zoom (web mercator)
+
+    Args:
+        lats, lons: NumPy arrays of coordinates, in degrees
+        z: zoom
+        tileSize: pixels of each side of a tile
+
+    Returns:
+        x, y: NumPy float arrays, y grows to the south
+    """
+    n = tileSize * 2 ** z
+    x = (lons + 180.0) / 360.0 * n
+    latRad = np.radians(np.clip(lats, -85.0511, 85.0511))
+    y = (1.0 - np.log(np.tan(latRad) + 1.0 / np.cos(latRad)) / math.pi) / 2.0 * n
+    return x, y
+
+
+def stream_region(conn, source, bounds, spatial, chunkSize=CHUNK_SIZE):
+    """
+    Streams the points of a region
+
+    Args:
+        conn: sqlite3 Connection object
+        source: 'nodes' (the nodes) or 'ways' (the vertices of the way_geometry table)
+        bounds: (minLat, minLon, maxLat, maxLon) tuple
+        spatial: True if the database has the R*Tree tables
+        chunkSize: number of rows fetched at once
+
+    Yields:
+        (n, 2) float64 arrays of (lat, lon) points, they can have points outside the region
+    """
+    minLat, minLon, maxLat, maxLon = bounds
+    cursor = conn.execute(POINT_QUERIES[source, spatial], (minLat, maxLat, minLon, maxLon))
+    while True:
+        rows = cursor.fetchmany(chunkSize)
+        if not rows:
+            break
+        if source == 'nodes':
+            yield np.array(rows, dtype=np.float64)
+        else:
+            yield geometry.decode_coords_degrees(b''.join(coords for (coords,) in rows))
+
+
+def downsample(raster):
+    """
+    Halves the resolution of a raster, adding blocks of 2x2 pixels
+    """
+    height, width = raster.shape
+    return raster.reshape(height // 2, 2, width // 2, 2).sum(axis=(1, 3), dtype=raster.dtype)
+
+
+def tile_path(outDir, z, x, y, fmt):
+    """
+    Path of a tile: outDir/z/x/y.png or outDir/z/x/y.npy
+    """
+    return os.path.join(outDir, str(z), str(x), '{}.{}'.format(y, fmt))
+
+
+def save_tile(outDir, z, x, y, raster, fmt, maxDensity=MAX_DENSITY):
+    """
+    Saves a tile, empty tiles aren't saved (and the old file is removed, if it exists)
+
+    Args:
+        outDir: directory of the pyramid
+        z, x, y: zoom and coordinates of the tile
+        raster: (TILE_SIZE, TILE_SIZE) array with the number of points in each pixel
+        fmt: 'png' or 'npy'
+        maxDensity: points per pixel that get the last color of the color map (png only)
+
+    Returns:
+        True if the tile was saved
+    """
+    path = tile_path(outDir, z, x, y, fmt)
+    if not raster.any():
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if fmt == 'npy':
+        np.save(path, raster)
+    else:
+        scaled = np.log1p(raster) / math.log1p(maxDensity)
+        colors = matplotlib.colormaps[COLOR_MAP](np.clip(scaled, 0.0, 1.0))
+        colors[..., 3] = raster > 0 # Pixels without points are transparent
+        matplotlib.image.imsave(path, colors)
+    return True
+
+
+def save_level(outDir, z, x0, y0, raster, fmt, tileSize, maxDensity):
+    """
+    Splits the raster of a block of tiles (x0, y0 is the first tile) and saves every tile
+
+    Returns:
+        The number of saved tiles
+    """
+    saved = 0
+    count = raster.shape[0] // tileSize
+    for row in range(count):
+        for col in range(count):
+            tile = raster[row * tileSize:(row + 1) * tileSize, col * tileSize:(col + 1) * tileSize]
+            saved += save_tile(outDir, z, x0 + col, y0 + row, tile, fmt, maxDensity)
+    return saved
+
+
+def render_region(args):
+    """
+    Renders the tiles of a region, from the maximum zoom to the zoom of the region
+    Run by the worker processes, each one holds the COUNT_DTYPE raster of its region at the
+    maximum zoom (see execute) and the points are added by chunk, without full size buffers
+
+    Args:
+        args: (dbName, outDir, region, maxZoom, fmt, tileSize, maxDensity, source, oldChecksum)
+              tuple, region is a (z, x, y) tuple
+
+    Returns:
+        (region, checksum, saved) tuple, saved is the number of saved tiles, or None if the
+        data of the region didn't change
+    """
+    dbName, outDir, region, maxZoom, fmt, tileSize, maxDensity, source, oldChecksum = args
+    z, x, y = region
+    scale = 2 ** (maxZoom - z)
+    side = tileSize * scale
+    raster = np.zeros(side * side, dtype=COUNT_DTYPE)
+    checksum = hashlib.sha1()
+    conn = sqlite3.Connection(dbName)
+    try:
+        spatial = sqlcreator.has_spatial_index(conn)
+        for points in stream_region(conn, source, tile_bounds(z, x, y), spatial):
+            checksum.update(points.tobytes())
+            px, py = to_pixels(points[:, 0], points[:, 1], maxZoom, tileSize)
+            cols = np.floor(px).astype(np.int64) - x * side
+            rows = np.floor(py).astype(np.int64) - y * side
+            inside = (cols >= 0) & (cols < side) & (rows >= 0) & (rows < side)
+            # Only the pixels of the chunk are counted (a bincount would be as large as the raster)
+            pixels, counts = np.unique(rows[inside] * side + cols[inside], return_counts=True)
+            raster[pixels] += counts.astype(COUNT_DTYPE)
+    finally:
+        conn.close()
+    checksum = checksum.hexdigest()
+    regionPath = os.path.join(outDir, REGIONS_DIR, '{}-{}-{}.npy'.format(z, x, y))
+    if checksum == oldChecksum and os.path.exists(regionPath):
+        return region, checksum, None
+
+    raster = raster.reshape(side, side)
+    saved = 0
+    for zoom in range(maxZoom, z - 1, -1):
+        saved += save_level(outDir, zoom, x * scale, y * scale, raster, fmt, tileSize, maxDensity)
+        if zoom > z:
+            raster = downsample(raster)
+            scale //= 2
+    np.save(regionPath, raster)
+    return region, checksum, saved
+
+
+def execute(dbName, outDir, minZoom=0, maxZoom=14, regionZoom=10, fmt='png', workers=None,
+            tileSize=TILE_SIZE, maxDensity=MAX_DENSITY, source='nodes', prints=True):
+    """
+    Main function of this module:
+    Generates (or updates) the tile pyramid of a database
+
+    Args:
+        dbName: a SQLite database name, ex: 'example.db'
+        outDir: directory of the pyramid, the tiles are saved in outDir/z/x/y.png (or .npy)
+        minZoom, maxZoom: zooms of the pyramid
+        regionZoom: zoom of the tiles used as regions, each region is rendered by a worker,
+                    with a (TILE_SIZE * 2 ** (maxZoom - regionZoom)) pixels square raster of
+                    COUNT_DTYPE counts: 4 * (TILE_SIZE * 2 ** (maxZoom - regionZoom)) ** 2
+                    bytes, 64 MB per worker with the defaults (4096 x 4096 pixels), plus a
+                    quarter of it while the lower zooms are built, each zoom added to
+                    regionZoom divides it by 4
+        fmt: 'png' (images) or 'npy' (arrays with the number of points of each pixel)
+        workers: number of processes, defaults to the number of CPUs
+        tileSize: pixels of each side of a tile
+        maxDensity: points per pixel that get the last color of the color map (png only)
+        source: 'nodes' renders the nodes, 'ways' renders the vertices of the ways (the database
+                needs the way_geometry table, see sqlcreator.build_way_geometry)
+        prints: True prints a summary
+
+    Returns:
+        A dictionary with the number of rendered regions, skipped regions and saved tiles
+    """
+    if fmt not in ('png', 'npy'):
+        raise ValueError("fmt must be 'png' or 'npy'")
+    if not minZoom <= regionZoom <= maxZoom:
+        raise ValueError('The zooms must be minZoom <= regionZoom <= maxZoom')
+    os.makedirs(os.path.join(outDir, REGIONS_DIR), exist_ok=True)
+
+    # The checksums are only valid for the same parameters
+    params = [minZoom, maxZoom, regionZoom, fmt, tileSize, maxDensity, source]
+    manifestPath = os.path.join(outDir, MANIFEST)
+    manifest = {'params': params, 'regions': {}}
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as f:
+            old = json.load(f)
+        if old['params'] == params:
+            manifest = old
+
+    conn = sqlite3.Connection(dbName)
+    try:
+        minLat, maxLat, minLon, maxLon = conn.execute(
+            'SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM nodes').fetchone()
+    finally:
+        conn.close()
+    if minLat is None:
+        return {'rendered': 0, 'skipped': 0, 'tiles': 0}
+    x0, y0 = tile_of(maxLat, minLon, regionZoom)
+    x1, y1 = tile_of(minLat, maxLon, regionZoom)
+    regions = [(regionZoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    jobs = [(dbName, outDir, region, maxZoom, fmt, tileSize, maxDensity, source,
+             manifest['regions'].get('{}/{}/{}'.format(*region))) for region in regions]
+    counts = {'rendered': 0, 'skipped': 0, 'tiles': 0}
+    workers = workers or multiprocessing.cpu_count()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(render_region, jobs)
+    else:
+        pool = None
+        results = (render_region(job) for job in jobs)
+    try:
+        for region, checksum, saved in results:
+            manifest['regions']['{}/{}/{}'.format(*region)] = checksum
+            if saved is None:
+                counts['skipped'] += 1
+            else:
+                counts['rendered'] += 1
+                counts['tiles'] += saved
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # The zooms below regionZoom are built from the region rasters, only when something changed
+    if counts['rendered'] > 0:
+        level = {}
+        for z, x, y in regions:
+            level[x, y] = np.load(os.path.join(outDir, REGIONS_DIR, '{}-{}-{}.npy'.format(z, x, y)))
+        for z in range(regionZoom - 1, minZoom - 1, -1):
+            parents = {}
+            for (x, y), raster in level.items():
+                parent = parents.setdefault((x // 2, y // 2),
+                                            np.zeros((2 * tileSize, 2 * tileSize),
+                                                     COUNT_DTYPE))
+                row, col = (y % 2) * tileSize, (x % 2) * tileSize
+                parent[row:row + tileSize, col:col + tileSize] = raster
+            level = {}
+            for (x, y), raster in parents.items():
+                level[x, y] = downsample(raster)
+                counts['tiles'] += save_tile(outDir, z, x, y, level[x, y], fmt, maxDensity)
+
+    with open(manifestPath, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if prints is True:
+        print('{rendered} regions rendered, {skipped} unchanged, {tiles} tiles saved'.format(
+            **counts))
+    return counts
+
+
+if __name__ == '__main__':
+    # If the module is used directly, generates the tiles of the database (default: curitiba.db)
+    dbName, outDir = sys.argv[1:3] if len(sys.argv) > 2 else ('curitiba.db', 'tiles')
+    execute(dbName, outDir)
@@ -0,0 +1,54 @@
+"""
+Small helper functions shared by the other modules
+"""
+
+import sys
+
+try:
+    import resource
+except ImportError: # The resource module is not available on Windows
+    resource = None
+
+
+STATUS_PATH = '/proc/self/status' # Linux: VmHWM is the peak resident set size
+CLEAR_REFS_PATH = '/proc/self/clear_refs' # Linux: writing 5 resets VmHWM
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of the current process, so peak_rss measures only what
+    runs after the reset. It's only possible on Linux, on the other platforms peak_rss keeps
+    returning the peak of the whole process
+
+    Returns:
+        True if the peak was reset
+    """
+    try:
+        with open(CLEAR_REFS_PATH, 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size (maximum memory used) of the current process, since the
+    last reset_peak_rss when it's supported
+
+    Returns:
+        The peak memory usage in megabytes, or None if it can't be measured on this platform
+    """
+    try:
+        with open(STATUS_PATH) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024 # In kilobytes
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # macOS reports it in bytes, Linux in kilobytes
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024